@@ -0,0 +1,58 @@
+"""Streams rows as NDJSON or CSV with constant memory,
+the rows are expected to be read by a server-side cursor (e.g. QuerySet.iterator() on PostgreSQL)."""
+import csv
+import json
+from datetime import datetime as DateTime
+from itertools import islice
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+FORMATS = {  # format -> content type
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+ROWS_PER_CHUNK = 1000  # of the response
+
+
+class _Echo:
+    """A file-like object for csv.writer, the written line is returned instead of being buffered"""
+
+    def write(self, value):
+        return value
+
+
+def _ndjson_lines(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+
+def _csv_value(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, DateTime):
+        return value.isoformat()
+    return value
+
+
+def _csv_lines(fields, rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([_csv_value(value) for value in row])
+
+
+_LINE_WRITERS = {
+    'ndjson': _ndjson_lines,
+    'csv': _csv_lines,
+}
+
+
+def stream(fields, rows, fmt):
+    """Yields the chunks of the rows in the format, a row has the values of the fields"""
+    lines = _LINE_WRITERS[fmt](fields, rows)
+    while True:
+        chunk = ''.join(islice(lines, ROWS_PER_CHUNK))
+        if not chunk:
+            break
+        yield chunk
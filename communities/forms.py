@@ -49,6 +49,8 @@ class CommunitySearchForm(AbstractForm):
         ('followers', 'Followers'),
         ('views_per_post', 'Views'),
         ('likes_per_view', 'Likes'),
+        ('growth_per_day', 'Growth per day'),
+        ('growth_per_week', 'Growth per week'),
     ]
 
     verified = YesNoAllField()
@@ -90,6 +92,7 @@ class PostSearchForm(AbstractForm):
         ('published_at', 'Date'),
         ('views', 'Views'),
         ('post_likes_per_view', 'Likes/1000Views'),
+        ('search_rank', 'Relevance'),
     ]
 
     community_id = forms.IntegerField(required=False, min_value=0)
@@ -124,3 +127,14 @@ class PostSearchForm(AbstractForm):
         self._validate_range('date_min', 'date_max')
         self._validate_range('views_min', 'views_max')
         self._validate_range('likes_per_view_min', 'likes_per_view_max')
+
+
+class CommunityHistoryExportForm(AbstractForm):
+
+    community_id = forms.IntegerField(required=False, min_value=0)
+    date_min = forms.DateTimeField(required=False)
+    date_max = forms.DateTimeField(required=False)
+
+    def clean(self):
+        super().clean()
+        self._validate_range('date_min', 'date_max')
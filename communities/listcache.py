@@ -0,0 +1,67 @@
+"""The cache of the ordered ids found by the list views.
+The results expire by time, and all of them are invalidated at once by bumping the generation of a model,
+which is done by the jobs changing many rows (see datacollector)."""
+import hashlib
+import json
+
+from django.core.cache import cache
+
+
+RESULTS_TIMEOUT = 5 * 60  # seconds
+KEY_PREFIX = 'communities:listcache'
+
+
+def _generation_key(model):
+    return '{0}:generation:{1}'.format(KEY_PREFIX, model._meta.label_lower)
+
+
+def generation(model):
+    return cache.get_or_set(_generation_key(model), 0, None)
+
+
+def bump_generation(model):
+    key = _generation_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:  # the key is absent
+        cache.set(key, 1, None)
+
+
+def results_key(model, params):
+    """The params are normalized, so the same search gives the same key regardless of the order of the params"""
+    normalized = json.dumps(params, sort_keys=True, default=str)
+    return '{0}:{1}:{2}:{3}'.format(
+        KEY_PREFIX,
+        model._meta.label_lower,
+        generation(model),
+        hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+    )
+
+
+def get_ids(queryset, params, limit):
+    """Returns the list of the first ids of the queryset, it is cached by the params of the search"""
+    key = results_key(queryset.model, params)
+    ids = cache.get(key)
+    if ids is None:
+        ids = list(queryset.values_list('pk', flat=True)[:limit])
+        cache.set(key, ids, RESULTS_TIMEOUT)
+    return ids
+
+
+class ObjectsByIds:
+    """A sequence of the objects with the ids, only the requested slices of the objects are fetched.
+    It is suitable for the pagination of ListView."""
+
+    def __init__(self, queryset, ids):
+        self._queryset = queryset
+        self._ids = ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            ids = self._ids[index]
+            id2obj = self._queryset.in_bulk(ids)
+            return [id2obj[id_] for id_ in ids if id_ in id2obj]  # the deleted objects are skipped
+        return self._queryset.get(pk=self._ids[index])
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0019_drop_post_content_fts_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='content_hash',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
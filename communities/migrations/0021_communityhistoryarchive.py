@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 11:40
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0020_community_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CommunityHistoryArchive',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('month', models.DateField()),
+                ('offsets', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+                ('followers', django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), size=None)),
+                ('community', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='communities.Community')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='communityhistoryarchive',
+            unique_together=set([('community', 'month')]),
+        ),
+        migrations.RunSQL(
+            '''
+            INSERT INTO "communities_communityhistoryarchive" ("community_id", "month", "offsets", "followers")
+            SELECT "community_id", "month",
+                array_agg(EXTRACT(EPOCH FROM "utc_checked_at" - "month")::integer ORDER BY "utc_checked_at"),
+                array_agg("followers" ORDER BY "utc_checked_at")
+            FROM (
+                SELECT DISTINCT ON ("community_id", "day") "community_id", "followers", "utc_checked_at", "month"
+                FROM (
+                    SELECT "community_id", "followers", "checked_at" AT TIME ZONE 'UTC' AS "utc_checked_at",
+                        date_trunc('day', "checked_at" AT TIME ZONE 'UTC') AS "day",
+                        date_trunc('month', "checked_at" AT TIME ZONE 'UTC') AS "month"
+                    FROM "communities_communityhistory" WHERE "checked_at" <
+                        date_trunc('day', now() AT TIME ZONE 'UTC' - INTERVAL '7 days') AT TIME ZONE 'UTC'
+                ) AS "r" ORDER BY "community_id", "day", "utc_checked_at"
+            ) AS "h"
+            GROUP BY "community_id", "month";
+
+            DELETE FROM "communities_communityhistory"
+            WHERE "checked_at" < date_trunc('day', now() AT TIME ZONE 'UTC' - INTERVAL '7 days') AT TIME ZONE 'UTC';''',
+
+            '''
+            INSERT INTO "communities_communityhistory" ("community_id", "checked_at", "followers")
+            SELECT "community_id",
+                ("month"::timestamp AT TIME ZONE 'UTC') + "sample"."offset" * INTERVAL '1 second',
+                "sample"."followers"
+            FROM "communities_communityhistoryarchive",
+                unnest("offsets", "followers") AS "sample"("offset", "followers");'''
+        ),
+    ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 13:05
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from communities.models import PostManager
+
+
+class Migration(migrations.Migration):
+    """Makes "communities_post" a table partitioned by week of "published_at" (PostgreSQL 11+).
+    A primary key of a partitioned table must include the partition key, so it is ("id", "published_at").
+    The posts out of the range of the partitions are stored in the default partition."""
+
+    dependencies = [
+        ('communities', '0021_communityhistoryarchive'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            ALTER TABLE "communities_post" RENAME TO "communities_post_old";
+
+            CREATE TABLE "communities_post" (LIKE "communities_post_old" INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+            PARTITION BY RANGE ("published_at");
+            ALTER TABLE "communities_post" ADD PRIMARY KEY ("id", "published_at");
+            ALTER TABLE "communities_post" ADD CONSTRAINT "communities_post_community_id_fk"
+                FOREIGN KEY ("community_id") REFERENCES "communities_community" ("vkid") DEFERRABLE INITIALLY DEFERRED;
+
+            CREATE TABLE "communities_post_default" PARTITION OF "communities_post" DEFAULT;
+            DO $$
+            DECLARE
+                week timestamp;
+            BEGIN
+                FOR week IN SELECT generate_series(
+                    date_trunc('week', now() AT TIME ZONE 'UTC') - INTERVAL '14 weeks',
+                    date_trunc('week', now() AT TIME ZONE 'UTC') + INTERVAL '4 weeks',
+                    INTERVAL '1 week'
+                ) LOOP
+                    EXECUTE format(
+                        'CREATE TABLE %I PARTITION OF "communities_post" FOR VALUES FROM (%L) TO (%L)',
+                        'communities_post_p' || to_char(week, 'YYYYMMDD'),
+                        week AT TIME ZONE 'UTC',
+                        (week + INTERVAL '1 week') AT TIME ZONE 'UTC'
+                    );
+                END LOOP;
+            END
+            $$;
+
+            INSERT INTO "communities_post" SELECT * FROM "communities_post_old";
+            DROP TABLE "communities_post_old";
+
+            CREATE INDEX "communities_post_community_id_index" ON "communities_post" ("community_id");
+            CREATE INDEX "communities_post_published_at_index" ON "communities_post" ("published_at");
+            CREATE INDEX "communities_post_views_index" ON "communities_post" ("views");
+            CREATE INDEX "communities_post_likes_per_view_index" ON "communities_post" (({0}));
+            CREATE INDEX "communities_post_content_fts_index_v2" ON "communities_post"
+                USING GIN(("post_content_to_tsvector"('russian', "content")));'''.format(
+                PostManager.POST_LIKES_PER_VIEW_EXPRESSION
+            ),
+            # the partitions are merged back into a plain table, it takes as long as the forward migration
+            '''
+            ALTER TABLE "communities_post" RENAME TO "communities_post_partitioned";
+
+            CREATE TABLE "communities_post"
+            (LIKE "communities_post_partitioned" INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+            INSERT INTO "communities_post" SELECT * FROM "communities_post_partitioned";
+            DROP TABLE "communities_post_partitioned";
+
+            ALTER TABLE "communities_post" ADD PRIMARY KEY ("id");
+            ALTER TABLE "communities_post" ADD CONSTRAINT "communities_post_community_id_fk"
+                FOREIGN KEY ("community_id") REFERENCES "communities_community" ("vkid") DEFERRABLE INITIALLY DEFERRED;
+
+            CREATE INDEX "communities_post_community_id_index" ON "communities_post" ("community_id");
+            CREATE INDEX "communities_post_published_at_index" ON "communities_post" ("published_at");
+            CREATE INDEX "communities_post_views_index" ON "communities_post" ("views");
+            CREATE INDEX "communities_post_likes_per_view_index" ON "communities_post" (({0}));
+            CREATE INDEX "communities_post_content_fts_index_v2" ON "communities_post"
+                USING GIN(("post_content_to_tsvector"('russian', "content")));'''.format(
+                PostManager.POST_LIKES_PER_VIEW_EXPRESSION
+            )
+        )
+    ]
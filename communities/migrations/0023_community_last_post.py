@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 14:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0022_partition_post_by_published_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='last_post_vkid',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='community',
+            name='last_post_published_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
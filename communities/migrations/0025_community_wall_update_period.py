@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 17:25
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('communities', '0024_community_checked_at_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='wall_update_period',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 18:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('communities', '0025_community_wall_update_period'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='community',
+            name='next_check_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE communities_community SET next_check_at = checked_at + interval '12 hours' "
+            "WHERE checked_at IS NOT NULL",
+            migrations.RunSQL.noop
+        ),
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY communities_community_next_check_at_index '
+            'ON communities_community (next_check_at)',
+            'DROP INDEX communities_community_next_check_at_index'
+        ),
+    ]
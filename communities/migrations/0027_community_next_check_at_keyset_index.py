@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 18:40
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('communities', '0026_community_next_check_at'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX CONCURRENTLY communities_community_next_check_at_vkid_index '
+            'ON communities_community (next_check_at, vkid)',
+            'DROP INDEX communities_community_next_check_at_vkid_index'
+        ),
+        migrations.RunSQL(
+            'DROP INDEX CONCURRENTLY communities_community_next_check_at_index',
+            'CREATE INDEX CONCURRENTLY communities_community_next_check_at_index '
+            'ON communities_community (next_check_at)'
+        ),
+    ]
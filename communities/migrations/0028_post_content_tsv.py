@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 19:20
+from __future__ import unicode_literals
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """Stores the tsvector of the content of a post. It is maintained by triggers:
+    AFTER INSERT of the partitioned table computes it for the inserted rows only, because BEFORE INSERT triggers
+    run for all the rows proposed by INSERT ... ON CONFLICT, even for those which only update the existing rows;
+    BEFORE UPDATE of every partition (PostgreSQL 11 does not allow them on a partitioned table,
+    see PostQuerySet.create_partitions()) recomputes it only when the content is changed."""
+
+    dependencies = [
+        ('communities', '0027_community_next_check_at_keyset_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            ALTER TABLE "communities_post" ADD COLUMN "content_tsv" tsvector NULL;
+            UPDATE "communities_post" SET "content_tsv" = "post_content_to_tsvector"('russian', "content");
+
+            CREATE FUNCTION "communities_post_content_tsv_trigger" () RETURNS trigger AS
+            $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    -- the partition is updated directly, a generic plan over all the partitions would be slow
+                    EXECUTE format(
+                        'UPDATE %s SET "content_tsv" = "post_content_to_tsvector"(''russian'', $1) '
+                        'WHERE "id" = $2 AND "published_at" = $3',
+                        TG_RELID::regclass
+                    ) USING NEW."content", NEW."id", NEW."published_at";
+                    RETURN NULL;
+                END IF;
+                IF NEW."content" IS DISTINCT FROM OLD."content" THEN
+                    NEW."content_tsv" = "post_content_to_tsvector"('russian', NEW."content");
+                ELSIF OLD."content_tsv" IS NOT NULL THEN  -- it is NULL only before the update made on insert
+                    NEW."content_tsv" = OLD."content_tsv";
+                END IF;
+                RETURN NEW;
+            END
+            $$
+            LANGUAGE plpgsql;
+
+            DO $$
+            DECLARE
+                part regclass;
+            BEGIN
+                FOR part IN SELECT "inhrelid"::regclass FROM "pg_inherits"
+                        WHERE "inhparent" = '"communities_post"'::regclass LOOP
+                    EXECUTE format(
+                        'CREATE TRIGGER "communities_post_content_tsv" BEFORE UPDATE ON %s '
+                        'FOR EACH ROW EXECUTE PROCEDURE "communities_post_content_tsv_trigger"()',
+                        part
+                    );
+                END LOOP;
+            END
+            $$;
+            CREATE TRIGGER "communities_post_content_tsv_insert" AFTER INSERT ON "communities_post"
+                FOR EACH ROW EXECUTE PROCEDURE "communities_post_content_tsv_trigger"();
+
+            DROP INDEX "communities_post_content_fts_index_v2";
+            CREATE INDEX "communities_post_content_tsv_index" ON "communities_post" USING GIN ("content_tsv");''',
+
+            '''
+            DROP INDEX "communities_post_content_tsv_index";
+            CREATE INDEX "communities_post_content_fts_index_v2" ON "communities_post"
+                USING GIN(("post_content_to_tsvector"('russian', "content")));
+            DROP FUNCTION "communities_post_content_tsv_trigger" () CASCADE;
+            ALTER TABLE "communities_post" DROP COLUMN "content_tsv";''',
+
+            state_operations=[
+                migrations.AddField(
+                    model_name='post',
+                    name='content_tsv',
+                    field=django.contrib.postgres.search.SearchVectorField(blank=True, editable=False, null=True),
+                ),
+            ]
+        )
+    ]
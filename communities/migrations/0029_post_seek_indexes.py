@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.11 on 2026-10-17 20:10
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from communities.models import PostManager
+
+
+class Migration(migrations.Migration):
+    """The indexes on the sorting keys of the posts get "id" as the last column for the keyset pagination"""
+
+    dependencies = [
+        ('communities', '0028_post_content_tsv'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            '''
+            CREATE INDEX "communities_post_published_at_id_index" ON "communities_post" ("published_at", "id");
+            CREATE INDEX "communities_post_views_id_index" ON "communities_post" ("views", "id");
+            CREATE INDEX "communities_post_likes_per_view_id_index" ON "communities_post" (({0}), "id");
+            DROP INDEX "communities_post_published_at_index";
+            DROP INDEX "communities_post_views_index";
+            DROP INDEX "communities_post_likes_per_view_index";'''.format(
+                PostManager.POST_LIKES_PER_VIEW_EXPRESSION
+            ),
+
+            '''
+            CREATE INDEX "communities_post_published_at_index" ON "communities_post" ("published_at");
+            CREATE INDEX "communities_post_views_index" ON "communities_post" ("views");
+            CREATE INDEX "communities_post_likes_per_view_index" ON "communities_post" (({0}));
+            DROP INDEX "communities_post_published_at_id_index";
+            DROP INDEX "communities_post_views_id_index";
+            DROP INDEX "communities_post_likes_per_view_id_index";'''.format(
+                PostManager.POST_LIKES_PER_VIEW_EXPRESSION
+            )
+        )
+    ]
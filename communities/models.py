@@ -1,6 +1,13 @@
-from django.db import models
-from django.db.models.expressions import RawSQL, Func, F, Value, Q
-from django.contrib.postgres.fields import JSONField
+import hashlib
+import re
+from datetime import datetime as DateTime
+from datetime import timedelta as TimeDelta
+
+from django.db import models, connections, transaction
+from django.db.models.expressions import RawSQL, Func, F, Value
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.search import SearchVectorField
+from django.utils import timezone
 
 
 class Separator(Func):
@@ -36,6 +43,108 @@ class ExtraQuerySet(models.QuerySet):
         }
         return self.filter(**params)
 
+    def bulk_update(self, objs, fields, batch_size=500):
+        """Updates the fields of the objects by one UPDATE ... FROM (VALUES ...) per batch.
+        The filters of the queryset are not applied."""
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        pk = self.model._meta.pk
+        fields = [pk] + [self.model._meta.get_field(name) for name in fields]
+        sql_template = 'UPDATE {0} AS t SET {1} FROM (VALUES {{0}}) AS v ({2}) WHERE t.{3} = v.{3}'.format(
+            qn(self.model._meta.db_table),
+            ', '.join('{0} = v.{0}'.format(qn(f.column)) for f in fields[1:]),
+            ', '.join(qn(f.column) for f in fields),
+            qn(pk.column)
+        )
+        row_placeholder = '({0})'.format(', '.join('%s::{0}'.format(f.db_type(connection)) for f in fields))
+
+        num = 0
+        with connection.cursor() as cursor:
+            for i in range(0, len(objs), batch_size):
+                batch = objs[i:i + batch_size]
+                cursor.execute(
+                    sql_template.format(', '.join([row_placeholder] * len(batch))),
+                    [f.get_db_prep_save(getattr(obj, f.attname), connection) for obj in batch for f in fields]
+                )
+                num += cursor.rowcount
+        return num
+
+
+class CommunityQuerySet(ExtraQuerySet):
+
+    def update_analytics(self, now, sample_tolerance, chunk_size=10000):
+        """Calculates growth_per_day, growth_per_week and posts_per_week of all the communities
+        by one UPDATE per chunk of ids. The growth is measured against the sample (raw or archived)
+        nearest to 1 day (1 week) before the last check within the tolerance, and it is scaled
+        to the period by the time between the samples. Returns the number of the changed rows."""
+        sample_sql = (
+            '''LEFT JOIN LATERAL ('''
+            '''SELECT "sampled_at", "followers" FROM ('''
+            '''SELECT "checked_at" AS "sampled_at", "followers" FROM "communities_communityhistory" '''
+            '''WHERE "community_id" = "c"."vkid" '''
+            '''AND "checked_at" BETWEEN "c"."checked_at" - %s AND "c"."checked_at" - %s '''
+            '''UNION ALL '''
+            '''SELECT {1}, "sample"."followers" FROM "communities_communityhistoryarchive", '''
+            '''unnest("offsets", "followers") AS "sample"("offset", "followers") '''
+            '''WHERE "community_id" = "c"."vkid" '''
+            '''AND "month" >= date_trunc('month', ("c"."checked_at" - %s) AT TIME ZONE 'UTC') '''
+            '''AND "month" <= (("c"."checked_at" - %s) AT TIME ZONE 'UTC')::date'''
+            ''') AS "samples" WHERE "sampled_at" BETWEEN "c"."checked_at" - %s AND "c"."checked_at" - %s '''
+            '''ORDER BY abs(EXTRACT(EPOCH FROM "sampled_at" - ("c"."checked_at" - %s))) LIMIT 1'''
+            ''') AS "{0}" ON TRUE '''
+        )
+        growth_sql = (
+            '''round(("c"."followers" - "{0}"."followers") * %s / '''
+            '''EXTRACT(EPOCH FROM "c"."checked_at" - "{0}"."sampled_at"))::integer'''
+        )
+        sql = (
+            '''UPDATE "communities_community" AS "t" SET '''
+            '''"growth_per_day" = "s"."growth_per_day", '''
+            '''"growth_per_week" = "s"."growth_per_week", '''
+            '''"posts_per_week" = "s"."posts_per_week" '''
+            '''FROM ('''
+            '''SELECT "c"."vkid", '''
+            + growth_sql.format('d') + ''' AS "growth_per_day", '''
+            + growth_sql.format('w') + ''' AS "growth_per_week", '''
+            '''CASE WHEN "c"."wall_checked_at" IS NOT NULL THEN LEAST("p"."num", 32767) END AS "posts_per_week" '''
+            '''FROM "communities_community" AS "c" '''
+            + sample_sql.format('d', CommunityHistoryArchiveQuerySet.SAMPLE_TIME_EXPRESSION)
+            + sample_sql.format('w', CommunityHistoryArchiveQuerySet.SAMPLE_TIME_EXPRESSION) +
+            '''LEFT JOIN LATERAL ('''
+            '''SELECT count(*) AS "num" FROM "communities_post" AS "p" '''
+            '''WHERE "p"."community_id" = "c"."vkid" AND "p"."published_at" > %s AND "p"."published_at" <= %s'''
+            ''') AS "p" ON TRUE '''
+            '''WHERE "c"."vkid" > %s AND "c"."vkid" <= %s'''
+            ''') AS "s" '''
+            '''WHERE "t"."vkid" = "s"."vkid" AND '''
+            '''("t"."growth_per_day", "t"."growth_per_week", "t"."posts_per_week") IS DISTINCT FROM '''
+            '''("s"."growth_per_day", "s"."growth_per_week", "s"."posts_per_week");'''
+        )
+        periods = (TimeDelta(days=1), TimeDelta(weeks=1))
+        params = [period.total_seconds() for period in periods]
+        for period in periods:
+            # the samples of the last half of the period are too close to the last check
+            earliest, latest = period + sample_tolerance, max(period - sample_tolerance, period / 2)
+            params.extend([earliest, latest, earliest, latest, earliest, latest, period])
+        params.extend([now - TimeDelta(weeks=1), now])
+
+        num = 0
+        last_id = -1
+        with connections[self.db].cursor() as cursor:
+            while True:
+                cursor.execute(
+                    '''SELECT max("vkid") FROM ('''
+                    '''SELECT "vkid" FROM "communities_community" WHERE "vkid" > %s ORDER BY "vkid" LIMIT %s'''
+                    ''') AS "chunk";''',
+                    [last_id, chunk_size]
+                )
+                chunk_end, = cursor.fetchone()
+                if chunk_end is None:
+                    return num
+                cursor.execute(sql, params + [last_id, chunk_end])
+                num += cursor.rowcount
+                last_id = chunk_end
+
 
 class AvailableCommunityManager(models.Manager.from_queryset(ExtraQuerySet)):
 
@@ -79,16 +188,40 @@ class Community(models.Model):
     icon50url = models.TextField(blank=True)
     icon100url = models.TextField(blank=True)
     checked_at = models.DateTimeField(blank=True, null=True)
+    next_check_at = models.DateTimeField(blank=True, null=True)  # depends on the volatility of the community
     wall_checked_at = models.DateTimeField(blank=True, null=True)
     posts_per_week = models.PositiveSmallIntegerField(blank=True, null=True)
     views_per_post = models.FloatField(blank=True, null=True)
     likes_per_view = models.FloatField(blank=True, null=True)
     growth_per_day = models.IntegerField(blank=True, null=True)
     growth_per_week = models.IntegerField(blank=True, null=True)
+    content_hash = models.BigIntegerField(blank=True, null=True)  # see calculate_content_hash()
+    last_post_vkid = models.PositiveIntegerField(blank=True, null=True)  # the newest post seen on the wall
+    last_post_published_at = models.DateTimeField(blank=True, null=True)
+    wall_update_period = models.PositiveIntegerField(blank=True, null=True)  # seconds, desired by the activity
 
-    objects = models.Manager()
+    objects = CommunityQuerySet.as_manager()
     available = AvailableCommunityManager()
 
+    CONTENT_FIELDS = ('name', 'description', 'status', 'icon50url', 'icon100url')
+
+    def calculate_content_hash(self):
+        """The fingerprint of the text fields, it allows to detect their changes without loading them"""
+        content = '\0'.join(getattr(self, f) for f in self.CONTENT_FIELDS)
+        digest = hashlib.md5(content.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big', signed=True)
+
+    def followers_history(self):
+        """The archived and the recent samples as [{'x': checked_at, 'y': followers}, ...]"""
+        history = CommunityHistoryArchive.objects.series(self.vkid)
+        history.extend(self.communityhistory_set.order_by(
+            'checked_at'
+        ).values(
+            x=F('checked_at'),
+            y=F('followers'),
+        ))
+        return history
+
     def vk_url(self):
         if self.ctype == self.TYPE_PUBLIC_PAGE:
             prefix = 'public'
@@ -98,12 +231,176 @@ class Community(models.Model):
 
 
 class CommunityHistory(models.Model):
+    """The recent samples, the older ones are moved to CommunityHistoryArchive"""
     id = models.BigAutoField(primary_key=True)
     community = models.ForeignKey('Community', on_delete=models.CASCADE)
     checked_at = models.DateTimeField()
     followers = models.PositiveIntegerField()
 
 
+class CommunityHistoryArchiveQuerySet(models.QuerySet):
+
+    # The time of a sample: the month is the UTC date of the first day and the offset is in seconds.
+    SAMPLE_TIME_EXPRESSION = '''(("month"::timestamp AT TIME ZONE 'UTC') + "sample"."offset" * INTERVAL '1 second')'''
+
+    def series(self, community_id):
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                '''SELECT {0}, "sample"."followers" '''
+                '''FROM "communities_communityhistoryarchive", '''
+                '''unnest("offsets", "followers") AS "sample"("offset", "followers") '''
+                '''WHERE "community_id" = %s ORDER BY 1;'''.format(self.SAMPLE_TIME_EXPRESSION),
+                [community_id]
+            )
+            return [{'x': x, 'y': y} for x, y in cursor.fetchall()]
+
+    def samples(self, community_id=None, since=None, until=None, chunk_size=2000):
+        """Yields the samples as (community_id, checked_at, followers) ordered by the community and the time,
+        they are read by a server-side cursor"""
+        conditions = ['TRUE']
+        params = []
+        if community_id is not None:
+            conditions.append('"community_id" = %s')
+            params.append(community_id)
+        if since is not None:
+            conditions.append('''"month" >= date_trunc('month', %s AT TIME ZONE 'UTC')''')
+            params.append(since)
+        if until is not None:
+            conditions.append('''"month" <= (%s AT TIME ZONE 'UTC')::date''')
+            params.append(until)
+        sample_conditions = ['TRUE']
+        for value, condition in ((since, '"checked_at" >= %s'), (until, '"checked_at" <= %s')):
+            if value is not None:
+                sample_conditions.append(condition)
+                params.append(value)
+        with connections[self.db].chunked_cursor() as cursor:
+            cursor.execute(
+                '''SELECT "community_id", "checked_at", "followers" FROM ('''
+                '''SELECT "community_id", {0} AS "checked_at", "sample"."followers" '''
+                '''FROM "communities_communityhistoryarchive", '''
+                '''unnest("offsets", "followers") AS "sample"("offset", "followers") '''
+                '''WHERE {1}'''
+                ''') AS "s" WHERE {2} ORDER BY "community_id", "checked_at";'''.format(
+                    self.SAMPLE_TIME_EXPRESSION,
+                    ' AND '.join(conditions),
+                    ' AND '.join(sample_conditions)
+                ),
+                params
+            )
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+
+    def compact(self, until):
+        """Moves the samples checked before the day of the time from CommunityHistory.
+        Only the first sample of a day (in UTC) is kept, so the communities checked at any time of a day
+        keep their history. The whole days are moved, so one run cannot leave a second sample of a day."""
+        until = until.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute(
+                '''INSERT INTO "communities_communityhistoryarchive" '''
+                '''("community_id", "month", "offsets", "followers") '''
+                '''SELECT "community_id", "month", '''
+                '''array_agg(EXTRACT(EPOCH FROM "utc_checked_at" - "month")::integer ORDER BY "utc_checked_at"), '''
+                '''array_agg("followers" ORDER BY "utc_checked_at") '''
+                '''FROM ('''
+                '''SELECT DISTINCT ON ("community_id", "day") "community_id", "followers", "utc_checked_at", "month" '''
+                '''FROM ('''
+                '''SELECT "community_id", "followers", "checked_at" AT TIME ZONE 'UTC' AS "utc_checked_at", '''
+                '''date_trunc('day', "checked_at" AT TIME ZONE 'UTC') AS "day", '''
+                '''date_trunc('month', "checked_at" AT TIME ZONE 'UTC') AS "month" '''
+                '''FROM "communities_communityhistory" WHERE "checked_at" < %s'''
+                ''') AS "r" ORDER BY "community_id", "day", "utc_checked_at"'''
+                ''') AS "h" '''
+                '''GROUP BY "community_id", "month" '''
+                '''ON CONFLICT ("community_id", "month") DO UPDATE SET '''
+                '''"offsets" = "communities_communityhistoryarchive"."offsets" || EXCLUDED."offsets", '''
+                '''"followers" = "communities_communityhistoryarchive"."followers" || EXCLUDED."followers";''',
+                [until]
+            )
+            cursor.execute('''DELETE FROM "communities_communityhistory" WHERE "checked_at" < %s;''', [until])
+            return cursor.rowcount
+
+    def thin_out(self, now, rules, window):
+        """Drops the samples by the rules [(max_age, keep_sql), ...] ordered by max_age.
+        A rule is applied to the samples older than its max_age (and younger than the max_age of the next rule),
+        keep_sql selects the samples to keep by their UTC time "t". Since the rules become stricter with age,
+        a sample is affected only when it crosses a max_age, so only the months around
+        (now - max_age - window, now - max_age) are scanned. Returns the number of the dropped samples."""
+        keep_sql = []
+        params = []
+        for i, (max_age, rule_sql) in enumerate(rules):
+            range_sql = '''"t" < (%s AT TIME ZONE 'UTC')'''
+            params.append(now - max_age)
+            if i + 1 < len(rules):
+                range_sql += ''' AND "t" >= (%s AT TIME ZONE 'UTC')'''
+                params.append(now - rules[i + 1][0])
+            keep_sql.append('(NOT ({0}) OR ({1}))'.format(range_sql, rule_sql))
+        months_sql = []
+        for max_age, _ in rules:
+            months_sql.append('''("month" >= date_trunc('month', %s AT TIME ZONE 'UTC') AND "month" <= %s)''')
+            params.extend([now - max_age - window, (now - max_age).date()])
+
+        with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+            cursor.execute(
+                '''UPDATE "communities_communityhistoryarchive" AS "a" '''
+                '''SET "offsets" = "f"."offsets", "followers" = "f"."followers" FROM ('''
+                '''SELECT "id", '''
+                '''COALESCE(array_agg("offset" ORDER BY "offset") FILTER (WHERE "keep"), '{{}}') AS "offsets", '''
+                '''COALESCE(array_agg("followers" ORDER BY "offset") FILTER (WHERE "keep"), '{{}}') AS "followers", '''
+                '''count(*) - count(*) FILTER (WHERE "keep") AS "dropped" '''
+                '''FROM ('''
+                '''SELECT "id", "offset", "followers", {0} AS "keep" FROM ('''
+                '''SELECT "id", "sample"."offset", "sample"."followers", {1} AT TIME ZONE 'UTC' AS "t" '''
+                '''FROM "communities_communityhistoryarchive", '''
+                '''unnest("offsets", "followers") AS "sample"("offset", "followers") '''
+                '''WHERE {2}'''
+                ''') AS "s"'''
+                ''') AS "k" GROUP BY "id"'''
+                ''') AS "f" WHERE "a"."id" = "f"."id" AND "f"."dropped" > 0 '''
+                '''RETURNING "a"."id", "f"."dropped", cardinality("f"."offsets");'''.format(
+                    ' AND '.join(keep_sql),
+                    self.SAMPLE_TIME_EXPRESSION,
+                    ' OR '.join(months_sql)
+                ),
+                params
+            )
+            rows = cursor.fetchall()
+            empty_ids = [id_ for id_, _, length in rows if length == 0]
+            if empty_ids:
+                cursor.execute(
+                    '''DELETE FROM "communities_communityhistoryarchive" WHERE "id" = ANY(%s);''',
+                    [empty_ids]
+                )
+            return sum(dropped for _, dropped, _ in rows)
+
+    def delete_older_than(self, dt):
+        """Deletes the months ended before the time"""
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                '''DELETE FROM "communities_communityhistoryarchive" '''
+                '''WHERE "month" < date_trunc('month', %s AT TIME ZONE 'UTC');''',
+                [dt]
+            )
+            return cursor.rowcount
+
+
+class CommunityHistoryArchive(models.Model):
+    """The samples of a community for a month packed into arrays"""
+    id = models.BigAutoField(primary_key=True)
+    community = models.ForeignKey('Community', on_delete=models.CASCADE, db_index=False)
+    month = models.DateField()  # the first day
+    offsets = ArrayField(models.IntegerField())  # seconds since the beginning of the month
+    followers = ArrayField(models.IntegerField())
+
+    objects = CommunityHistoryArchiveQuerySet.as_manager()
+
+    class Meta:
+        unique_together = ('community', 'month')
+
+
 class PostQuerySet(ExtraQuerySet):
     
     # This expression has an index.
@@ -119,24 +416,175 @@ class PostQuerySet(ExtraQuerySet):
             post_likes_per_view=RawSQL(self.POST_LIKES_PER_VIEW_EXPRESSION, (), output_field=models.FloatField())
         )
 
+    CONTENT_SUMMARY_TEXT_LENGTH = 500
+
+    def with_content_summary(self):
+        """Defers the content and annotates the posts with content_summary instead of it.
+        It is [{'text': the beginning of the text, 'truncated': bool, 'attachments': the number of them}, ...]
+        in the order of the content items, so the list of posts does not transfer the attachments."""
+        return self.defer('content', 'content_tsv').annotate(content_summary=RawSQL(
+            '''(SELECT COALESCE(jsonb_agg(jsonb_build_object('''
+            ''''text', left(COALESCE("item"->>'text', ''), %s), '''
+            ''''truncated', length(COALESCE("item"->>'text', '')) > %s, '''
+            ''''attachments', jsonb_array_length(COALESCE("item"->'attachments', '[]'::jsonb)))'''
+            ''' ORDER BY "i"), '[]'::jsonb) '''
+            '''FROM jsonb_array_elements("communities_post"."content") WITH ORDINALITY AS "e"("item", "i"))''',
+            (self.CONTENT_SUMMARY_TEXT_LENGTH, self.CONTENT_SUMMARY_TEXT_LENGTH),
+            output_field=JSONField()
+        ))
+
+    # The indexes on (the key, "id") serve the sorting and the row comparison of seek(), see the migration 0029.
+    # The expressions must match the ones of the indexes.
+    SEEK_EXPRESSIONS = {
+        'published_at': '"communities_post"."published_at"',
+        'views': '"communities_post"."views"',
+        'post_likes_per_view': POST_LIKES_PER_VIEW_EXPRESSION,
+    }
+
+    def seek(self, field_name, inverse=False, after=None):
+        """Sorts the posts by the field (one of SEEK_EXPRESSIONS) and then by id.
+        after is (value, id) of the last post of the previous page, the next posts are found by an index range scan,
+        so any page costs the same as the first one."""
+        qs = self
+        if after is not None:
+            qs = qs.extra(
+                where=['({0}, "communities_post"."id") {1} (%s, %s)'.format(
+                    self.SEEK_EXPRESSIONS[field_name],
+                    '<' if inverse else '>'
+                )],
+                params=list(after)
+            )
+        prefix = '-' if inverse else ''
+        return qs.order_by(prefix + field_name, prefix + 'id')
+
     def search(self, query):
+        """Filters the posts by the query using the index on content_tsv and annotates them with search_rank.
+        A query without meaningful words (e.g. only stop words) matches all the posts."""
+        no_rank = self.annotate(search_rank=Value(0.0, output_field=models.FloatField()))
         if not query:
-            return self
+            return no_rank
+
+        # the size is checked by a separate query, otherwise "numnode(...) = 0 OR ..." would prevent the index scan
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('''SELECT numnode(plainto_tsquery('russian', %s));''', [query])
+            query_size, = cursor.fetchone()
+        if query_size == 0:
+            return no_rank
 
         tsquery = Func(Value('russian'), Value(query), function='plainto_tsquery')
         return self.annotate(
-            query_size_annotation=Func(
-                tsquery,
-                function='numnode',
-                output_field=models.IntegerField()
-            ),
             found_annotation=Separator(
                 '@@',
-                Func(Value('russian'), F('content'), function='post_content_to_tsvector'),
+                F('content_tsv'),
                 tsquery,
                 output_field=models.BooleanField()
+            ),
+            search_rank=Func(
+                F('content_tsv'),
+                tsquery,
+                function='ts_rank_cd',
+                output_field=models.FloatField()
+            )
+        ).filter(found_annotation=True)
+
+    UPSERT_BATCH_SIZE = 500
+
+    def upsert(self, posts):
+        """Inserts new posts and updates existing ones by one INSERT ... ON CONFLICT per batch"""
+        id2post = {}
+        for p in posts:
+            p.id = self.model.build_id(p.community_id, p.vkid)
+            id2post[p.id] = p  # a row cannot be affected twice by one statement
+        posts = [id2post[id_] for id_ in sorted(id2post)]  # the same order of locks in all transactions
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        # content_tsv is left to the triggers, which do not recompute it for the unchanged content
+        fields = [f for f in self.model._meta.concrete_fields if f.name != 'content_tsv']
+        sql_template = 'INSERT INTO {0} ({1}) VALUES {{0}} ON CONFLICT ({2}) DO UPDATE SET {3}'.format(
+            qn(self.model._meta.db_table),
+            ', '.join(qn(f.column) for f in fields),
+            ', '.join(qn(column) for column in self.model.PRIMARY_KEY_COLUMNS),
+            ', '.join(
+                '{0} = EXCLUDED.{0}'.format(qn(f.column))
+                for f in fields if f.column not in self.model.PRIMARY_KEY_COLUMNS
             )
-        ).filter(Q(query_size_annotation=0) | Q(found_annotation=True))
+        )
+        row_placeholder = '({0})'.format(', '.join(['%s'] * len(fields)))
+
+        with connection.cursor() as cursor:
+            for i in range(0, len(posts), self.UPSERT_BATCH_SIZE):
+                batch = posts[i:i + self.UPSERT_BATCH_SIZE]
+                cursor.execute(
+                    sql_template.format(', '.join([row_placeholder] * len(batch))),
+                    [f.get_db_prep_save(getattr(p, f.attname), connection) for p in batch for f in fields]
+                )
+        return len(posts)
+
+    # The table is partitioned by weeks of "published_at", see the migration 0022.
+    # The rows out of the range of the weekly partitions are stored in the default one.
+    PARTITION_PERIOD = TimeDelta(weeks=1)
+    PARTITION_NAME_RE = re.compile(r'^communities_post_p(\d{8})$')
+    # PostgreSQL 11 has no BEFORE ROW triggers on partitioned tables, so every partition has its own one,
+    # the AFTER INSERT trigger of the partitioned table is cloned to the new partitions by PostgreSQL
+    CONTENT_TSV_TRIGGER_SQL = (
+        '''CREATE TRIGGER "communities_post_content_tsv" BEFORE UPDATE ON "{0}" '''
+        '''FOR EACH ROW EXECUTE PROCEDURE "communities_post_content_tsv_trigger"();'''
+    )
+
+    def partitions(self):
+        """Returns the sorted list of the first days (in UTC) of the weekly partitions"""
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                '''SELECT "c"."relname" FROM "pg_inherits" '''
+                '''JOIN "pg_class" AS "c" ON "c"."oid" = "pg_inherits"."inhrelid" '''
+                '''WHERE "pg_inherits"."inhparent" = '"communities_post"'::regclass;'''
+            )
+            names = [name for name, in cursor.fetchall()]
+        return sorted(
+            DateTime.strptime(m.group(1), '%Y%m%d').date()
+            for m in map(self.PARTITION_NAME_RE.match, names) if m
+        )
+
+    def create_partitions(self, now, until):
+        """Creates the missing partitions from the week of now till the week of until inclusive.
+        Returns the number of the created partitions."""
+        existing = set(self.partitions())
+        week = now.date() - TimeDelta(days=now.weekday())
+        created = 0
+        with connections[self.db].cursor() as cursor:
+            while week <= until.date():
+                if week not in existing:
+                    cursor.execute(
+                        '''CREATE TABLE "communities_post_p{0:%Y%m%d}" PARTITION OF "communities_post" '''
+                        '''FOR VALUES FROM ('{0:%Y-%m-%d} 00:00:00+00') TO ('{1:%Y-%m-%d} 00:00:00+00');'''.format(
+                            week, week + self.PARTITION_PERIOD
+                        )
+                    )
+                    cursor.execute(self.CONTENT_TSV_TRIGGER_SQL.format('communities_post_p{0:%Y%m%d}'.format(week)))
+                    created += 1
+                week += self.PARTITION_PERIOD
+        return created
+
+    def drop_partitions(self, before, lock_timeout='5s'):
+        """Detaches and drops the partitions ended before the time, returns the number of them.
+        Detaching locks the whole table, so it gives up after the lock timeout instead of holding
+        the writers behind a long reader. The old rows of the default partition are left to ChunkedDeleter.
+        The deferred checks of the foreign keys are run before, so the rows written by the same transaction
+        do not block dropping."""
+        dropped = 0
+        for week in self.partitions():
+            if week + self.PARTITION_PERIOD > before.date():
+                break
+            with transaction.atomic(using=self.db), connections[self.db].cursor() as cursor:
+                cursor.execute('''SET LOCAL lock_timeout = %s;''', [lock_timeout])
+                cursor.execute('''SET CONSTRAINTS ALL IMMEDIATE;''')
+                cursor.execute(
+                    '''ALTER TABLE "communities_post" DETACH PARTITION "communities_post_p{0:%Y%m%d}";'''.format(week)
+                )
+                cursor.execute('''DROP TABLE "communities_post_p{0:%Y%m%d}";'''.format(week))
+            dropped += 1
+        return dropped
 
 
 class Post(models.Model):
@@ -152,16 +600,27 @@ class Post(models.Model):
     comments = models.PositiveIntegerField()
     marked_as_ads = models.BooleanField()
     links = models.PositiveSmallIntegerField()
+    content_tsv = SearchVectorField(blank=True, null=True, editable=False)  # maintained by triggers, see 0028
 
     objects = PostQuerySet.as_manager()
 
+    PRIMARY_KEY_COLUMNS = ('id', 'published_at')  # the real one, the partition key is a part of it
+
+    @staticmethod
+    def build_id(community_id, vkid):
+        return community_id * 2147483648 + vkid
+
     def save(self, *args, **kwargs):
-        self.id = self.community_id * 2147483648 + self.vkid
+        self.id = self.build_id(self.community_id, self.vkid)
         super().save(*args, **kwargs)
 
     def vk_url(self):
         return r'https://vk.com/wall-{0:d}_{1:d}'.format(self.community_id, self.vkid)
 
+    def content_is_summarized(self):
+        """For the posts annotated by PostQuerySet.with_content_summary()"""
+        return any(item['truncated'] or item['attachments'] for item in self.content_summary)
+
 
 # for old migrations
 class PostManager(models.Manager.from_queryset(PostQuerySet)):
@@ -21,6 +21,8 @@
         res['followers'] = document.getElementById('followers-range-widget').getElementsByClassName('filter__sorting-icon')[0];
         res['views_per_post'] = document.getElementById('views-range-widget').getElementsByClassName('filter__sorting-icon')[0];
         res['likes_per_view'] = document.getElementById('likes-range-widget').getElementsByClassName('filter__sorting-icon')[0];
+        res['growth_per_day'] = document.getElementById('growth-per-day-widget').getElementsByClassName('filter__sorting-icon')[0];
+        res['growth_per_week'] = document.getElementById('growth-per-week-widget').getElementsByClassName('filter__sorting-icon')[0];
         return res;
     }
 
@@ -4,6 +4,7 @@
     var field_name2sorting_icon = find_sorting_icons();
     sync_sorting_icons();
     init_events();
+    init_full_content_links();
 
 
     function find_options() {
@@ -83,6 +84,27 @@
         }
     }
 
+    function init_full_content_links() {
+        var links = document.getElementsByClassName('post__full-content-link');
+        for (var i=0; i<links.length; ++i) {
+            links[i].onclick = function(event) {
+                event.preventDefault();
+                load_full_content(this);
+            };
+        }
+    }
+
+    function load_full_content(link) {
+        var request = new XMLHttpRequest();
+        request.open('GET', link.href);
+        request.onload = function() {
+            if (request.status == 200) {
+                link.parentNode.innerHTML = request.responseText;
+            }
+        };
+        request.send();
+    }
+
     function sync_sorting_icons() {
         var current_field_name = document.forms['filter'].elements["sort_by"].selectedOptions[0].value;
         for (var field_name in field_name2sorting_icon) {
@@ -0,0 +1,29 @@
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from ..listcache import get_ids, bump_generation, ObjectsByIds
+from ..models import Community
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ListCacheTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for vkid in (1, 2, 3):
+            Community.objects.create(vkid=vkid, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=vkid)
+
+    def test_ids_are_cached_until_generation_is_bumped(self):
+        qs = Community.objects.order_by('-followers')
+        self.assertEqual(get_ids(qs, {'sort_by': 'followers', 'inverse': True}, 2), [3, 2])
+        Community.objects.create(vkid=4, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=4)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_ids(qs, {'inverse': True, 'sort_by': 'followers'}, 2), [3, 2])
+        bump_generation(Community)
+        self.assertEqual(get_ids(qs, {'sort_by': 'followers', 'inverse': True}, 2), [4, 3])
+
+    def test_objects_by_ids(self):
+        objects = ObjectsByIds(Community.objects.all(), [3, 1, 42, 2])
+        self.assertEqual(len(objects), 4)
+        self.assertEqual([c.vkid for c in objects[:3]], [3, 1])
+        self.assertEqual(objects[3].vkid, 2)
@@ -1,7 +1,12 @@
-from django.test import TestCase
+from datetime import date as Date
+from datetime import datetime as DateTime
+from datetime import timedelta as TimeDelta
+
+from django.db import DatabaseError, connection, transaction
+from django.test import TestCase, TransactionTestCase
 from django.utils import timezone
 
-from ..models import Community, Post
+from ..models import Community, CommunityHistory, CommunityHistoryArchive, Post
 
 
 class ExtraQuerySetTest(TestCase):
@@ -47,6 +52,48 @@ class CommunityTest(TestCase):
         private_group = Community(vkid=1, deactivated=False, ctype=Community.TYPE_PRIVATE_GROUP)
         self.assertEqual(private_group.vk_url(), 'https://vk.com/club1')
 
+    def test_content_hash(self):
+        comm = Community(vkid=1, name='name', description='description')
+        content_hash = comm.calculate_content_hash()
+        self.assertEqual(Community(vkid=2, name='name', description='description').calculate_content_hash(),
+                         content_hash)
+        comm.status = 'status'
+        self.assertNotEqual(comm.calculate_content_hash(), content_hash)
+        self.assertNotEqual(Community(vkid=1, name='namedescription').calculate_content_hash(), content_hash)
+
+    def test_update_analytics(self):
+        now = timezone.now()
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        comm = Community.objects.create(vkid=1, followers=100, checked_at=now, wall_checked_at=now, **other_attrs)
+        Community.objects.create(vkid=2, followers=100, **other_attrs)
+        slow_comm = Community.objects.create(vkid=3, followers=1000, checked_at=now, **other_attrs)
+        CommunityHistory.objects.create(community=comm, checked_at=now - TimeDelta(hours=23), followers=90)
+        self._archive(comm, [(now - TimeDelta(days=8), 10), (now - TimeDelta(days=7, hours=1), 50)])
+        for age, followers in ((TimeDelta(days=2, hours=23), 994), (TimeDelta(days=6), 988)):
+            CommunityHistory.objects.create(community=slow_comm, checked_at=now - age, followers=followers)
+        self._archive(slow_comm, [(now - TimeDelta(days=9), 982)])
+        for vkid, age in ((1, TimeDelta(days=1)), (2, TimeDelta(days=6)), (3, TimeDelta(days=8))):
+            Post.objects.create(community=comm, vkid=vkid, published_at=now - age, checked_at=now, content=[],
+                                likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+
+        num = Community.objects.update_analytics(now, TimeDelta(days=2), chunk_size=1)
+        self.assertEqual(num, 2)
+        self.assertQuerysetEqual(Community.objects.order_by('vkid'), [(10, 50, 2), (None, None, None), (2, 14, None)],
+                                 lambda c: (c.growth_per_day, c.growth_per_week, c.posts_per_week))
+        self.assertEqual(Community.objects.update_analytics(now, TimeDelta(days=2)), 0)
+
+    @staticmethod
+    def _archive(comm, samples):
+        for checked_at, followers in samples:
+            utc_checked_at = checked_at.astimezone(timezone.utc)
+            month = DateTime(utc_checked_at.year, utc_checked_at.month, 1, tzinfo=timezone.utc)
+            archive, _ = CommunityHistoryArchive.objects.get_or_create(
+                community=comm, month=month.date(), defaults=dict(offsets=[], followers=[])
+            )
+            archive.offsets.append(int((utc_checked_at - month).total_seconds()))
+            archive.followers.append(followers)
+            archive.save()
+
     def test_only_private_and_deactivated_groups_are_not_available(self):
         Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
         Community.objects.create(vkid=2, deactivated=False, ctype=Community.TYPE_OPEN_GROUP)
@@ -61,6 +108,57 @@ class CommunityTest(TestCase):
         self.assertEqual(available_community_ids, [1, 2, 3])
 
 
+class CommunityHistoryArchiveTest(TestCase):
+
+    def setUp(self):
+        self.comm = Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+
+    def test_compact(self):
+        dt = DateTime(2018, 5, 30, 6, tzinfo=timezone.utc)
+        for i, hours in enumerate((0, 12, 38, 48, 72)):  # the sample of 31 May is checked only after noon
+            CommunityHistory.objects.create(community=self.comm, checked_at=dt + TimeDelta(hours=hours), followers=i)
+
+        num = CommunityHistoryArchive.objects.compact(dt + TimeDelta(hours=36))  # till the start of 31 May
+        self.assertEqual(num, 2)
+        num = CommunityHistoryArchive.objects.compact(dt + TimeDelta(hours=60))
+        self.assertEqual(num, 1)
+        num = CommunityHistoryArchive.objects.compact(dt + TimeDelta(hours=80))
+        self.assertEqual(num, 1)
+
+        self.assertEqual(CommunityHistory.objects.count(), 1)
+        self.assertEqual(
+            [(p['x'], p['y']) for p in self.comm.followers_history()],
+            [(dt, 0), (dt + TimeDelta(hours=38), 2), (dt + TimeDelta(hours=48), 3), (dt + TimeDelta(hours=72), 4)]
+        )
+        self.assertQuerysetEqual(
+            CommunityHistoryArchive.objects.order_by('month'),
+            [(Date(2018, 5, 1), [0, 2]), (Date(2018, 6, 1), [3])],
+            lambda a: (a.month, a.followers)
+        )
+
+    def test_thin_out(self):
+        now = DateTime(2018, 7, 1, tzinfo=timezone.utc)
+        CommunityHistoryArchive.objects.create(community=self.comm, month=Date(2018, 5, 1),
+                                               offsets=[day * 86400 for day in range(31)], followers=list(range(31)))
+        CommunityHistoryArchive.objects.create(community=self.comm, month=Date(2018, 6, 1),
+                                               offsets=[0], followers=[100])
+        dropped = CommunityHistoryArchive.objects.thin_out(
+            now, [(TimeDelta(days=30), '''EXTRACT(DAY FROM "t") = 1''')], TimeDelta(days=14))
+        self.assertEqual(dropped, 30)
+        self.assertEqual([p['y'] for p in self.comm.followers_history()], [0, 100])
+
+        dropped = CommunityHistoryArchive.objects.thin_out(now, [(TimeDelta(days=30), 'FALSE')], TimeDelta(days=14))
+        self.assertEqual(dropped, 1)
+        self.assertEqual(CommunityHistoryArchive.objects.count(), 1)
+
+    def test_delete_older_than(self):
+        for month in (4, 5, 6):
+            CommunityHistoryArchive.objects.create(community=self.comm, month=Date(2018, month, 1),
+                                                   offsets=[0], followers=[month])
+        num = CommunityHistoryArchive.objects.delete_older_than(DateTime(2018, 6, 15, tzinfo=timezone.utc))
+        self.assertEqual(num, 2)
+
+
 class PostTest(TestCase):
 
     def test_with_likes_per_view(self):
@@ -74,6 +172,130 @@ class PostTest(TestCase):
         self.assertQuerysetEqual(Post.objects.with_likes_per_view().order_by('vkid'), [500, None, 0, None],
                                  lambda c: None if c.post_likes_per_view is None else int(c.post_likes_per_view * 1000))
 
+    def test_upsert(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      shares=0, comments=0, marked_as_ads=False, links=0)
+        Post.objects.create(vkid=1, content=[{'text': 'old'}], views=10, likes=1, **params)
+        num = Post.objects.upsert([
+            Post(vkid=1, content=[{'text': 'new'}], views=20, likes=2, **params),
+            Post(vkid=2, content=[], views=30, likes=3, **params),
+        ])
+        self.assertEqual(num, 2)
+        self.assertQuerysetEqual(Post.objects.order_by('vkid'), [
+            (Post.build_id(1, 1), [{'text': 'new'}], 20, 2),
+            (Post.build_id(1, 2), [], 30, 3),
+        ], lambda p: (p.id, p.content, p.views, p.likes))
+
+    def test_content_tsv_is_maintained(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      views=0, likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+        Post.objects.create(vkid=1, content=[{'text': 'Мороз и солнце'}], **params)
+        Post.objects.upsert([
+            Post(vkid=1, content=[{'text': 'Мороз и солнце'}], **params),
+            Post(vkid=2, content=[{'text': 'день чудесный'}], **params),
+        ])
+        self.assertEqual([p.vkid for p in Post.objects.search('мороз')], [1])
+        self.assertEqual([p.vkid for p in Post.objects.search('чудесный')], [2])
+        Post.objects.upsert([Post(vkid=1, content=[{'text': 'чудесный день'}], **params)])
+        self.assertFalse(Post.objects.search('мороз').exists())
+        self.assertEqual(sorted(p.vkid for p in Post.objects.search('день')), [1, 2])
+        self.assertEqual(Post.objects.search('и').count(), 2)  # only stop words
+
+    def test_content_tsv_is_not_recomputed_for_same_content(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      views=0, likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+        Post.objects.upsert([Post(vkid=1, content=[{'text': 'солнце'}], **params)])
+        with connection.cursor() as cursor:  # rolled back with the test
+            cursor.execute(
+                '''CREATE OR REPLACE FUNCTION "post_content_to_tsvector" (config regconfig, content jsonb) '''
+                '''RETURNS tsvector AS $$ BEGIN RAISE EXCEPTION 'recomputed'; END $$ LANGUAGE plpgsql IMMUTABLE;'''
+            )
+        Post.objects.upsert([Post(vkid=1, content=[{'text': 'солнце'}], **dict(params, views=10))])
+        with self.assertRaises(DatabaseError), transaction.atomic():
+            Post.objects.upsert([Post(vkid=1, content=[{'text': 'луна'}], **params)])
+        self.assertEqual([(p.views, p.content) for p in Post.objects.search('солнце')], [(10, [{'text': 'солнце'}])])
+
+    def test_content_summary(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+        Post.objects.create(vkid=1, content=[{'text': 'a' * 501, 'attachments': [{}, {}]}, {'text': 'b'}, {}], **params)
+        Post.objects.create(vkid=2, content=[], **params)
+        posts = list(Post.objects.with_content_summary().order_by('vkid'))
+        self.assertEqual(posts[0].content_summary, [
+            {'text': 'a' * 500, 'truncated': True, 'attachments': 2},
+            {'text': 'b', 'truncated': False, 'attachments': 0},
+            {'text': '', 'truncated': False, 'attachments': 0},
+        ])
+        self.assertTrue(posts[0].content_is_summarized())
+        self.assertEqual(posts[1].content_summary, [])
+        self.assertFalse(posts[1].content_is_summarized())
+        self.assertIn('content', posts[0].get_deferred_fields())
+
+    def test_seek(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(), content=[],
+                      shares=0, comments=0, marked_as_ads=False, links=0)
+        for vkid, views, likes in ((1, 10, 1), (2, 20, 1), (3, 10, 5), (4, 40, 4)):
+            Post.objects.create(vkid=vkid, views=views, likes=likes, **params)
+        qs = Post.objects.with_likes_per_view()
+        self.assertEqual([p.vkid for p in qs.seek('views')], [1, 3, 2, 4])
+        self.assertEqual([p.vkid for p in qs.seek('views', after=(10, Post.build_id(1, 1)))], [3, 2, 4])
+        self.assertEqual([p.vkid for p in qs.seek('views', True, after=(20, Post.build_id(1, 2)))], [3, 1])
+        self.assertEqual([p.vkid for p in qs.seek('post_likes_per_view', True, after=(0.1, Post.build_id(1, 4)))],
+                         [1, 2])
+
+    def test_partitions(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        published_at = DateTime(1990, 1, 1, tzinfo=timezone.utc)
+        Post.objects.create(vkid=1, community_id=1, published_at=published_at, checked_at=published_at,
+                            content=[], likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+
+        num = Post.objects.create_partitions(DateTime(2100, 1, 6, tzinfo=timezone.utc),
+                                             DateTime(2100, 1, 11, tzinfo=timezone.utc))
+        self.assertEqual(num, 2)
+        self.assertEqual(Post.objects.partitions()[-2:], [Date(2100, 1, 4), Date(2100, 1, 11)])
+        Post.objects.create(vkid=2, community_id=1, published_at=DateTime(2100, 1, 7, tzinfo=timezone.utc),
+                            checked_at=published_at, content=[{'text': 'солнце'}], likes=0, shares=0, comments=0,
+                            marked_as_ads=False, links=0)
+        self.assertEqual([p.vkid for p in Post.objects.search('солнце')], [2])
+        Post.objects.filter(vkid=2).delete()
+
+        self.assertEqual(Post.objects.drop_partitions(DateTime(2000, 1, 1, tzinfo=timezone.utc)), 0)
+        self.assertTrue(Post.objects.exists())  # in the default partition
+
     def test_vk_url(self):
         p = Post(community_id=11, vkid=22)
         self.assertEqual(p.vk_url(), 'https://vk.com/wall-11_22')
+
+
+class PostPartitionsTest(TransactionTestCase):
+
+    def test_drop_partitions(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        Post.objects.create_partitions(DateTime(1990, 1, 3, tzinfo=timezone.utc),
+                                       DateTime(1990, 1, 8, tzinfo=timezone.utc))
+        self.addCleanup(Post.objects.drop_partitions, DateTime(1990, 1, 15, tzinfo=timezone.utc))
+        self.assertEqual(Post.objects.partitions()[:2], [Date(1990, 1, 1), Date(1990, 1, 8)])
+        for vkid, day in ((1, 2), (2, 9)):
+            published_at = DateTime(1990, 1, day, tzinfo=timezone.utc)
+            Post.objects.create(vkid=vkid, community_id=1, published_at=published_at, checked_at=published_at,
+                                content=[], likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+
+        self.assertEqual(Post.objects.drop_partitions(DateTime(1990, 1, 10, tzinfo=timezone.utc)), 1)
+        self.assertEqual(Post.objects.partitions()[0], Date(1990, 1, 8))
+        self.assertEqual([p.vkid for p in Post.objects.all()], [2])
+
+    def test_rows_written_by_same_transaction_do_not_block_dropping(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        Post.objects.create_partitions(DateTime(1990, 1, 3, tzinfo=timezone.utc),
+                                       DateTime(1990, 1, 3, tzinfo=timezone.utc))
+        with transaction.atomic():
+            published_at = DateTime(1990, 1, 2, tzinfo=timezone.utc)
+            Post.objects.create(vkid=1, community_id=1, published_at=published_at, checked_at=published_at,
+                                content=[], likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+            self.assertEqual(Post.objects.drop_partitions(DateTime(1990, 1, 10, tzinfo=timezone.utc)), 1)
+        self.assertFalse(Post.objects.exists())
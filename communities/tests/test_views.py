@@ -1,12 +1,17 @@
+import json
 from urllib.parse import urlencode
+from datetime import date as Date
+from datetime import datetime as DateTime
 from datetime import timedelta as TimeDelta
+from unittest.mock import patch
 
 from django.test import TestCase
 from django.urls import reverse
 from django.utils import timezone
 
 from accounts.models import User
-from ..models import Community, CommunityHistory, Post
+from ..models import Community, CommunityHistory, CommunityHistoryArchive, Post
+from ..views import PostListView
 
 
 EMAIL = 'superuser42@example42.com'
@@ -39,6 +44,16 @@ class CommunityListViewTest(TestCase):
         self.assertContains(resp, 'comm2')
         self.assertContains(resp, 'comm3')
 
+    def test_sort_by_growth(self):
+        params = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=1)
+        for vkid, growth in ((1, 5), (2, -3), (3, 40)):
+            Community.objects.create(vkid=vkid, name='comm{}'.format(vkid), growth_per_week=growth, **params)
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp = self.client.get(reverse('communities:community_list') + '?sort_by=growth_per_week&inverse=on')
+        self.assertEqual([c.vkid for c in resp.context['page_obj']], [3, 1, 2])
+        self.assertContains(resp, '+40')
+        self.assertContains(resp, 'growth-per-week-widget')
+
     def test_pagination_is_50(self):
         for vkid in range(51):
             Community.objects.create(vkid=vkid, deactivated=False,
@@ -93,6 +108,22 @@ class CommunityDetailViewTest(TestCase):
         )
 
 
+    def test_view_shows_archived_followers_trend(self):
+        CommunityHistoryArchive.objects.create(community_id=1, month=Date(2018, 5, 1),
+                                               offsets=[0, 86400], followers=[1, 2])
+        CommunityHistory.objects.create(community_id=1, checked_at=DateTime(2018, 6, 1, tzinfo=timezone.utc),
+                                        followers=3)
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp = self.client.get(reverse('communities:community_detail', args=[1]))
+        self.assertEqual(
+            tuple((p['x'], p['y']) for p in resp.context['followers_history']),
+            (
+                (DateTime(2018, 5, 1, tzinfo=timezone.utc), 1),
+                (DateTime(2018, 5, 2, tzinfo=timezone.utc), 2),
+                (DateTime(2018, 6, 1, tzinfo=timezone.utc), 3),
+            )
+        )
+
 class PostListViewTest(TestCase):
 
     @classmethod
@@ -135,6 +166,28 @@ class PostListViewTest(TestCase):
         self.assertTrue('page_obj' in resp.context)
         self.assertEqual(len(resp.context['page_obj']), 1)
 
+    def test_pagination_by_cursor_after_limit(self):
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      content=[], likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+        for vkid in range(45):
+            Post.objects.create(vkid=vkid, views=vkid // 2, **params)
+        self.client.login(email=EMAIL, password=PASSWORD)
+        url = reverse('communities:post_list') + '?sort_by=views&inverse=on'
+
+        with patch.object(PostListView, 'limit', new=40):
+            resp = self.client.get(url)
+            self.assertIsNone(resp.context['next_cursor'])
+            resp = self.client.get(url + '&p=2')
+        cursor = resp.context['next_cursor']
+        self.assertEqual([p.vkid for p in resp.context['object_list']], list(range(24, 4, -1)))
+
+        resp = self.client.get(url + '&' + urlencode({'after': cursor}))
+        self.assertEqual([p.vkid for p in resp.context['object_list']], [4, 3, 2, 1, 0])
+        self.assertIsNone(resp.context['next_cursor'])
+
+        resp = self.client.get(url + '&after=invalid')
+        self.assertEqual(len(resp.context['object_list']), 20)
+
     def test_search(self):
         params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
                       views=0, likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
@@ -148,3 +201,102 @@ class PostListViewTest(TestCase):
         resp = self.client.get(reverse('communities:post_list') + '?sort_by=published_at&' +
                                urlencode({'search': 'чудесный'}))
         self.assertContains(resp, 'день чудесный', 2)
+
+    def test_search_by_relevance(self):
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      views=0, likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+        Post.objects.create(vkid=1, content=[{'text': 'солнце'}, {'text': 'день чудесный'}], **params)
+        Post.objects.create(vkid=2, content=[{'text': 'солнце, солнце, солнце'}], **params)
+
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp = self.client.get(reverse('communities:post_list') + '?sort_by=search_rank&inverse=on&' +
+                               urlencode({'search': 'солнце'}))
+        self.assertEqual([p.vkid for p in resp.context['page_obj']], [2, 1])
+
+    def test_full_content_is_loaded_on_demand(self):
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      likes=0, shares=0, comments=0, marked_as_ads=False, links=0)
+        post = Post.objects.create(vkid=1, content=[{'text': 'x' * 500 + 'tail'}, {'text': 'repost'}], **params)
+        content_url = reverse('communities:post_content', args=[post.id])
+
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp = self.client.get(reverse('communities:post_list'))
+        self.assertContains(resp, content_url)
+        self.assertContains(resp, 'repost')
+        self.assertNotContains(resp, 'tail')
+
+        resp = self.client.get(content_url)
+        self.assertContains(resp, 'x' * 500 + 'tail')
+        self.assertContains(resp, 'repost')
+
+
+class ExportViewTest(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        User.objects.create_user(EMAIL, PASSWORD, is_active=True)
+        for vkid, followers in ((1, 20), (2, 10)):
+            Community.objects.create(vkid=vkid, name='сообщество {}'.format(vkid), deactivated=False,
+                                     ctype=Community.TYPE_PUBLIC_PAGE, followers=followers)
+            CommunityHistory.objects.create(community_id=vkid, checked_at=timezone.now(), followers=followers)
+
+    def _export(self, name, **params):
+        resp = self.client.get(reverse('communities:{}_export'.format(name)) + '?' + urlencode(params))
+        return resp, b''.join(resp.streaming_content).decode()
+
+    def test_only_authenticated_user_can_access(self):
+        resp = self.client.get(reverse('communities:community_export'))
+        self.assertNotEqual(resp.status_code, 200)
+
+    def test_communities_as_ndjson(self):
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp, content = self._export('community', followers_max=15)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([(row['vkid'], row['name']) for row in rows], [(2, 'сообщество 2')])
+
+    def test_history_as_csv(self):
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp, content = self._export('community_history', format='csv', community_id=1)
+        self.assertEqual(resp['Content-Type'], 'text/csv')
+        self.assertIn('attachment', resp['Content-Disposition'])
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'community_id,checked_at,followers')
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith('1,') and lines[1].endswith(',20'))
+
+    def test_archived_history_goes_first(self):
+        CommunityHistoryArchive.objects.create(community_id=1, month=Date(2026, 1, 1),
+                                               offsets=[0, 86400 * 3], followers=[5, 7])
+        CommunityHistoryArchive.objects.create(community_id=2, month=Date(2026, 1, 1), offsets=[0], followers=[1])
+
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp, content = self._export('community_history', community_id=1)
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['followers'] for row in rows], [5, 7, 20])
+        self.assertEqual(rows[1]['checked_at'], '2026-01-04T00:00:00Z')
+
+        resp, content = self._export('community_history', date_min='2026-01-02', date_max='2026-01-10')
+        self.assertEqual([json.loads(line)['followers'] for line in content.splitlines()], [7])
+
+    def test_posts_are_sorted_like_in_list(self):
+        params = dict(community_id=1, checked_at=timezone.now(), likes=0, shares=0, comments=0,
+                      marked_as_ads=False, links=0)
+        for vkid, views in ((1, 10), (2, 30), (3, 20)):
+            Post.objects.create(vkid=vkid, published_at=timezone.now(), views=views,
+                                content=[{'text': 'пост'}], **params)
+
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp, content = self._export('post', sort_by='views', inverse='on')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['vkid'] for row in rows], [2, 3, 1])
+        self.assertEqual(rows[0]['content'], [{'text': 'пост'}])
+
+    def test_invalid_params(self):
+        self.client.login(email=EMAIL, password=PASSWORD)
+        resp = self.client.get(reverse('communities:post_export') + '?format=xml')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(reverse('communities:community_export') + '?sort_by=unknown')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('sort_by', json.loads(resp.content.decode())['errors'])
@@ -19,4 +19,24 @@ urlpatterns = [
         views.PostListView.as_view(),
         name='post_list',
     ),
+    url(
+        r'^posts/(?P<pk>[0-9]+)/content$',
+        views.PostContentView.as_view(),
+        name='post_content',
+    ),
+    url(
+        r'^export/communities$',
+        views.CommunityExportView.as_view(),
+        name='community_export',
+    ),
+    url(
+        r'^export/history$',
+        views.CommunityHistoryExportView.as_view(),
+        name='community_history_export',
+    ),
+    url(
+        r'^export/posts$',
+        views.PostExportView.as_view(),
+        name='post_export',
+    ),
 ]
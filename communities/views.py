@@ -1,9 +1,51 @@
-from django.db.models import F
-from django.views.generic import DetailView, ListView
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime as DateTime
+from itertools import chain
+
+from django.http import HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.views.generic import DetailView, ListView, View
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.utils.dateparse import parse_datetime
+
+from .models import Community, CommunityHistory, CommunityHistoryArchive, Post, PostQuerySet
+from .forms import CommunitySearchForm, PostSearchForm, CommunityHistoryExportForm
+from .listcache import get_ids, ObjectsByIds
+from . import export
+
+
+def find_communities(params):
+    """The communities sorted and filtered by the cleaned_data of CommunitySearchForm"""
+    return Community.available.filter_ignoring_nonetype(
+        verified=params.get('verified'),
+        ctype=params.get('ctype'),
+        age_limit=params.get('age_limit'),
+        followers__gte=params.get('followers_min'),
+        followers__lte=params.get('followers_max'),
+        views_per_post__gte=params.get('views_per_post_min'),
+        views_per_post__lte=params.get('views_per_post_max'),
+        likes_per_view__gte=params.get('likes_per_view_min'),
+        likes_per_view__lte=params.get('likes_per_view_max'),
+    ).exclude_nulls(
+        params['sort_by']
+    ).sort_by(params['sort_by'], params['inverse'])
 
-from .models import Community, Post
-from .forms import CommunitySearchForm, PostSearchForm
+
+def find_posts(params):
+    """The posts filtered by the cleaned_data of PostSearchForm, they are not sorted"""
+    qs = Post.objects.with_likes_per_view().filter_ignoring_nonetype(
+        community_id=params.get('community_id'),
+        marked_as_ads=params.get('marked_as_ads'),
+        published_at__gte=params.get('date_min'),
+        published_at__lte=params.get('date_max'),
+        views__gte=params.get('views_min'),
+        views__lte=params.get('views_max'),
+        post_likes_per_view__gte=params.get('likes_per_view_min'),
+        post_likes_per_view__lte=params.get('likes_per_view_max'),
+    ).search(params.get('search'))
+    if 'has_links' in params:
+        qs = qs.exclude(links=0) if params['has_links'] else qs.filter(links=0)
+    return qs.exclude_nulls(params['sort_by'])
 
 
 class CommunityListView(LoginRequiredMixin, ListView):
@@ -11,6 +53,8 @@ class CommunityListView(LoginRequiredMixin, ListView):
     paginate_by = 50
     limit = 400
     page_kwarg = 'p'
+    fields = ('vkid', 'name', 'icon100url', 'verified', 'ctype', 'age_limit', 'followers', 'views_per_post',
+              'likes_per_view', 'growth_per_day', 'growth_per_week')  # the ones shown in the list
 
     def get_queryset(self):
         self.form = CommunitySearchForm(self.request.GET)
@@ -19,20 +63,8 @@ class CommunityListView(LoginRequiredMixin, ListView):
         else:
             params = {'sort_by': 'followers', 'inverse': True}
             self.form = CommunitySearchForm(initial=params)
-        qs = Community.available.filter_ignoring_nonetype(
-            verified=params.get('verified'),
-            ctype=params.get('ctype'),
-            age_limit=params.get('age_limit'),
-            followers__gte=params.get('followers_min'),
-            followers__lte=params.get('followers_max'),
-            views_per_post__gte=params.get('views_per_post_min'),
-            views_per_post__lte=params.get('views_per_post_max'),
-            likes_per_view__gte=params.get('likes_per_view_min'),
-            likes_per_view__lte=params.get('likes_per_view_max'),
-        ).exclude_nulls(
-            params['sort_by']
-        ).sort_by(params['sort_by'], params['inverse'])
-        return list(qs[:self.limit])
+        qs = find_communities(params)
+        return ObjectsByIds(Community.objects.only(*self.fields), get_ids(qs, params, self.limit))
 
     def get_context_data(self, **kwargs):
         return super().get_context_data(form=self.form)
@@ -43,46 +75,168 @@ class CommunityDetailView(LoginRequiredMixin, DetailView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx['followers_history'] = list(self.object.communityhistory_set.order_by(
-            'checked_at'
-        ).values(
-            x=F('checked_at'),
-            y=F('followers'),
-        ))
+        ctx['followers_history'] = self.object.followers_history()
         return ctx
 
 
 class PostListView(LoginRequiredMixin, ListView):
+    """The first posts (up to the limit) are cached and paginated by numbers,
+    the next ones are paginated by a cursor if the posts are sorted by one of PostQuerySet.SEEK_EXPRESSIONS"""
     template_name = 'communities/post_list.html'
     paginate_by = 20
     limit = 160
     page_kwarg = 'p'
+    cursor_kwarg = 'after'
+    # the ones shown in the list, the content is summarized (see PostQuerySet.with_content_summary())
+    fields = ('id', 'vkid', 'published_at', 'views', 'likes', 'shares', 'comments',
+              'community', 'community__vkid', 'community__ctype', 'community__name', 'community__icon50url')
 
     def get_queryset(self):
+        self.seekable = False
+        self.seeking = False
+        self.next_cursor = None
         self.form = PostSearchForm(self.request.GET)
         if self.form.is_valid():
             params = self.form.cleaned_data
         else:
             params = {'sort_by': 'published_at', 'inverse': True}
             self.form = PostSearchForm(initial=params)
-        qs = Post.objects.with_likes_per_view().select_related(
+        qs = find_posts(params)
+        sort_by = self.sort_by = params['sort_by']
+        page_qs = self._project(Post.objects.with_likes_per_view())
+        if sort_by not in PostQuerySet.SEEK_EXPRESSIONS:
+            return ObjectsByIds(page_qs, get_ids(qs.sort_by(sort_by, params['inverse']), params, self.limit))
+
+        self.seekable = True
+        after = self._decode_cursor(self.request.GET.get(self.cursor_kwarg), sort_by)
+        if after is None:
+            return ObjectsByIds(page_qs, get_ids(qs.seek(sort_by, params['inverse']), params, self.limit))
+        self.seeking = True
+        posts = list(self._project(qs.seek(sort_by, params['inverse'], after))[:self.paginate_by + 1])
+        if len(posts) > self.paginate_by:
+            posts = posts[:self.paginate_by]
+            self.next_cursor = self._encode_cursor(posts[-1])
+        return posts
+
+    def _project(self, qs):
+        return qs.with_content_summary().select_related(
             'community'
-        ).filter_ignoring_nonetype(
-            community_id=params.get('community_id'),
-            marked_as_ads=params.get('marked_as_ads'),
-            published_at__gte=params.get('date_min'),
-            published_at__lte=params.get('date_max'),
-            views__gte=params.get('views_min'),
-            views__lte=params.get('views_max'),
-            post_likes_per_view__gte=params.get('likes_per_view_min'),
-            post_likes_per_view__lte=params.get('likes_per_view_max'),
-        ).search(params.get('search'))
-        if 'has_links' in params:
-            qs = qs.exclude(links=0) if params['has_links'] else qs.filter(links=0)
-        qs = qs.exclude_nulls(
-            params['sort_by']
-        ).sort_by(params['sort_by'], params['inverse'])
-        return list(qs[:self.limit])
+        ).only(
+            *self.fields
+        )
+
+    def get_paginate_by(self, queryset):
+        return None if self.seeking else self.paginate_by
 
     def get_context_data(self, **kwargs):
-        return super().get_context_data(form=self.form)
+        ctx = super().get_context_data(form=self.form)
+        page = ctx['page_obj']
+        # the cached posts may be followed by others
+        if self.seekable and page is not None and page.object_list and not page.has_next() and \
+                len(page.paginator.object_list) == self.limit:
+            self.next_cursor = self._encode_cursor(page.object_list[-1])
+        ctx['next_cursor'] = self.next_cursor
+        return ctx
+
+    def _encode_cursor(self, post):
+        value = getattr(post, self.sort_by)
+        if isinstance(value, DateTime):
+            value = value.isoformat()
+        return urlsafe_b64encode(json.dumps([self.sort_by, value, post.id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor, sort_by):
+        """Returns (value, id) of the last post of the previous page or None if the cursor is absent or invalid"""
+        if not cursor:
+            return None
+        try:
+            field_name, value, id_ = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (ValueError, TypeError):
+            return None
+        if field_name != sort_by or not isinstance(id_, int):
+            return None
+        if field_name == 'published_at':
+            value = parse_datetime(value) if isinstance(value, str) else None
+        elif not isinstance(value, (int, float)):
+            value = None
+        if value is None:
+            return None
+        return value, id_
+
+
+class PostContentView(LoginRequiredMixin, DetailView):
+    """The full content of a post, it is loaded by the list of posts on demand"""
+    queryset = Post.objects.only('id', 'content')
+    template_name = 'communities/post_content_snippet.html'
+    context_object_name = 'post'
+
+
+class AbstractExportView(LoginRequiredMixin, View):
+    """Streams the rows(params) of a subclass found by the params of the form as NDJSON or CSV (?format=csv)"""
+    name = None
+    form_class = None
+    default_params = {}
+    fields = ()
+
+    def get(self, request):
+        fmt = request.GET.get('format', 'ndjson')
+        if fmt not in export.FORMATS:
+            return HttpResponseBadRequest('unknown format')
+        data = request.GET.copy()
+        for key, value in self.default_params.items():
+            data.setdefault(key, value)
+        form = self.form_class(data)
+        if not form.is_valid():
+            return JsonResponse({'errors': form.errors}, status=400)
+        response = StreamingHttpResponse(
+            export.stream(self.fields, self.rows(form.cleaned_data), fmt),
+            content_type=export.FORMATS[fmt]
+        )
+        response['Content-Disposition'] = 'attachment; filename="{0}.{1}"'.format(self.name, fmt)
+        return response
+
+
+class CommunityExportView(AbstractExportView):
+    name = 'communities'
+    form_class = CommunitySearchForm
+    default_params = {'sort_by': 'followers', 'inverse': 'on'}
+    fields = ('vkid', 'name', 'ctype', 'verified', 'age_limit', 'followers', 'views_per_post', 'likes_per_view',
+              'growth_per_day', 'growth_per_week', 'posts_per_week', 'checked_at', 'description', 'status')
+
+    def rows(self, params):
+        return find_communities(params).values_list(*self.fields).iterator()
+
+
+class CommunityHistoryExportView(AbstractExportView):
+    """The archived samples go first, then the recent ones"""
+    name = 'community_history'
+    form_class = CommunityHistoryExportForm
+    fields = ('community_id', 'checked_at', 'followers')
+
+    def rows(self, params):
+        archived = CommunityHistoryArchive.objects.samples(params['community_id'], params['date_min'],
+                                                           params['date_max'])
+        recent = CommunityHistory.objects.filter(**{
+            lookup: params[name]
+            for lookup, name in (('community_id', 'community_id'),
+                                 ('checked_at__gte', 'date_min'),
+                                 ('checked_at__lte', 'date_max'))
+            if params[name] is not None
+        }).order_by('id').values_list(*self.fields).iterator()
+        return chain(archived, recent)
+
+
+class PostExportView(AbstractExportView):
+    name = 'posts'
+    form_class = PostSearchForm
+    default_params = {'sort_by': 'published_at', 'inverse': 'on'}
+    fields = ('id', 'community_id', 'vkid', 'published_at', 'checked_at', 'views', 'likes', 'shares', 'comments',
+              'marked_as_ads', 'links', 'content')
+
+    def rows(self, params):
+        qs = find_posts(params)
+        if params['sort_by'] in PostQuerySet.SEEK_EXPRESSIONS:
+            qs = qs.seek(params['sort_by'], params['inverse'])
+        else:
+            qs = qs.sort_by(params['sort_by'], params['inverse'])
+        return qs.values_list(*self.fields).iterator()
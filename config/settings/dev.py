@@ -58,6 +58,10 @@ LOGGING = {
             'level': 'INFO',
             'handlers': ['console'],
         },
+        'analytics': {
+            'level': 'INFO',
+            'handlers': ['console'],
+        },
         'celery': {
             'level': 'INFO',
             'handlers': ['celery_console'],
@@ -48,6 +48,16 @@ LOGGING = {
             'backupCount': 240,
             'encoding': 'utf-8',
         },
+        'analytics_file': {
+            'level': 'INFO',
+            'formatter': 'default',
+            'class': 'logging.handlers.TimedRotatingFileHandler',
+            'filename': '/var/log/vkcommunities/analytics',
+            'when': 'H',
+            'interval': 1,
+            'backupCount': 240,
+            'encoding': 'utf-8',
+        },
         'celery_file': {
             'level': 'INFO',
             'formatter': 'celery',
@@ -68,6 +78,10 @@ LOGGING = {
             'level': 'INFO',
             'handlers': ['dbcleaner_file'],
         },
+        'analytics': {
+            'level': 'INFO',
+            'handlers': ['analytics_file'],
+        },
         'celery': {
             'level': 'INFO',
             'handlers': ['celery_file'],
@@ -30,3 +30,9 @@ LOGGING = {
 }
 
 EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+CACHES = {  # the tests of the caching turn it on by override_settings
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    }
+}
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import logging
+import ssl
+import time
+from urllib.parse import urlencode
+
+from django.utils import timezone
+
+from .vkapi import (
+    BaseVkApi, TryAgain, HttpError, API_HOST, HTTP_REQUEST_TIMEOUT, REQUEST_DELAY_PER_TOKEN,
+    REQUEST_DELAY_PER_TOKEN_FOR_WALL
+)
+
+
+MAX_CONNECTIONS = 100
+
+METHOD_CLASS_DEFAULT = 'default'
+METHOD_CLASS_WALL = 'wall'
+RATES = {  # method class -> (requests per second, burst)
+    METHOD_CLASS_DEFAULT: (1 / REQUEST_DELAY_PER_TOKEN, 1),
+    METHOD_CLASS_WALL: (1 / REQUEST_DELAY_PER_TOKEN_FOR_WALL, 1),
+}
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """A request may reserve a slot in advance, so the bucket can go into debt"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def delay(self, now):
+        self._refill(now)
+        return max(0, (1 - self._tokens) / self.rate)
+
+    def reserve(self, now):
+        delay = self.delay(now)
+        self._tokens -= 1
+        return delay
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateScheduler:
+    """Keeps a token bucket per (token, method class).
+    Each request takes a slot in the bucket of its class and in the default one.
+    The rates of a token are divided by its delay_scale, and the token waits for the end of its cooldown."""
+
+    def __init__(self, tokens, rates=RATES):
+        self._rates = rates
+        self._buckets = {}
+        self.set_tokens(tokens)
+
+    def set_tokens(self, tokens):
+        """The buckets of the kept tokens are kept"""
+        self._tokens = list(tokens)
+        for token in self._tokens:
+            for method_class, (rate, capacity) in self._rates.items():
+                self._buckets.setdefault((token.key, method_class), TokenBucket(rate, capacity))
+
+    async def acquire(self, method_class=METHOD_CLASS_DEFAULT):
+        classes = {METHOD_CLASS_DEFAULT, method_class}
+        now = time.monotonic()
+        wall_now = timezone.now()
+        token = min(
+            self._tokens,
+            key=lambda t: max([self._cooldown(t, wall_now)] + [self._bucket(t, c).delay(now) for c in classes])
+        )
+        delay = max([self._cooldown(token, wall_now)] + [self._bucket(token, c).reserve(now) for c in classes])
+        await asyncio.sleep(delay)
+        return token
+
+    def _bucket(self, token, method_class):
+        bucket = self._buckets[token.key, method_class]
+        bucket.rate = self._rates[method_class][0] / token.delay_scale
+        return bucket
+
+    @staticmethod
+    def _cooldown(token, now):
+        return max(0, (token.available_at - now).total_seconds())
+
+
+class AsyncHttpsPool:
+    """A minimal HTTP/1.1 client which keeps the connections to one host alive"""
+
+    def __init__(self, host, max_connections=MAX_CONNECTIONS, timeout=HTTP_REQUEST_TIMEOUT):
+        self._host = host
+        self._timeout = timeout
+        self._ssl = ssl.create_default_context()
+        self._idle = []
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+    async def post(self, path, body):
+        async with self._semaphore:
+            if self._idle:
+                try:
+                    return await self._send(self._idle.pop(), path, body)
+                except (OSError, asyncio.IncompleteReadError) as err:
+                    # the server could have closed the idle connection
+                    logger.debug('reconnecting after %s', repr(err))
+            return await self._send(await self._connect(), path, body)
+
+    def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+    async def _connect(self):
+        return await asyncio.wait_for(
+            asyncio.open_connection(self._host, 443, ssl=self._ssl),
+            self._timeout
+        )
+
+    async def _send(self, conn, path, body):
+        try:
+            keep_alive, data = await asyncio.wait_for(self._roundtrip(conn, path, body), self._timeout)
+        except BaseException:
+            conn[1].close()
+            raise
+        if keep_alive:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+        return data
+
+    async def _roundtrip(self, conn, path, body):
+        reader, writer = conn
+        writer.write(
+            'POST {0} HTTP/1.1\r\n'
+            'Host: {1}\r\n'
+            'Content-Type: application/x-www-form-urlencoded\r\n'
+            'Content-Length: {2}\r\n'
+            'Connection: keep-alive\r\n'
+            '\r\n'.format(path, self._host, len(body)).encode('ascii') + body
+        )
+        await writer.drain()
+
+        status_line = await reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            data = await self._read_chunked(reader)
+        else:
+            data = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        if status != 200:
+            raise HttpError('HTTP status {0}'.format(status))
+        return headers.get('connection', '').lower() != 'close', data
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass  # trailers
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+
+class AsyncVkApi(BaseVkApi):
+    """The same as VkApi, but the methods are coroutines.
+    Many requests can be in flight at once, each token is limited by its own buckets."""
+
+    def __init__(self):
+        super().__init__()
+        self._scheduler = RateScheduler(self._tokens)
+        self._http = AsyncHttpsPool(API_HOST)
+
+    async def get_communities(self, ids):
+        params = self._communities_params(ids)
+        await self._refresh_scheduler()
+        token = await self._scheduler.acquire()
+        response = await self._request('groups.getById', access_token=token.key, **params)
+        return self._parse_communities(response, token)
+
+    async def get_community_wall(self, id_):
+        await self._refresh_scheduler()
+        token = await self._scheduler.acquire(METHOD_CLASS_WALL)
+        response = await self._request('wall.get', access_token=token.key, **self._wall_params(id_))
+        return self._parse_wall(response, id_, token)
+
+    async def get_community_walls(self, ids, counts=None):
+        params = self._walls_params(ids, counts)
+        await self._refresh_scheduler()
+        token = await self._scheduler.acquire(METHOD_CLASS_WALL)
+        response = await self._request('execute', access_token=token.key, **params)
+        return self._parse_walls(response, ids, token)
+
+    def close(self):
+        self._http.close()
+
+    async def _refresh_scheduler(self):
+        """The tokens are reloaded in the executor of the event loop, like the other database work"""
+        if self._tokens_reload_is_due():
+            await asyncio.get_event_loop().run_in_executor(None, self._load_tokens)
+            self._scheduler.set_tokens(self._tokens)
+
+    async def _request(self, method, **params):
+        params = urlencode(params)
+        params = params.encode('ascii')
+        try:
+            data = await self._http.post('/method/' + method, params)
+            self._on_successful_request()
+            return json.loads(data.decode('utf-8'))
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                HttpError, ValueError) as err:
+            self._on_network_error(err)
+            raise TryAgain()
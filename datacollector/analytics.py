@@ -0,0 +1,38 @@
+import logging
+from datetime import timedelta as TimeDelta
+
+import django
+django.setup()
+
+from communities.listcache import bump_generation
+from communities.models import Community
+from datacollector.clean import retry
+from datacollector.commupdater import SLOW_COMMUNITY_UPDATE_PERIOD
+
+
+# the slowest checked communities with followers have a sample every 3 days,
+# so one of them is at most 2 days away from the aimed time
+GROWTH_SAMPLE_TOLERANCE = SLOW_COMMUNITY_UPDATE_PERIOD - TimeDelta(days=1)
+
+
+logger = logging.getLogger('analytics')
+
+
+@retry([300, 600, 600])
+def update_community_analytics():
+    now = django.utils.timezone.now()
+    return Community.objects.update_analytics(now, GROWTH_SAMPLE_TOLERANCE)
+
+
+def main():
+    logger.info('updating the growth and the posting rate of communities started')
+    num = update_community_analytics()
+    logger.info('%s communities updated', num)
+    bump_generation(Community)
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        logger.exception(e)
@@ -4,14 +4,32 @@ from datetime import timedelta as TimeDelta
 
 import django
 django.setup()
-from django.db import connection
+from django.core.cache import cache
+from django.db import connection, connections, transaction
 
-from communities.models import Community, CommunityHistory, Post
+from communities.listcache import bump_generation
+from communities.models import Community, CommunityHistory, CommunityHistoryArchive, Post
 
 
 POST_MAX_AGE = TimeDelta(days=90)
+POST_PARTITIONS_AHEAD = TimeDelta(weeks=4)
 NON_PROMO_POST_MAX_AGE = TimeDelta(days=15)
 
+COMMHISTORY_RAW_MAX_AGE = TimeDelta(days=7)  # then only the first sample of a day is archived
+COMMHISTORY_MAX_AGE = TimeDelta(days=365 * 2)
+COMMHISTORY_THINNING_RULES = [  # (age, which samples are kept), "t" is the UTC time of a sample
+    (TimeDelta(days=30), '''mod(EXTRACT(DAY FROM "t")::integer, 2) = 1 OR EXTRACT(DOW FROM "t") = 1'''),  # Monday
+    (TimeDelta(days=60), '''EXTRACT(DAY FROM "t") = 1 OR EXTRACT(DOW FROM "t") = 1'''),
+    (TimeDelta(days=180), '''EXTRACT(DAY FROM "t") = 1'''),
+    (COMMHISTORY_MAX_AGE, '''FALSE'''),
+]
+COMMHISTORY_THINNING_WINDOW = TimeDelta(days=14)  # must be longer than the period between the runs
+
+DELETE_BATCH_SIZE = 5000
+DELETE_BATCH_PAUSE = 0.5  # seconds, to let other transactions take the locks
+DELETE_CHECKPOINT_TIMEOUT = 24 * 60 * 60  # seconds, the run is started anew after it
+DELETE_CHECKPOINT_KEY_PREFIX = 'datacollector:clean:checkpoint'
+
 
 logger = logging.getLogger('dbcleaner')
 
@@ -29,61 +47,118 @@ def retry(intervals):
     return decorator
 
 
-@retry([300, 600, 600])
+class ChunkedDeleter:
+    """Deletes the rows of a queryset by small batches in the order of the first key field.
+    Every batch is a transaction of its own, so the locks are short and the memory usage is flat.
+    The key of the last batch is kept in the cache under checkpoint_key, so a run interrupted by an error
+    or a restart of the process continues from it. The checkpoint is removed when all the rows are deleted.
+    The rows are deleted by raw SQL, so the queryset must not have dependent rows (no cascades)."""
+
+    def __init__(self, queryset, key_fields=('pk',), batch_size=DELETE_BATCH_SIZE, pause=DELETE_BATCH_PAUSE,
+                 checkpoint_key=None):
+        self._queryset = queryset
+        self._key_fields = key_fields
+        self._batch_size = batch_size
+        self._pause = pause
+        self._checkpoint_key = checkpoint_key and '{0}:{1}'.format(DELETE_CHECKPOINT_KEY_PREFIX, checkpoint_key)
+        self.checkpoint = None  # the greatest value of the first key field in the deleted batches
+        self.deleted = 0
+
+    def run(self):
+        model = self._queryset.model
+        qn = connections[self._queryset.db].ops.quote_name
+        key_columns = [model._meta.get_field(f).column if f != 'pk' else model._meta.pk.column
+                       for f in self._key_fields]
+        if self.checkpoint is None and self._checkpoint_key:
+            self.checkpoint = cache.get(self._checkpoint_key)
+        while True:
+            qs = self._queryset
+            if self.checkpoint is not None:
+                # the rows with the same key are not deleted by the previous batch, if they did not fit into it
+                qs = qs.filter(**{'{0}__gte'.format(self._key_fields[0]): self.checkpoint})
+            qs = qs.order_by(self._key_fields[0]).values_list(*self._key_fields)[:self._batch_size]
+            subquery, params = qs.query.sql_with_params()
+            with transaction.atomic(using=self._queryset.db), connections[self._queryset.db].cursor() as cursor:
+                cursor.execute(
+                    '''DELETE FROM {0} WHERE ({1}) IN ({2}) RETURNING {3};'''.format(
+                        qn(model._meta.db_table),
+                        ', '.join(qn(c) for c in key_columns),
+                        subquery,
+                        qn(key_columns[0])
+                    ),
+                    params
+                )
+                keys = [key for key, in cursor.fetchall()]
+            if not keys:
+                return self._finish()
+            self.checkpoint = max(keys)
+            self.deleted += len(keys)
+            if self._checkpoint_key:
+                cache.set(self._checkpoint_key, self.checkpoint, DELETE_CHECKPOINT_TIMEOUT)
+            logger.info('%s "%s" rows deleted, up to %s=%s', self.deleted, model._meta.db_table,
+                        self._key_fields[0], self.checkpoint)
+            if len(keys) < self._batch_size:
+                return self._finish()
+            time.sleep(self._pause)
+
+    def _finish(self):
+        if self._checkpoint_key:
+            cache.delete(self._checkpoint_key)
+        return self.deleted
+
+
 def cleanup_non_promo_posts():
     now = django.utils.timezone.now()
-    num, _ = Post.objects.filter(
-        published_at__lt=now - NON_PROMO_POST_MAX_AGE,
-        checked_at__lt=now - TimeDelta(hours=25),  # to avoid blocks in db
-        links=0,
-        marked_as_ads=False,
-    ).delete()
-    return num
+    deleter = ChunkedDeleter(
+        Post.objects.filter(
+            published_at__lt=now - NON_PROMO_POST_MAX_AGE,
+            checked_at__lt=now - TimeDelta(hours=25),  # to avoid blocks in db
+            links=0,
+            marked_as_ads=False,
+        ),
+        key_fields=Post.PRIMARY_KEY_COLUMNS,
+        checkpoint_key='non_promo_posts'
+    )
+    retry([300, 600, 600])(deleter.run)()
+    return deleter.deleted
 
 
 @retry([300, 600, 600])
-def cleanup_posts():
+def create_post_partitions():
     now = django.utils.timezone.now()
-    num, _ = Post.objects.filter(
-        published_at__lt=now - POST_MAX_AGE,
-        checked_at__lt=now - TimeDelta(hours=25),  # to avoid blocks in db
-    ).delete()
-    return num
+    return Post.objects.create_partitions(now, now + POST_PARTITIONS_AHEAD)
 
 
 @retry([300, 600, 600])
-def cleanup_commhistory():
+def drop_old_post_partitions():
     now = django.utils.timezone.now()
+    return Post.objects.drop_partitions(now - POST_MAX_AGE)
 
-    num, _ = CommunityHistory.objects.filter(
-        checked_at__lte=now - TimeDelta(days=365 * 2),
-    ).delete()
 
-    num += CommunityHistory.objects.filter(
-        checked_at__lte=now - TimeDelta(days=7),
-        checked_at__hour__gte=12,
-    ).delete()[0]
+def cleanup_old_posts():
+    """The old posts are left only in the default partition after the old partitions are dropped"""
+    now = django.utils.timezone.now()
+    deleter = ChunkedDeleter(
+        Post.objects.filter(published_at__lt=now - POST_MAX_AGE),
+        key_fields=Post.PRIMARY_KEY_COLUMNS,
+        checkpoint_key='old_posts'
+    )
+    retry([300, 600, 600])(deleter.run)()
+    return deleter.deleted
 
-    num += CommunityHistory.objects.filter(
-        checked_at__range=(now - TimeDelta(days=60), now - TimeDelta(days=30)),
-        checked_at__day__in=range(2, 31, 2),
-    ).exclude(
-        checked_at__week_day=2,  # Monday
-    ).delete()[0]
 
-    num += CommunityHistory.objects.filter(
-        checked_at__range=(now - TimeDelta(days=180), now - TimeDelta(days=60)),
-        checked_at__day__gt=1,
-    ).exclude(
-        checked_at__week_day=2,  # Monday
-    ).delete()[0]
+@retry([300, 600, 600])
+def compact_commhistory():
+    now = django.utils.timezone.now()
+    return CommunityHistoryArchive.objects.compact(now - COMMHISTORY_RAW_MAX_AGE)
 
-    num += CommunityHistory.objects.filter(
-        checked_at__lte=now - TimeDelta(days=180),
-        checked_at__day__gt=1,
-    ).delete()[0]
 
-    return num
+@retry([300, 600, 600])
+def cleanup_commhistory():
+    now = django.utils.timezone.now()
+    months = CommunityHistoryArchive.objects.delete_older_than(now - COMMHISTORY_MAX_AGE)
+    samples = CommunityHistoryArchive.objects.thin_out(now, COMMHISTORY_THINNING_RULES, COMMHISTORY_THINNING_WINDOW)
+    return months, samples
 
 
 @retry([300, 600, 600])
@@ -96,16 +171,25 @@ def vacuum_analyze(table_name):
 
 def main():
     logger.info('cleaning posts started')
+    num = create_post_partitions()
+    logger.info('%s post partitions created', num)
+    num = drop_old_post_partitions()
+    logger.info('%s post partitions dropped', num)
+    num = cleanup_old_posts()
+    logger.info('%s old posts deleted from the default partition', num)
     num = cleanup_non_promo_posts()
-    num += cleanup_posts()
-    logger.info('%s posts deleted', num)
+    logger.info('%s non-promo posts deleted', num)
+    bump_generation(Post)
 
     logger.info('cleaning history rows started')
-    num = cleanup_commhistory()
-    logger.info('%s history rows deleted', num)
+    num = compact_commhistory()
+    logger.info('%s history rows archived', num)
+    months, samples = cleanup_commhistory()
+    logger.info('%s archived months deleted, %s archived samples dropped', months, samples)
 
     vacuum_analyze(Post._meta.db_table)
     vacuum_analyze(CommunityHistory._meta.db_table)
+    vacuum_analyze(CommunityHistoryArchive._meta.db_table)
     vacuum_analyze(Community._meta.db_table)
 
 
@@ -1,5 +1,10 @@
+import asyncio
 import logging
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta as TimeDelta
+from itertools import chain
 from threading import Thread, Event
 
 from django.db import transaction
@@ -11,7 +16,20 @@ from .errors import VkApiParsingError
 
 
 COMMUNITY_UPDATE_PERIOD = TimeDelta(hours=12)
+FAST_COMMUNITY_UPDATE_PERIOD = TimeDelta(hours=6)
+SLOW_COMMUNITY_UPDATE_PERIOD = TimeDelta(days=3)
+DORMANT_COMMUNITY_UPDATE_PERIOD = TimeDelta(days=14)  # deactivated or without followers counter
+FAST_GROWTH = 0.01  # followers per day relative to followers
+SLOW_GROWTH = 0.0005
+MIN_FOLLOWERS_OF_BIG_COMMUNITY = 10000  # they are never updated slowly
 COMMUNITIES_BUFFER_MAX_LENGTH = 20 * COMMUNITIES_PER_REQUEST
+COMMUNITIES_BUFFER_MIN_LENGTH = 5 * COMMUNITIES_PER_REQUEST  # the next page is loaded in background below it
+REQUESTS_IN_FLIGHT = 4  # 0 disables the pipeline, a request and a write of its response take turns then
+# the text fields (Community.CONTENT_FIELDS) are not loaded, their changes are detected by content_hash
+COMPARED_FIELDS = (
+    'deactivated', 'ctype', 'verified', 'age_limit', 'followers', 'checked_at', 'next_check_at', 'content_hash'
+)
+LOADED_FIELDS = COMPARED_FIELDS + ('growth_per_day', 'growth_per_week')
 
 
 logger = logging.getLogger(__name__)
@@ -19,74 +37,258 @@ logger = logging.getLogger(__name__)
 
 class CommunitiesUpdater(Thread):
 
-    def __init__(self, vkapi):
+    def __init__(self, vkapi, requests_in_flight=REQUESTS_IN_FLIGHT):
         super().__init__()
         self._vkapi = vkapi
+        self._requests_in_flight = requests_in_flight
         self._stop_event = Event()
         self._communities_buffer = []
         self._check_time = None
+        # the keyset of the buffer end: the last vkid without next_check_at and the last (next_check_at, vkid)
+        self._last_new_vkid = 0
+        self._last_keyset = None
+        self._rescheduled = []  # the written communities, the early ones are put back into the buffer
+        self._loader = None
+        self._loading = None  # the future of the next page
+        self._fetcher = None
+        self._pipeline = deque()  # [(communities, the future of _fetch() or the task of _update_communities_async())]
+        self._slots = None  # the semaphore of the requests in flight of run_async()
+        self._write_lock = None
 
     def stop(self):
         self._stop_event.set()
 
     def run(self):
         logger.info('started')
+        self._loader = ThreadPoolExecutor(max_workers=1)
+        if self._requests_in_flight:
+            self._fetcher = ThreadPoolExecutor(max_workers=self._requests_in_flight)
         while not self._stop_event.is_set():
             try:
-                self._loop()
+                if self._fetcher is None:
+                    self._loop()
+                else:
+                    self._loop_pipelined()
+            except TryAgain:
+                pass  # it is raised only after the stop
             except Exception as err:
                 logger.exception(err)
                 self._sleep(10)
+        if self._fetcher is not None:
+            self._fetcher.shutdown()
+            self._fetcher = None
+            self._pipeline.clear()
+        self._loader.shutdown()
+        self._loader = None
+        self._loading = None
+        self._stop_event.clear()
+        logger.info('stopped')
+
+    async def run_async(self):
+        """The same as run(), but the requests to VK API are awaited (AsyncVkApi is expected)
+        and the database work is done in the executor of the event loop.
+        Up to requests_in_flight requests are awaited at once, their responses are written one by one."""
+        logger.info('started')
+        self._slots = asyncio.Semaphore(max(1, self._requests_in_flight))
+        self._write_lock = asyncio.Lock()
+        while not self._stop_event.is_set():
+            try:
+                await self._loop_async()
+            except Exception as err:
+                logger.exception(err)
+                await self._sleep_async(10)
+        await self._wait_pipeline_async()
         self._stop_event.clear()
         logger.info('stopped')
 
     def _loop(self):
         if self._communities_buffer:
+            self._prefetch_communities()
             self._sleep_until_check_begins()
             self._update_communities()
         else:
             self._load_communities()
 
+    def _loop_pipelined(self):
+        """The same as _loop(), but the requests are sent by the fetcher threads,
+        while this thread writes the responses in the order of the requests"""
+        try:
+            if self._communities_buffer:
+                self._prefetch_communities()
+                delay = self._delay_until_check_begins()
+                if delay > 0:
+                    self._write_pipeline(0)  # nothing to wait for in parallel
+                    self._sleep(delay)
+                    if self._stop_event.is_set():
+                        return
+                communities = self._communities_buffer[:COMMUNITIES_PER_REQUEST]
+                self._communities_buffer = self._communities_buffer[COMMUNITIES_PER_REQUEST:]
+                self._pipeline.append((communities, self._fetcher.submit(self._fetch, communities)))
+                self._write_pipeline(self._requests_in_flight - 1)
+            else:
+                self._write_pipeline(0)  # or the communities in flight are loaded again
+                self._load_communities()
+        except Exception:
+            # the lost communities are due, they are loaded again after the reset of the keyset
+            self._pipeline.clear()
+            self._communities_buffer = []
+            raise
+
+    def _write_pipeline(self, max_length):
+        """Writes the finished responses and waits for the others until the pipeline is not longer than max_length"""
+        while len(self._pipeline) > max_length or (self._pipeline and self._pipeline[0][1].done()):
+            communities, future = self._pipeline.popleft()
+            self._check_time, vkid2data = future.result()
+            self._save_communities(communities, vkid2data)
+            self._requeue_rescheduled()
+
+    async def _loop_async(self):
+        if self._communities_buffer:
+            if len(self._communities_buffer) < COMMUNITIES_BUFFER_MIN_LENGTH:
+                # the keyset is taken here, the pipeline is changed by the event loop
+                num = COMMUNITIES_BUFFER_MAX_LENGTH - len(self._communities_buffer)
+                self._append_page(await self._run_sync(self._load_page, num, *self._buffer_keyset()))
+            await self._sleep_async(self._delay_until_check_begins())
+            if self._stop_event.is_set():
+                return
+            await self._slots.acquire()
+            communities = self._communities_buffer[:COMMUNITIES_PER_REQUEST]
+            self._communities_buffer = self._communities_buffer[COMMUNITIES_PER_REQUEST:]
+            task = asyncio.ensure_future(self._update_communities_async(communities))
+            self._pipeline.append((communities, task))
+            task.add_done_callback(self._on_request_done)
+        else:
+            await self._wait_pipeline_async()  # or the communities in flight are loaded again
+            await self._run_sync(self._load_communities)
+
+    async def _update_communities_async(self, communities):
+        check_time, vkid2data = await self._request_async(communities)
+        async with self._write_lock:
+            self._check_time = check_time
+            await self._run_sync(self._save_communities, communities, vkid2data)
+            self._requeue_rescheduled()  # the buffer is changed only by the event loop
+
+    def _on_request_done(self, task):
+        self._slots.release()
+        self._pipeline.remove(next(item for item in self._pipeline if item[1] is task))
+        err = None if task.cancelled() else task.exception()
+        if err is not None and not isinstance(err, TryAgain):  # TryAgain means it is stopped
+            # the lost communities are due, they are loaded again after the reset of the keyset
+            logger.error(repr(err), exc_info=err)
+
+    async def _wait_pipeline_async(self):
+        while self._pipeline:
+            await asyncio.wait([task for _, task in self._pipeline])
+
     def _sleep_until_check_begins(self):
-        last_check_time = self._communities_buffer[0].checked_at
-        if last_check_time is None:
-            return
-        next_check_time = last_check_time + COMMUNITY_UPDATE_PERIOD
+        delay = self._delay_until_check_begins()
+        if delay > 0:
+            self._sleep(delay)
+
+    def _delay_until_check_begins(self):
+        next_check_time = self._communities_buffer[0].next_check_at
+        if next_check_time is None:
+            return 0
         delay = (next_check_time - timezone.now()).total_seconds()
         if delay < 0:
             logger.warning('updating is %.2f seconds late', -delay)
-        elif delay > 0:
-            self._sleep(delay)
+        return max(0, delay)
 
     def _sleep(self, seconds):
         self._stop_event.wait(timeout=seconds)
 
+    async def _sleep_async(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self._stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(remaining, 1))
+
+    @staticmethod
+    async def _run_sync(fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
     def _update_communities(self):
         communities = self._communities_buffer[:COMMUNITIES_PER_REQUEST]
         vkid2data = self._request(communities)
+        self._save_communities(communities, vkid2data)
+        self._communities_buffer = self._communities_buffer[COMMUNITIES_PER_REQUEST:]
+        self._requeue_rescheduled()
+
+    def _save_communities(self, communities, vkid2data):
+        fields2communities = defaultdict(list)  # the communities are grouped by the changed fields
+        history = []
+        rescheduled = []
         for c in communities:
             try:
                 data = vkid2data.get(c.vkid)
+                old_values = [getattr(c, f) for f in COMPARED_FIELDS]
                 self._update_community(c, data)
-                logger.info('community(id=%s) updated', c.vkid)
             except VkApiParsingError as err:
                 logger.error('community(id=%s): %s', c.vkid, repr(err))
-        self._communities_buffer = self._communities_buffer[COMMUNITIES_PER_REQUEST:]
+                continue
+            rescheduled.append(c)
+            changed_fields = tuple(f for f, old in zip(COMPARED_FIELDS, old_values) if getattr(c, f) != old)
+            if 'content_hash' in changed_fields:
+                changed_fields += Community.CONTENT_FIELDS
+            if changed_fields:
+                fields2communities[changed_fields].append(c)
+            if c.followers is not None:
+                history.append(CommunityHistory(
+                    community_id=c.vkid,
+                    checked_at=self._check_time,
+                    followers=c.followers
+                ))
+        self._write_communities(fields2communities, history)
+        self._rescheduled.extend(rescheduled)
+        logger.info('%s communities updated', sum(len(comms) for comms in fields2communities.values()))
+
+    @staticmethod
+    @transaction.atomic
+    def _write_communities(fields2communities, history):
+        for fields, communities in fields2communities.items():
+            Community.objects.bulk_update(communities, fields)
+        CommunityHistory.objects.bulk_create(history)
 
     def _request(self, communities):
+        self._check_time, id2item = self._fetch(communities)
+        return id2item
+
+    def _fetch(self, communities):
+        """Returns the check time and the response, it is safe to call it from many threads"""
         ids = [c.vkid for c in communities]
         while True:
             try:
-                self._check_time = timezone.now()
+                check_time = timezone.now()
                 items = self._vkapi.get_communities(ids)
                 break
             except TryAgain:
+                if self._stop_event.is_set():
+                    raise  # the batch is due again after the restart
                 self._sleep(1)
         id2item = {i['id']: i for i in items}
-        return id2item
+        return check_time, id2item
+
+    async def _request_async(self, communities):
+        """The same as _fetch(), many requests can be awaited at once"""
+        ids = [c.vkid for c in communities]
+        while True:
+            try:
+                check_time = timezone.now()
+                items = await self._vkapi.get_communities(ids)
+                break
+            except TryAgain:
+                if self._stop_event.is_set():
+                    raise  # the batch is due again after the restart
+                await self._sleep_async(1)
+        id2item = {i['id']: i for i in items}
+        return check_time, id2item
 
     def _update_community(self, comm, data):
         followers = data.get('members_count')
+        old_followers = comm.followers
+        old_check_time = comm.checked_at
 
         comm.deactivated = self._parse_deactivated(data)
         comm.ctype = self._parse_type(data)
@@ -99,21 +301,24 @@ class CommunitiesUpdater(Thread):
         comm.icon50url = data.get('photo_50', '')
         comm.icon100url = data.get('photo_100', '')
         comm.checked_at = self._check_time
+        comm.content_hash = comm.calculate_content_hash()
+        comm.next_check_at = self._check_time + self._update_period(comm, old_followers, old_check_time)
 
-        if followers is None:
-            comm.save()
-        else:
-            self._save_with_history(comm)
-
-    def _save_with_history(self, comm):
-        current = CommunityHistory(
-            community=comm,
-            checked_at=self._check_time,
-            followers=comm.followers
-        )
-        with transaction.atomic():
-            comm.save()
-            current.save()
+    def _update_period(self, comm, old_followers, old_check_time):
+        """Volatile and big communities are checked more often than static and small ones"""
+        if comm.deactivated or not comm.followers:
+            return DORMANT_COMMUNITY_UPDATE_PERIOD
+        growth = [abs(comm.growth_per_day or 0), abs(comm.growth_per_week or 0) / 7]
+        if old_followers is not None and old_check_time is not None:
+            days = (self._check_time - old_check_time).total_seconds() / 86400
+            if days > 0:
+                growth.append(abs(comm.followers - old_followers) / days)
+        relative_growth = max(growth) / comm.followers
+        if relative_growth >= FAST_GROWTH:
+            return FAST_COMMUNITY_UPDATE_PERIOD
+        if relative_growth < SLOW_GROWTH and comm.followers < MIN_FOLLOWERS_OF_BIG_COMMUNITY:
+            return SLOW_COMMUNITY_UPDATE_PERIOD
+        return COMMUNITY_UPDATE_PERIOD
 
     @staticmethod
     def _parse_deactivated(data):
@@ -162,19 +367,74 @@ class CommunitiesUpdater(Thread):
             return Community.AGELIMIT_18
         raise VkApiParsingError('unexpected value of a parameter age_limits = {0}'.format(age_limits))
 
-    @transaction.atomic
     def _load_communities(self):
-        communities = Community.objects.filter(checked_at__isnull=True)[:COMMUNITIES_BUFFER_MAX_LENGTH]
-        self._communities_buffer = list(communities)
-        if len(self._communities_buffer) < COMMUNITIES_BUFFER_MAX_LENGTH:
-            communities = Community.objects.filter(
-                checked_at__isnull=False
-            ).order_by(
-                'checked_at'
-            ).only(
-                'deactivated', 'ctype', 'verified', 'age_limit', 'name', 'description', 'followers',
-                'status', 'icon50url', 'icon100url', 'checked_at', 'growth_per_day', 'growth_per_week'
-            )[:COMMUNITIES_BUFFER_MAX_LENGTH - len(self._communities_buffer)]
-            self._communities_buffer.extend(communities)
+        """Starts the buffer from the most overdue communities"""
+        if self._loading is not None:
+            self._loading.exception()  # waits for the page, it is not needed after the reset of the keyset
+            self._loading = None
+        self._last_new_vkid = 0
+        self._last_keyset = None
+        self._extend_buffer()
         if not self._communities_buffer:
             raise RuntimeError('no communities in the database')
+
+    def _extend_buffer(self):
+        num = COMMUNITIES_BUFFER_MAX_LENGTH - len(self._communities_buffer)
+        self._append_page(self._load_page(num, *self._buffer_keyset()))
+
+    def _prefetch_communities(self):
+        if self._loading is not None and self._loading.done():
+            loading, self._loading = self._loading, None
+            self._append_page(loading.result())
+        if self._loading is None and len(self._communities_buffer) < COMMUNITIES_BUFFER_MIN_LENGTH:
+            num = COMMUNITIES_BUFFER_MAX_LENGTH - len(self._communities_buffer)
+            self._loading = self._loader.submit(self._load_page, num, *self._buffer_keyset())
+
+    def _buffer_keyset(self):
+        # the new communities in flight are not written yet, so they would be loaded again
+        pending = chain(self._communities_buffer, chain.from_iterable(comms for comms, _ in self._pipeline))
+        if not any(c.next_check_at is None for c in pending):
+            self._last_new_vkid = 0  # the communities added since then may have lower vkids
+        return self._last_new_vkid, self._last_keyset
+
+    def _requeue_rescheduled(self):
+        """The communities rescheduled before the end of the buffer are put into it in order,
+        otherwise the keyset would pass them until the buffer runs out (e.g. the fast rechecks)"""
+        rescheduled, self._rescheduled = self._rescheduled, []
+        if self._last_keyset is None:
+            return
+        early = [c for c in rescheduled if (c.next_check_at, c.vkid) <= self._last_keyset]
+        if early:
+            self._communities_buffer.extend(early)
+            self._communities_buffer.sort(key=lambda c: (0, c.vkid) if c.next_check_at is None
+                                          else (1, c.next_check_at, c.vkid))
+
+    def _append_page(self, communities):
+        for c in communities:
+            if c.next_check_at is None:
+                self._last_new_vkid = c.vkid
+            else:
+                self._last_keyset = (c.next_check_at, c.vkid)
+        self._communities_buffer.extend(communities)
+
+    @staticmethod
+    def _load_page(num, last_new_vkid, last_keyset):
+        """Loads the communities after the keyset: the new ones by vkid, then the others by (next_check_at, vkid)"""
+        communities = list(Community.objects.filter(
+            next_check_at__isnull=True,
+            vkid__gt=last_new_vkid
+        ).order_by(
+            'vkid'
+        ).only(
+            *LOADED_FIELDS
+        )[:num])
+        if len(communities) < num:
+            queryset = Community.objects.filter(next_check_at__isnull=False)
+            if last_keyset is not None:
+                queryset = queryset.extra(where=['("next_check_at", "vkid") > (%s, %s)'], params=last_keyset)
+            communities.extend(queryset.order_by(
+                'next_check_at', 'vkid'
+            ).only(
+                *LOADED_FIELDS
+            )[:num - len(communities)])
+        return communities
@@ -0,0 +1,58 @@
+"""Compares the link extractor with the former regexp on the texts of the latest posts:
+python -m datacollector.linkbench [number of posts]"""
+import re
+import sys
+import time
+
+from datacollector.utils.links import find_links
+from datacollector.utils.tld import LATIN_TLD_LIST, CYRILLIC_TLD_LIST
+
+
+DEFAULT_POSTS_NUM = 10000
+
+# the former regexp of WallUpdater, it contains the alternation of all the TLDs
+REFERENCE_REGEXP = re.compile(
+    r'''((?i:https://)?)'''
+    r'''(@)?'''
+    r'''((?:[-_0-9a-zA-Zа-яёґєіїА-ЯЁҐЄІЇ]+\.)+)'''
+    r'''((?i:{}))'''.format('|'.join(sorted(LATIN_TLD_LIST + CYRILLIC_TLD_LIST, reverse=True))) +
+    r'''(?![-0-9a-zA-Zа-яА-Я])'''
+    r'''([/?#][-_.,/\\+=;:"'~!@#$%&?<>0-9a-zA-Zа-яёґєіїА-ЯЁҐЄІЇ]*)?'''
+)
+
+
+def load_texts(num):
+    from communities.models import Post
+    texts = []
+    for content in Post.objects.order_by('-published_at').values_list('content', flat=True)[:num]:
+        texts.extend(item.get('text', '') for item in content)
+    return texts
+
+
+def measure(fn, texts):
+    started = time.perf_counter()
+    results = [fn(text) for text in texts]
+    return time.perf_counter() - started, results
+
+
+def main(num):
+    texts = load_texts(num)
+    size = sum(len(text) for text in texts)
+    print('{0} texts, {1} characters'.format(len(texts), size))
+
+    reference_time, expected = measure(REFERENCE_REGEXP.findall, texts)
+    time_, found = measure(find_links, texts)
+    mismatches = [text for text, a, b in zip(texts, expected, found) if a != b]
+
+    print('regexp with TLD alternation: {0:.3f} s'.format(reference_time))
+    print('TLD set lookup:              {0:.3f} s'.format(time_))
+    print('speedup: {0:.1f}x, links: {1}, mismatches: {2}'.format(
+        reference_time / time_, sum(map(len, found)), len(mismatches)))
+    for text in mismatches[:10]:
+        print(repr(text))
+
+
+if __name__ == '__main__':
+    import django
+    django.setup()
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_POSTS_NUM)
@@ -1,25 +1,65 @@
+import argparse
+import asyncio
 import logging
+import signal
 
 import django
 django.setup()
 
 from datacollector.vkapi import VkApi
+from datacollector.aiovkapi import AsyncVkApi
 from datacollector.commupdater import CommunitiesUpdater
-from datacollector.wallupdater import WallUpdater
+from datacollector.wallupdater import WallUpdater, PARSE_PROCESSES
 
 
-def main():
+def main(parse_processes=PARSE_PROCESSES):
     logger = logging.getLogger('datacollector')
     logger.info('started')
     try:
         va = VkApi()
         cu = CommunitiesUpdater(va)
-        wu = WallUpdater(va)
+        wu = WallUpdater(va, parse_processes=parse_processes)
         cu.start()
         wu.start()
     except Exception as err:
         logger.exception(err)
 
 
+def main_async():
+    """Runs both updaters as coroutines on one event loop until SIGINT or SIGTERM,
+    then the requests in flight are finished and written"""
+    logger = logging.getLogger('datacollector')
+    logger.info('started (asyncio)')
+    loop = asyncio.get_event_loop()
+    try:
+        va = AsyncVkApi()
+        cu = CommunitiesUpdater(va)
+        wu = WallUpdater(va)
+
+        def stop():
+            logger.info('stopping')
+            cu.stop()
+            wu.stop()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop)
+        loop.run_until_complete(asyncio.gather(cu.run_async(), wu.run_async()))
+        va.close()
+        logger.info('stopped')
+    except Exception as err:
+        logger.exception(err)
+    finally:
+        loop.close()
+
+
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--asyncio', action='store_true', help='run the updaters as coroutines on one event loop')
+    parser.add_argument('--parse-processes', type=int, default=PARSE_PROCESSES,
+                        help='the worker processes parsing the walls, 0 means the wall updater thread parses them '
+                             '(not used with --asyncio)')
+    args = parser.parse_args()
+    if args.asyncio:
+        main_async()
+    else:
+        main(args.parse_processes)
@@ -0,0 +1,68 @@
+import asyncio
+from datetime import timedelta as TimeDelta
+from unittest.mock import patch
+
+from django.test import SimpleTestCase
+from django.utils import timezone
+
+from ..aiovkapi import TokenBucket, RateScheduler, METHOD_CLASS_WALL
+from ..vkapi import Token
+
+
+class TokenBucketTest(SimpleTestCase):
+
+    def test_reserved_slots_are_queued(self):
+        with patch('time.monotonic', return_value=100):
+            bucket = TokenBucket(rate=2, capacity=1)
+        self.assertEqual(bucket.reserve(100), 0)
+        self.assertEqual(bucket.reserve(100), 0.5)
+        self.assertEqual(bucket.reserve(100), 1)
+        self.assertEqual(bucket.delay(101), 0.5)
+
+
+class RateSchedulerTest(SimpleTestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_tokens_are_used_in_turn(self):
+        scheduler = RateScheduler([Token('a'), Token('b')])
+        with patch('asyncio.sleep', side_effect=self._no_sleep), patch('time.monotonic', return_value=10 ** 6):
+            keys = [self.loop.run_until_complete(scheduler.acquire()).key for _ in range(4)]
+        self.assertEqual(sorted(keys[:2]), ['a', 'b'])
+        self.assertEqual(sorted(keys[2:]), ['a', 'b'])
+
+    def test_wall_requests_take_default_slots_too(self):
+        scheduler = RateScheduler([Token('a')], rates={'default': (2, 1), METHOD_CLASS_WALL: (0.1, 1)})
+        delays = []
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        with patch('asyncio.sleep', side_effect=sleep), patch('time.monotonic', return_value=10 ** 6):
+            self.loop.run_until_complete(scheduler.acquire(METHOD_CLASS_WALL))
+            self.loop.run_until_complete(scheduler.acquire())
+            self.loop.run_until_complete(scheduler.acquire(METHOD_CLASS_WALL))
+        self.assertEqual(delays, [0, 0.5, 10])
+
+    def test_token_in_cooldown_is_not_used(self):
+        a, b = Token('a'), Token('b')
+        a.available_at = timezone.now() + TimeDelta(hours=1)
+        b.delay_scale = 2
+        scheduler = RateScheduler([a, b], rates={'default': (2, 1)})
+        delays = []
+
+        async def sleep(delay):
+            delays.append(delay)
+
+        with patch('asyncio.sleep', side_effect=sleep), patch('time.monotonic', return_value=10 ** 6):
+            keys = [self.loop.run_until_complete(scheduler.acquire()).key for _ in range(2)]
+        self.assertEqual(keys, ['b', 'b'])
+        self.assertEqual(delays, [0, 1])
+
+    @staticmethod
+    async def _no_sleep(delay):
+        pass
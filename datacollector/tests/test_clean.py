@@ -0,0 +1,46 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from communities.models import Community, Post
+from ..clean import ChunkedDeleter
+
+
+class ChunkedDeleterTest(TestCase):
+
+    def setUp(self):
+        Community.objects.create(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        params = dict(community_id=1, published_at=timezone.now(), checked_at=timezone.now(),
+                      content=[], likes=0, shares=0, comments=0, marked_as_ads=False)
+        for vkid in range(1, 6):
+            Post.objects.create(vkid=vkid, links=vkid % 2, **params)
+
+    def test_rows_are_deleted_by_batches(self):
+        deleter = ChunkedDeleter(Post.objects.filter(links=1), key_fields=Post.PRIMARY_KEY_COLUMNS,
+                                 batch_size=2, pause=0)
+        self.assertEqual(deleter.run(), 3)
+        self.assertEqual(deleter.checkpoint, Post.build_id(1, 5))
+        self.assertQuerysetEqual(Post.objects.order_by('vkid'), [2, 4], lambda p: p.vkid)
+
+    def test_run_continues_from_checkpoint(self):
+        deleter = ChunkedDeleter(Post.objects.all(), key_fields=Post.PRIMARY_KEY_COLUMNS, batch_size=2, pause=0)
+        deleter.checkpoint = Post.build_id(1, 4)
+        self.assertEqual(deleter.run(), 2)
+        self.assertQuerysetEqual(Post.objects.order_by('vkid'), [1, 2, 3], lambda p: p.vkid)
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_checkpoint_is_kept_in_cache(self):
+        deleter = ChunkedDeleter(Post.objects.all(), key_fields=Post.PRIMARY_KEY_COLUMNS, batch_size=2, pause=0,
+                                 checkpoint_key='posts')
+        with patch('datacollector.clean.logger.info', side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, deleter.run)
+        self.assertEqual(cache.get('datacollector:clean:checkpoint:posts'), Post.build_id(1, 2))
+
+        deleter = ChunkedDeleter(Post.objects.all(), key_fields=Post.PRIMARY_KEY_COLUMNS, batch_size=2, pause=0,
+                                 checkpoint_key='posts')
+        cache.set('datacollector:clean:checkpoint:posts', Post.build_id(1, 4))
+        self.assertEqual(deleter.run(), 2)
+        self.assertQuerysetEqual(Post.objects.order_by('vkid'), [3], lambda p: p.vkid)
+        self.assertIsNone(cache.get('datacollector:clean:checkpoint:posts'))
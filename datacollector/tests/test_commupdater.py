@@ -1,11 +1,17 @@
+import asyncio
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import timedelta as TimeDelta
 from unittest.mock import Mock, patch
 
 from django.test import TestCase
 from django.utils import timezone
 
-from communities.models import Community
-from ..commupdater import CommunitiesUpdater, VkApiParsingError, COMMUNITY_UPDATE_PERIOD
+from communities.models import Community, CommunityHistory
+from ..commupdater import (
+    CommunitiesUpdater, VkApiParsingError, COMMUNITY_UPDATE_PERIOD, FAST_COMMUNITY_UPDATE_PERIOD,
+    SLOW_COMMUNITY_UPDATE_PERIOD, DORMANT_COMMUNITY_UPDATE_PERIOD
+)
 
 
 class CommunitiesUpdaterTest(TestCase):
@@ -15,19 +21,95 @@ class CommunitiesUpdaterTest(TestCase):
         cu._communities_buffer = [Mock()] * 3
         with patch('datacollector.commupdater.COMMUNITIES_PER_REQUEST', new=3),\
                 patch.object(cu, '_request') as _request,\
-                patch.object(cu, '_update_community') as _update_community:
+                patch.object(cu, '_update_community') as _update_community,\
+                patch.object(cu, '_write_communities'):
             _request.return_value = dict()
             _update_community.side_effect = [Mock(), VkApiParsingError, Mock()]
             cu._update_communities()
             self.assertEqual(_update_community.call_count, 3)
 
+    def test_pipelined_responses_are_written_in_order(self):
+        vk_api = Mock()
+        vk_api.get_communities.side_effect = lambda ids: [{'id': id_} for id_ in ids]
+        cu = CommunitiesUpdater(vk_api, requests_in_flight=2)
+        cu._fetcher = ThreadPoolExecutor(max_workers=2)
+        cu._communities_buffer = [Community(vkid=vkid) for vkid in (1, 2, 3)]
+        with patch('datacollector.commupdater.COMMUNITIES_PER_REQUEST', new=1),\
+                patch.object(cu, '_prefetch_communities'),\
+                patch.object(cu, '_save_communities') as _save_communities:
+            for _ in range(3):
+                cu._loop_pipelined()
+            self.assertLessEqual(len(cu._pipeline), 1)
+            cu._write_pipeline(0)
+            cu._fetcher.shutdown()
+        self.assertEqual(cu._communities_buffer, [])
+        self.assertEqual([call[0][1] for call in _save_communities.call_args_list],
+                         [{1: {'id': 1}}, {2: {'id': 2}}, {3: {'id': 3}}])
+
+    def test_async_requests_are_in_flight_at_once(self):
+        in_flight = []
+        max_in_flight = []
+
+        async def get_communities(ids):
+            in_flight.append(ids)
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(ids)
+            return [{'id': id_} for id_ in ids]
+
+        vk_api = Mock()
+        vk_api.get_communities.side_effect = get_communities
+        cu = CommunitiesUpdater(vk_api, requests_in_flight=2)
+        cu._communities_buffer = [Community(vkid=vkid) for vkid in range(1, 7)]
+        saved = []
+
+        async def run():
+            cu._slots = asyncio.Semaphore(2)
+            cu._write_lock = asyncio.Lock()
+            for _ in range(3):
+                await cu._loop_async()
+            await cu._wait_pipeline_async()
+
+        loop = asyncio.new_event_loop()
+        with patch('datacollector.commupdater.COMMUNITIES_PER_REQUEST', new=2),\
+                patch('datacollector.commupdater.COMMUNITIES_BUFFER_MIN_LENGTH', new=0),\
+                patch.object(cu, '_save_communities', side_effect=lambda comms, data: saved.extend(data)):
+            loop.run_until_complete(run())
+        loop.close()
+        self.assertEqual(max(max_in_flight), 2)
+        self.assertEqual(sorted(saved), list(range(1, 7)))
+        self.assertEqual(cu._pipeline, deque())
+
+    def test_only_changed_fields_are_written(self):
+        dt = timezone.now()
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, age_limit=Community.AGELIMIT_NONE,
+                           verified=False, followers=10, checked_at=dt)
+        for vkid in (1, 2):
+            comm = Community(vkid=vkid, name='comm{}'.format(vkid), **other_attrs)
+            comm.content_hash = comm.calculate_content_hash()
+            comm.save()
+        data = dict(type='page', verified=0, age_limits=1, members_count=10)
+        cu = CommunitiesUpdater(None)
+        cu._load_communities()
+        cu._check_time = dt + TimeDelta(hours=1)
+        with patch.object(Community.objects, 'bulk_update', wraps=Community.objects.bulk_update) as bulk_update:
+            cu._save_communities(cu._communities_buffer, {1: dict(id=1, name='comm1', **data),
+                                                          2: dict(id=2, name='new name', **data)})
+        self.assertEqual(sorted(call[0][1] for call in bulk_update.call_args_list), [
+            ('checked_at', 'next_check_at'),
+            ('checked_at', 'next_check_at', 'content_hash') + Community.CONTENT_FIELDS,
+        ])
+        self.assertEqual(Community.objects.get(vkid=2).name, 'new name')
+        self.assertEqual(Community.objects.filter(checked_at=cu._check_time).count(), 2)
+        self.assertEqual(CommunityHistory.objects.count(), 2)
+
     def test_load_communities(self):
         other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
         dt = timezone.now()
-        Community.objects.create(vkid=1, checked_at=dt + TimeDelta(hours=2), **other_attrs),
-        Community.objects.create(vkid=2, checked_at=dt, **other_attrs),
+        Community.objects.create(vkid=1, next_check_at=dt + TimeDelta(hours=2), **other_attrs),
+        Community.objects.create(vkid=2, next_check_at=dt, **other_attrs),
         Community.objects.create(vkid=3, **other_attrs),
-        Community.objects.create(vkid=4, checked_at=dt + TimeDelta(hours=1), **other_attrs),
+        Community.objects.create(vkid=4, next_check_at=dt + TimeDelta(hours=1), **other_attrs),
         cu = CommunitiesUpdater(None)
         with patch('datacollector.commupdater.COMMUNITIES_BUFFER_MAX_LENGTH', new=3):
             cu._load_communities()
@@ -36,12 +118,94 @@ class CommunitiesUpdaterTest(TestCase):
                 [3, 2, 4]
             )
 
+    def test_buffer_is_extended_after_keyset(self):
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        dt = timezone.now()
+        for vkid, next_check_at in ((1, dt), (2, dt), (3, None), (4, dt - TimeDelta(hours=1))):
+            Community.objects.create(vkid=vkid, next_check_at=next_check_at, **other_attrs)
+        cu = CommunitiesUpdater(None)
+        with patch('datacollector.commupdater.COMMUNITIES_BUFFER_MAX_LENGTH', new=2):
+            cu._load_communities()
+            self.assertEqual([c.vkid for c in cu._communities_buffer], [3, 4])
+            Community.objects.filter(vkid=3).update(next_check_at=dt + TimeDelta(days=1))
+            cu._communities_buffer = []
+            cu._extend_buffer()
+            self.assertEqual([c.vkid for c in cu._communities_buffer], [1, 2])
+            cu._communities_buffer = []
+            cu._extend_buffer()
+            self.assertEqual([c.vkid for c in cu._communities_buffer], [3])
+
+    def test_page_is_prefetched_in_background(self):
+        dt = timezone.now()
+        cu = CommunitiesUpdater(None)
+        cu._loader = Mock()
+        cu._loader.submit.return_value = page = Future()
+        cu._communities_buffer = [Community(vkid=1, next_check_at=dt)]
+        with patch('datacollector.commupdater.COMMUNITIES_BUFFER_MIN_LENGTH', new=2),\
+                patch('datacollector.commupdater.COMMUNITIES_BUFFER_MAX_LENGTH', new=3):
+            cu._prefetch_communities()
+            self.assertEqual(cu._loader.submit.call_args, [(cu._load_page, 2, 0, None)])
+            cu._prefetch_communities()
+            page.set_result([Community(vkid=2, next_check_at=dt)])
+            cu._prefetch_communities()
+        self.assertEqual([c.vkid for c in cu._communities_buffer], [1, 2])
+        self.assertEqual(cu._last_keyset, (dt, 2))
+        self.assertEqual(cu._loader.submit.call_count, 1)
+
     def test_sleep_until_check_begins(self):
         now = timezone.now()
         cu = CommunitiesUpdater(None)
         cu._communities_buffer = [Community(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE,
-                                  checked_at=now - COMMUNITY_UPDATE_PERIOD + TimeDelta(seconds=42))]
+                                  next_check_at=now + TimeDelta(seconds=42))]
         with patch('django.utils.timezone.now', return_value=now),\
                 patch.object(cu, '_sleep') as _sleep:
             cu._sleep_until_check_begins()
             self.assertEqual(_sleep.call_args, [(42,)])
+
+    def test_update_period_depends_on_growth(self):
+        cu = CommunitiesUpdater(None)
+        cu._check_time = timezone.now()
+        checked_at = cu._check_time - TimeDelta(days=1)
+
+        def period(old_followers=None, **attrs):
+            attrs.setdefault('deactivated', False)
+            comm = Community(vkid=1, ctype=Community.TYPE_PUBLIC_PAGE, **attrs)
+            return cu._update_period(comm, old_followers, checked_at)
+
+        self.assertEqual(period(followers=1000, growth_per_week=140), FAST_COMMUNITY_UPDATE_PERIOD)
+        self.assertEqual(period(followers=1000, old_followers=980), FAST_COMMUNITY_UPDATE_PERIOD)
+        self.assertEqual(period(followers=1000, growth_per_day=1), COMMUNITY_UPDATE_PERIOD)
+        self.assertEqual(period(followers=1000, growth_per_day=0), SLOW_COMMUNITY_UPDATE_PERIOD)
+        self.assertEqual(period(followers=100000, growth_per_day=0), COMMUNITY_UPDATE_PERIOD)
+        self.assertEqual(period(followers=None), DORMANT_COMMUNITY_UPDATE_PERIOD)
+        self.assertEqual(period(followers=1000, deactivated=True), DORMANT_COMMUNITY_UPDATE_PERIOD)
+
+    def test_new_communities_in_flight_are_not_loaded_again(self):
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        for vkid in (1, 2, 3):
+            Community.objects.create(vkid=vkid, **other_attrs)
+        cu = CommunitiesUpdater(None, requests_in_flight=2)
+        with patch('datacollector.commupdater.COMMUNITIES_BUFFER_MAX_LENGTH', new=2):
+            cu._load_communities()
+            self.assertEqual([c.vkid for c in cu._communities_buffer], [1, 2])
+            cu._pipeline.append((cu._communities_buffer, Future()))
+            cu._communities_buffer = []
+            cu._extend_buffer()
+        self.assertEqual([c.vkid for c in cu._communities_buffer], [3])
+
+    def test_communities_rescheduled_before_keyset_are_put_into_buffer(self):
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        dt = timezone.now()
+        for vkid, hours in ((1, -1), (2, 1), (3, 2), (4, 72)):
+            Community.objects.create(vkid=vkid, next_check_at=dt + TimeDelta(hours=hours), **other_attrs)
+        cu = CommunitiesUpdater(None)
+        cu._check_time = dt
+        data = dict(type='page', verified=0, age_limits=1, members_count=10)
+        with patch('datacollector.commupdater.COMMUNITIES_BUFFER_MAX_LENGTH', new=3),\
+                patch('datacollector.commupdater.COMMUNITIES_PER_REQUEST', new=2),\
+                patch.object(cu, '_request', return_value={1: dict(id=1, **data), 2: dict(id=2, **data)}),\
+                patch.object(cu, '_update_period', side_effect=[TimeDelta(minutes=90), TimeDelta(days=3)]):
+            cu._load_communities()
+            cu._update_communities()
+        self.assertEqual([c.vkid for c in cu._communities_buffer], [1, 3])
+        self.assertEqual(cu._communities_buffer[0].next_check_at, dt + TimeDelta(minutes=90))
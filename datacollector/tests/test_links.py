@@ -0,0 +1,16 @@
+import random
+
+from django.test import SimpleTestCase
+
+from ..linkbench import REFERENCE_REGEXP
+from ..utils.links import find_links
+
+
+class FindLinksTest(SimpleTestCase):
+
+    def test_same_results_as_reference_regexp(self):
+        pieces = list('abcxyzорфHTTPSs:/.@-_#?ёї 7\n') + ['.com', '.ru', '.рф', '.co', '.comx', '.org/', 'https://']
+        rnd = random.Random(42)
+        for _ in range(5000):
+            text = ''.join(rnd.choice(pieces) for _ in range(rnd.randint(0, 40)))
+            self.assertEqual(find_links(text), REFERENCE_REGEXP.findall(text), repr(text))
@@ -0,0 +1,170 @@
+from http.client import HTTPConnection
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from datetime import timedelta as TimeDelta
+from threading import Thread
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+
+from ..models import VkAccount
+from ..vkapi import (
+    VkApi, TryAgain, HttpsConnectionPool, HttpError, MAX_THROTTLED_REQUESTS, TOKENS_RELOAD_PERIOD, TOKEN_QUARANTINE,
+    MAX_TOKEN_COOLDOWN_WAIT
+)
+
+
+class VkApiTest(TestCase):
+
+    def setUp(self):
+        VkAccount.objects.create(password='password', api_token='token')
+        self.vkapi = VkApi()
+
+    def test_get_community_walls(self):
+        response = {
+            'response': [{'count': 1, 'items': [{'id': 1}]}, False, False, {'count': 0, 'items': []}],
+            'execute_errors': [
+                {'method': 'wall.get', 'error_code': 15, 'error_msg': 'Access denied'},
+                {'method': 'wall.get', 'error_code': 10, 'error_msg': 'Internal server error'},
+            ]
+        }
+        with patch('time.sleep'), patch.object(self.vkapi, '_request', return_value=response):
+            walls = self.vkapi.get_community_walls([1, 2, 3, 4])
+        self.assertEqual(walls, {1: [{'id': 1}], 2: None, 4: []})
+
+    def test_get_community_walls_raises_try_again_on_error(self):
+        response = {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+        with patch('time.sleep'), patch.object(self.vkapi, '_request', return_value=response):
+            with self.assertRaises(TryAgain):
+                self.vkapi.get_community_walls([1, 2])
+
+    def test_throttled_token_is_slowed_down(self):
+        token, = self.vkapi._tokens
+        throttled = {'error': {'error_code': 9, 'error_msg': 'Flood control'}}
+        with patch('time.sleep'), patch.object(self.vkapi, '_request', return_value=throttled):
+            for _ in range(2):
+                with self.assertRaises(TryAgain):
+                    self.vkapi.get_communities([1])
+        self.assertEqual(token.delay_scale, 4)
+        self.assertGreater(token.available_at, timezone.now())
+        with patch('time.sleep'), patch.object(self.vkapi, '_request', return_value={'response': []}):
+            self.vkapi.get_communities([1])
+        self.assertEqual((token.throttled, token.delay_scale, token.errors[9]), (0, 3.9, 2))
+        for _ in range(MAX_THROTTLED_REQUESTS):
+            self.vkapi._on_token_error(token, 9)
+        self.assertGreater(token.available_at, timezone.now() + TimeDelta(minutes=30))
+
+    def test_quarantined_token_is_not_waited_for(self):
+        token, = self.vkapi._tokens
+        token.available_at = timezone.now() + TOKEN_QUARANTINE
+        with patch('time.sleep') as sleep, patch.object(self.vkapi, '_request') as _request:
+            for method, args in (('get_communities', [[1]]), ('get_community_walls', [[1]])):
+                with self.assertRaises(TryAgain):
+                    getattr(self.vkapi, method)(*args)
+        self.assertFalse(sleep.called)
+        self.assertFalse(_request.called)
+
+    def test_usual_delay_of_token_is_waited_for(self):
+        response = {'response': [{'count': 0, 'items': []}]}
+        with patch('time.sleep') as sleep, patch.object(self.vkapi, '_request', return_value=response):
+            for _ in range(2):
+                self.assertEqual(self.vkapi.get_community_walls([1]), {1: []})
+        self.assertGreater(max(delay for (delay,), _ in sleep.call_args_list), MAX_TOKEN_COOLDOWN_WAIT)
+
+    def test_token_with_auth_error_is_not_used(self):
+        VkAccount.objects.create(password='password', api_token='token2')
+        self.vkapi._load_tokens()
+        used = []
+
+        def request(method, access_token, **params):
+            used.append(access_token)
+            if access_token == 'token':
+                return {'error': {'error_code': 5, 'error_msg': 'User authorization failed'}}
+            return {'response': []}
+
+        with patch('time.sleep'), patch.object(self.vkapi, '_request', side_effect=request):
+            for _ in range(4):
+                try:
+                    self.vkapi.get_communities([1])
+                except TryAgain:
+                    pass
+        self.assertLessEqual(used.count('token'), 1)
+
+    def test_tokens_are_reloaded(self):
+        token, = self.vkapi._tokens
+        token.delay_scale = 2
+        VkAccount.objects.create(password='password', api_token='token2')
+        self.assertFalse(self.vkapi._refresh_tokens())
+        self.vkapi._tokens_loaded_at -= TOKENS_RELOAD_PERIOD
+        self.assertTrue(self.vkapi._refresh_tokens())
+        self.assertEqual({t.key: t.delay_scale for t in self.vkapi._tokens}, {'token': 2, 'token2': 1})
+        VkAccount.objects.filter(api_token='token').update(enabled=False)
+        self.vkapi._load_tokens()
+        self.assertEqual([t.key for t in self.vkapi._tokens], ['token2'])
+
+    def test_walls_script(self):
+        self.assertEqual(
+            VkApi._walls_script([1, 2]),
+            'return ['
+            'API.wall.get({"owner_id": -1, "offset": 0, "count": 100, "filter": "all"}),'
+            'API.wall.get({"owner_id": -2, "offset": 0, "count": 100, "filter": "all"})'
+            '];'
+        )
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = 500 if self.path == '/error' else 200
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpsConnectionPoolTest(SimpleTestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+        self.pool = HttpsConnectionPool(connection_factory=lambda: HTTPConnection('127.0.0.1', port, timeout=5))
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_is_reused(self):
+        self.assertEqual(self.pool.post('/method/a', b'a=1'), b'a=1')
+        self.assertEqual(self.pool.post('/method/b', b'b=2'), b'b=2')
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['idle'], 1)
+
+    def test_idle_connection_is_evicted(self):
+        self.pool.post('/method/a', b'a=1')
+        with patch('time.monotonic', return_value=10 ** 9):
+            self.pool.post('/method/a', b'a=1')
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['evicted'], 1)
+
+    def test_reconnect_when_idle_connection_is_broken(self):
+        self.pool.post('/method/a', b'a=1')
+        self.pool._idle[0][0].sock.close()
+        self.assertEqual(self.pool.post('/method/a', b'a=2'), b'a=2')
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 2)
+        self.assertEqual(stats['failed'], 1)
+
+    def test_http_error(self):
+        with self.assertRaises(HttpError):
+            self.pool.post('/error', b'')
+        self.assertEqual(self.pool.stats()['idle'], 1)
@@ -0,0 +1,32 @@
+from django.test import SimpleTestCase
+
+from communities.models import Community
+from ..wallschedule import WallSchedule
+
+
+class WallScheduleTest(SimpleTestCase):
+
+    def setUp(self):
+        self.schedule = WallSchedule()
+        for vkid, followers, due in ((1, 10, 200), (2, 20, 100), (3, 30, 100), (4, 40, 300)):
+            self.schedule.push(Community(vkid=vkid, followers=followers), due)
+
+    def test_communities_are_popped_by_due_time_then_by_followers(self):
+        self.assertEqual([c.vkid for c in self.schedule.pop(3, until=250)], [3, 2, 1])
+        self.assertEqual(self.schedule.pop(3, until=250), [])
+        self.assertEqual(self.schedule.next_due(), 300)
+        self.assertEqual(len(self.schedule), 1)
+
+    def test_removed_and_pushed_again(self):
+        self.schedule.remove(3)
+        self.schedule.push(Community(vkid=1, followers=10), 50)
+        self.assertNotIn(3, self.schedule)
+        self.assertEqual(self.schedule.due_of(1), 50)
+        self.assertEqual([c.vkid for c in self.schedule.pop(10, until=1000)], [1, 2, 4])
+
+    def test_pushed_again_with_same_due_time_and_followers(self):
+        for _ in range(3):
+            self.schedule.push(Community(vkid=2, followers=20), 100)
+        self.schedule.push(Community(vkid=5, followers=20), 100)
+        self.assertEqual(len(self.schedule), 5)
+        self.assertEqual([c.vkid for c in self.schedule.pop(10, until=100)], [3, 2, 5])
@@ -1,13 +1,18 @@
+import asyncio
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta as TimeDelta
 from unittest.mock import Mock, patch
 
+from django.db import DatabaseError
 from django.test import SimpleTestCase, TestCase
 from django.utils import timezone
 
 from ..wallupdater import (
     WallUpdater, MIN_PERIOD_FOR_STATS, VkApiParsingError,
-    MIN_POSTS_NUM_FOR_STATS, MIN_LIFETIME_OF_POST
+    MIN_POSTS_NUM_FOR_STATS, MIN_LIFETIME_OF_POST, LIVE_POST_PERIOD, MIN_POSTS_PER_WALL, WALL_UPDATE_PERIOD,
+    MIN_WALL_UPDATE_PERIOD, USUAL_VIEWS_GROWTH, USUAL_LIKES_GROWTH, TryAgain
 )
 from communities.models import Community, Post
 
@@ -24,16 +29,161 @@ class WallUpdaterTest(TestCase):
             self.assertFalse(wu._period_for_statistics_is_over())
 
     def test_parsing_error_does_not_stop_work(self):
-        vk_api = Mock()
-        vk_api.get_community_wall.return_value = [{'id': None}] * 3
-        wu = WallUpdater(vk_api)
-        with patch.object(wu, '_current_community') as _current_community,\
-                patch.object(wu, '_parse_post') as _parse_post:
-            _current_community.return_value = Mock(wall_checked_at=None)
+        wu = WallUpdater(None)
+        with patch.object(wu, '_parse_post') as _parse_post:
             _parse_post.side_effect = [42, VkApiParsingError(), 42]
-            posts = wu._get_new_posts()
+            posts = wu._get_new_posts(Mock(wall_checked_at=None, last_post_vkid=None), [{'id': None}] * 3)
         self.assertEquals(posts, [42, 42])
 
+    def test_walls_with_temporary_errors_are_requested_again(self):
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=0)
+        vk_api = Mock()
+        vk_api.get_community_walls.return_value = {1: [], 3: None}
+        wu = WallUpdater(vk_api)
+        for vkid in (1, 2, 3, 4):
+            wu._schedule.push(Community(vkid=vkid, **other_attrs), vkid)
+        wu._period_start = wu._reloaded_at = timezone.now()
+        with patch('datacollector.wallupdater.WALLS_PER_REQUEST', new=3),\
+                patch.object(wu, '_save_posts'),\
+                patch.object(wu, '_write_wall_stats', return_value=({}, {})):
+            wu._loop()
+        self.assertEqual(vk_api.get_community_walls.call_args, [([1, 2, 3], {1: 100, 2: 100, 3: 100})])
+        self.assertEqual([c.vkid for c in wu._schedule.pop(10, time.time())], [2, 4])
+
+    def test_stopped_updater_does_not_wait_for_token(self):
+        vk_api = Mock()
+        vk_api.get_community_walls.side_effect = TryAgain
+        wu = WallUpdater(vk_api)
+        wu.stop()
+        with self.assertRaises(TryAgain):
+            wu._get_walls([Community(vkid=1)])
+
+    def test_pipelined_walls_are_parsed_and_written(self):
+        post_data = {'id': 7, 'date': 1500000000, 'from_id': -1, 'owner_id': -1, 'text': 'see test.com',
+                     'likes': {'count': 1}, 'reposts': {'count': 0}, 'comments': {'count': 0}}
+        vk_api = Mock()
+        vk_api.get_community_walls.return_value = {1: [post_data, {'id': 8}]}
+        wu = WallUpdater(vk_api)
+        wu._parser = ThreadPoolExecutor(max_workers=1)
+        wu._schedule.push(Community(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=0), 0)
+        wu._period_start = wu._reloaded_at = timezone.now()
+        with patch.object(wu, '_write_walls') as _write_walls:
+            wu._loop_pipelined()
+            wu._parser.shutdown()
+            while wu._pipeline:
+                wu._write_parsed_walls(*wu._pipeline.popleft())
+        self.assertGreater(wu._schedule.next_due(), time.time())
+        (communities, comm2posts), _ = _write_walls.call_args
+        self.assertEqual([c.vkid for c in communities], [1])
+        self.assertEqual([(p.vkid, p.links, p.likes) for p in comm2posts[1]], [(7, 1, 1)])
+
+    def test_pipelined_walls_are_rescheduled_after_write(self):
+        vk_api = Mock()
+        vk_api.get_community_walls.return_value = {1: []}
+        wu = WallUpdater(vk_api)
+        wu._parser = ThreadPoolExecutor(max_workers=1)
+        wu._period_start = wu._reloaded_at = timezone.now()
+
+        def write_walls(communities, comm2posts):
+            communities[0].wall_update_period = MIN_WALL_UPDATE_PERIOD
+
+        for side_effect in (write_walls, DatabaseError):
+            wu._schedule.push(Community(vkid=1, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=0), 0)
+            with patch.object(wu, '_write_walls', side_effect=side_effect):
+                wu._loop_pipelined()
+                self.assertFalse(wu._schedule)  # in the pipeline
+                try:
+                    while wu._pipeline:
+                        wu._write_parsed_walls(*wu._pipeline.popleft())
+                except DatabaseError:
+                    pass
+            if side_effect is write_walls:
+                self.assertLess(wu._schedule.next_due(), time.time() + MIN_WALL_UPDATE_PERIOD + 60)
+                wu._schedule.clear()
+            else:
+                self.assertEqual(wu._schedule.next_due(), 0)  # requested again
+        wu._parser.shutdown()
+
+    def test_communities_are_not_changed_when_write_fails(self):
+        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=0)
+        communities = [Community.objects.create(vkid=vkid, **other_attrs) for vkid in (1, 2)]
+        wu = WallUpdater(None)
+        wu._check_time = timezone.now()
+        comm2posts = {
+            comm.vkid: [Post(community=comm, vkid=7, published_at=wu._check_time, checked_at=wu._check_time,
+                             content=[], likes=0, shares=0, comments=0, marked_as_ads=False, links=0)]
+            for comm in communities
+        }
+        with patch.object(wu, '_desired_update_period', side_effect=[MIN_WALL_UPDATE_PERIOD, DatabaseError]):
+            with self.assertRaises(DatabaseError):
+                wu._write_walls(communities, comm2posts)
+        self.assertEqual([(c.last_post_vkid, c.wall_checked_at) for c in communities], [(None, None)] * 2)
+        self.assertFalse(Post.objects.exists())
+        self.assertFalse(Community.objects.filter(last_post_vkid__isnull=False).exists())
+        self.assertEqual(wu._recent_posts, {})
+
+        wu._write_walls(communities, comm2posts)
+        self.assertEqual([c.last_post_vkid for c in communities], [7, 7])
+        self.assertEqual(list(wu._recent_posts[1]), [7])
+        self.assertEqual(Community.objects.filter(last_post_vkid=7).count(), 2)
+
+    def test_async_requests_are_in_flight_at_once(self):
+        in_flight = []
+        max_in_flight = []
+
+        async def get_community_walls(ids, counts):
+            in_flight.append(ids)
+            max_in_flight.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(ids)
+            return {id_: [] for id_ in ids}
+
+        vk_api = Mock()
+        vk_api.get_community_walls.side_effect = get_community_walls
+        wu = WallUpdater(vk_api, requests_in_flight=3)
+        for vkid in range(1, 9):
+            wu._schedule.push(Community(vkid=vkid, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=0), 0)
+        wu._period_start = wu._reloaded_at = timezone.now()
+        written = []
+
+        async def run():
+            wu._slots = asyncio.Semaphore(3)
+            wu._write_lock = asyncio.Lock()
+            for _ in range(4):
+                await wu._loop_async()
+            await wu._wait_requests_async()
+
+        loop = asyncio.new_event_loop()
+        with patch('datacollector.wallupdater.WALLS_PER_REQUEST', new=2),\
+                patch.object(wu, '_update_walls', side_effect=lambda communities, walls: written.extend(walls)):
+            loop.run_until_complete(run())
+        loop.close()
+        self.assertEqual(max(max_in_flight), 3)
+        self.assertEqual(sorted(written), list(range(1, 9)))
+        self.assertEqual(len(wu._schedule), 8)
+        self.assertGreater(wu._schedule.next_due(), time.time())
+
+    def test_only_new_and_live_posts_are_parsed(self):
+        wu = WallUpdater(None)
+        wu._check_time = timezone.now()
+        old = (wu._check_time - LIVE_POST_PERIOD - TimeDelta(hours=1)).timestamp()
+        live = (wu._check_time - LIVE_POST_PERIOD + TimeDelta(hours=1)).timestamp()
+        wall_data = [{'id': 5, 'date': old}, {'id': 4, 'date': live}, {'id': 3, 'date': old}]
+        with patch.object(wu, '_parse_post', side_effect=lambda comm, data: data['id']):
+            posts = wu._get_new_posts(Mock(wall_checked_at=None, last_post_vkid=4), wall_data)
+        self.assertEqual(posts, [5, 4])
+
+    def test_posts_per_wall(self):
+        now = timezone.now()
+        communities = [
+            Community(vkid=1),
+            Community(vkid=2, last_post_vkid=1, last_post_published_at=now - LIVE_POST_PERIOD * 2),
+            Community(vkid=3, last_post_vkid=1, last_post_published_at=now, posts_per_week=35),
+            Community(vkid=4, last_post_vkid=1, last_post_published_at=now, posts_per_week=350),
+        ]
+        counts = WallUpdater(None)._posts_per_wall(communities)
+        self.assertEqual(counts, {1: 100, 2: MIN_POSTS_PER_WALL, 3: 80, 4: 100})
+
     def test_wall_stats_calculation(self):
         check_time = timezone.now()
         comm = Community.objects.create(vkid=42, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
@@ -57,11 +207,41 @@ class WallUpdaterTest(TestCase):
         likes_per_view = self._median([p.likes / p.views for p in posts])
         wu = WallUpdater(None)
         wu._check_time = check_time
-        with patch.object(wu, '_current_community') as _current_community:
-            _current_community.return_value = comm
-            wu._update_wall_stats()
-            self.assertAlmostEqual(comm.views_per_post, views_per_post)
-            self.assertAlmostEqual(comm.likes_per_view, likes_per_view)
+        wu._update_wall_stats(comm)
+        self.assertAlmostEqual(comm.views_per_post, views_per_post)
+        self.assertAlmostEqual(comm.likes_per_view, likes_per_view)
+
+    def test_wall_stats_use_cached_and_parsed_posts(self):
+        check_time = timezone.now()
+        published_at = check_time - MIN_LIFETIME_OF_POST
+        comm = Community(vkid=42, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+        wu = WallUpdater(None)
+        wu._check_time = check_time
+        wu._recent_posts[42] = {
+            i: (published_at, check_time - TimeDelta(hours=1), 100, 1) for i in range(MIN_POSTS_NUM_FOR_STATS)
+        }
+        posts = [Post(vkid=0, published_at=published_at, checked_at=check_time, views=200, likes=10)]
+        wu._update_wall_stats(comm, posts)
+        self.assertIsNone(comm.views_per_post)  # the cached counters are too young
+
+        wu._recent_posts[42] = {i: (published_at, check_time, 100, 1) for i in range(MIN_POSTS_NUM_FOR_STATS)}
+        wu._update_wall_stats(comm, posts)
+        self.assertEqual(comm.views_per_post, 100)
+        self.assertEqual(comm.likes_per_view, 0.01)
+
+    def test_recent_posts_cache_is_limited_by_posts(self):
+        wu = WallUpdater(None)
+        published_at = timezone.now()
+        with patch('datacollector.wallupdater.RECENT_POSTS_CACHE_SIZE', new=5):
+            for comm_id, num in ((1, 2), (2, 2), (1, 3), (3, 2)):
+                wu._cache_recent_posts(comm_id, {i: (published_at, published_at, 0, 0) for i in range(num)})
+        self.assertEqual(list(wu._recent_posts), [1, 3])
+        self.assertEqual(wu._recent_posts_size, 5)
+
+    def test_median(self):
+        self.assertEqual(WallUpdater._median([3, 1, 2]), 2.0)
+        self.assertEqual(WallUpdater._median([4, 1, 2, 3]), 2.5)
+        self.assertEqual(WallUpdater._median([0.1, 0.2]), 0.1 + (0.2 - 0.1) * 0.5)
 
     @staticmethod
     def _median(seq):
@@ -92,11 +272,9 @@ class WallUpdaterTest(TestCase):
             ).save()
         wu = WallUpdater(None)
         wu._check_time = check_time
-        with patch.object(wu, '_current_community') as _current_community:
-            _current_community.return_value = comm
-            wu._update_wall_stats()
-            self.assertIsNone(comm.views_per_post)
-            self.assertIsNone(comm.likes_per_view)
+        wu._update_wall_stats(comm)
+        self.assertIsNone(comm.views_per_post)
+        self.assertIsNone(comm.likes_per_view)
 
     def test_load_accessible_communities(self):
         communities = [
@@ -108,61 +286,79 @@ class WallUpdaterTest(TestCase):
             Community.objects.create(vkid=6, deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=None),
         ]
         wu = WallUpdater(None)
-        wu._load_accessible_communities(len(communities))
         self.assertEqual(
-            sorted(c.vkid for c in wu._communities),
+            sorted(c.vkid for c in wu._load_accessible_communities(len(communities))),
             [1, 2]
         )
 
-    def test_priority_of_community_depends_on_followers_num(self):
-        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
-        communities = [
-            Community(vkid=1, followers=0, **other_attrs),
-            Community(vkid=2, followers=20, **other_attrs),
-            Community(vkid=3, followers=10, **other_attrs),
-        ]
-        self.assertEqual(
-            [c.vkid for c in sorted(communities, key=WallUpdater._priority_of_community)],
-            [1, 3, 2]
-        )
-
     def test_new_communities_have_highest_priority(self):
-        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE, followers=0)
         dt = timezone.now()
-        communities = [
-            Community(vkid=1, wall_checked_at=dt, **other_attrs),
-            Community(vkid=2, **other_attrs),
-            Community(vkid=3, wall_checked_at=dt, **other_attrs),
-        ]
-        self.assertEqual(
-            sorted(communities, key=WallUpdater._priority_of_community)[-1].vkid,
-            2
-        )
+        wu = WallUpdater(None)
+        self.assertEqual(wu._due_time_of(Community(vkid=1)), 0)
+        self.assertEqual(wu._due_time_of(Community(vkid=1, wall_checked_at=dt)), dt.timestamp() + WALL_UPDATE_PERIOD)
 
-    def test_update_time_is_more_important_than_followers_num(self):
-        other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
+    def test_update_period_depends_on_activity(self):
+        wu = WallUpdater(None)
+        wu._check_time = timezone.now()
+        day_ago = wu._check_time - TimeDelta(days=1)
+        quiet = wu._desired_update_period([], None)
+        posting = wu._desired_update_period([(day_ago, day_ago, 100, 1)] * 7, None)
+        growing = wu._desired_update_period([(day_ago, day_ago, 100, 1)] * 7, USUAL_VIEWS_GROWTH * 10)
+        liked = wu._desired_update_period([(day_ago, day_ago, 100, 1)] * 7, USUAL_VIEWS_GROWTH * 10,
+                                          USUAL_LIKES_GROWTH * 10)
+        self.assertEqual(quiet, WALL_UPDATE_PERIOD * 2)
+        self.assertLess(posting, quiet)
+        self.assertLess(growing, posting)
+        self.assertLess(liked, growing)
+        self.assertEqual(wu._desired_update_period([(day_ago, day_ago, 100, 1)] * 1000, None), MIN_WALL_UPDATE_PERIOD)
+
+    def test_growth_of_views_and_likes(self):
+        check_time = timezone.now()
+        previous = {1: (check_time, check_time - TimeDelta(hours=2), 100, 10), 2: (check_time, check_time, 0, 0)}
+        posts = [Post(vkid=vkid, checked_at=check_time, views=200, likes=12) for vkid in (1, 2, 3)]
+        self.assertEqual(WallUpdater._growth(previous, posts, 'views'), 0.5)
+        self.assertEqual(WallUpdater._growth(previous, posts, 'likes'), 0.1)
+        self.assertIsNone(WallUpdater._growth({}, posts, 'likes'))
+
+    def test_update_periods_are_scaled_to_throughput(self):
+        wu = WallUpdater(None)
         dt = timezone.now()
-        communities = [
-            Community(vkid=1, followers=0, wall_checked_at=dt + TimeDelta(hours=1), **other_attrs),
-            Community(vkid=2, followers=20, wall_checked_at=dt, **other_attrs),
-            Community(vkid=3, followers=10, wall_checked_at=dt + TimeDelta(hours=2), **other_attrs),
-        ]
-        self.assertEqual(
-            [c.vkid for c in sorted(communities, key=WallUpdater._priority_of_community)],
-            [3, 1, 2]
-        )
+        for vkid in range(10):
+            wu._schedule.push(Community(vkid=vkid, followers=0, wall_update_period=WALL_UPDATE_PERIOD // 2), 0)
+        wu._fit_periods_to_throughput(10)
+        self.assertAlmostEqual(wu._period_scale, 2, places=3)
+        comm = Community(vkid=1, wall_checked_at=dt, wall_update_period=WALL_UPDATE_PERIOD // 2)
+        self.assertAlmostEqual(wu._due_time_of(comm), dt.timestamp() + WALL_UPDATE_PERIOD, places=0)
 
-    def test_current_community_has_highest_priority(self):
+    def test_most_overdue_community_goes_first(self):
         other_attrs = dict(deactivated=False, ctype=Community.TYPE_PUBLIC_PAGE)
-        dt = timezone.now()
-        communities = [
-            Community.objects.create(vkid=1, followers=0, wall_checked_at=dt + TimeDelta(hours=1), **other_attrs),
-            Community.objects.create(vkid=2, followers=20, wall_checked_at=dt, **other_attrs),
-            Community.objects.create(vkid=3, followers=10, wall_checked_at=dt + TimeDelta(hours=2), **other_attrs),
-        ]
+        dt = timezone.now() - TimeDelta(seconds=WALL_UPDATE_PERIOD) - TimeDelta(hours=3)
+        Community.objects.create(vkid=1, followers=0, wall_checked_at=dt + TimeDelta(hours=1), **other_attrs)
+        Community.objects.create(vkid=2, followers=20, wall_checked_at=dt, **other_attrs)
+        Community.objects.create(vkid=3, followers=10, wall_checked_at=dt + TimeDelta(hours=2), **other_attrs)
+        Community.objects.create(vkid=4, followers=30, wall_checked_at=timezone.now(), **other_attrs)
+        wu = WallUpdater(None)
+        wu._reload_communities()
+        self.assertEqual([c.vkid for c in wu._schedule.pop(10, time.time())], [2, 1, 3])
+
+    def test_sync_communities(self):
+        other_attrs = dict(ctype=Community.TYPE_PUBLIC_PAGE, wall_checked_at=timezone.now())
+        for vkid in (1, 2):
+            Community.objects.create(vkid=vkid, deactivated=False, followers=10, checked_at=timezone.now(),
+                                     **other_attrs)
         wu = WallUpdater(None)
-        wu._load_accessible_communities(len(communities))
-        self.assertEqual(wu._current_community().vkid, 2)
+        with patch.object(wu, '_calculate_communities_per_period', return_value=2):
+            wu._reload_communities()
+        self.assertEqual(wu._min_followers, 10)
+        checked_at = timezone.now()
+        Community.objects.filter(vkid=1).update(deactivated=True, checked_at=checked_at)
+        Community.objects.create(vkid=3, deactivated=False, followers=20, checked_at=checked_at, **other_attrs)
+        Community.objects.create(vkid=4, deactivated=False, followers=5, checked_at=checked_at, **other_attrs)
+        wu._sync_communities()
+        self.assertNotIn(1, wu._schedule)
+        self.assertIn(2, wu._schedule)
+        self.assertIn(3, wu._schedule)
+        self.assertNotIn(4, wu._schedule)
 
     def test_content_attachments_parsing(self):
         data = """
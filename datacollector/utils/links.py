@@ -0,0 +1,53 @@
+import re
+
+from .tld import LATIN_TLD_LIST, CYRILLIC_TLD_LIST
+
+
+TLD_SET = frozenset(LATIN_TLD_LIST + CYRILLIC_TLD_LIST)
+
+# the protocol, "@" (to exclude emails) and the labels of a domain name followed by dots
+_CANDIDATE_REGEXP = re.compile(
+    r'''((?i:https://)?)'''
+    r'''(@)?'''
+    r'''((?:[-_0-9a-zA-Zа-яёґєіїА-ЯЁҐЄІЇ]+\.)+)'''
+)
+# all the TLDs consist of these symbols, so a TLD must be the whole run of them
+_TLD_REGEXP = re.compile(r'''[-0-9a-zA-Zа-яА-Я]+''')
+_PATH_REGEXP = re.compile(r'''[/?#][-_.,/\\+=;:"'~!@#$%&?<>0-9a-zA-Zа-яёґєіїА-ЯЁҐЄІЇ]*''')
+
+
+def find_links(text):
+    """Returns [(protocol, at, name, tld, path), ...] exactly as re.findall() with the regexp
+    which contains the alternation of all the TLDs, but looks up the TLD candidates in a set"""
+    links = []
+    pos = 0
+    while True:
+        candidate = _CANDIDATE_REGEXP.search(text, pos)
+        if candidate is None:
+            return links
+        link = _match_link(text, candidate)
+        if link is None:
+            pos = candidate.start() + 1
+        else:
+            links.append(link[0])
+            pos = link[1]
+
+
+def _match_link(text, candidate):
+    name_start = candidate.start(3)
+    name_end = candidate.end(3)
+    # as the regexp does, the name gives back its labels one by one until a TLD follows it
+    while name_end > name_start:
+        tld = _TLD_REGEXP.match(text, name_end)
+        if tld is not None and tld.group().lower() in TLD_SET:
+            path = _PATH_REGEXP.match(text, tld.end())
+            end = tld.end() if path is None else path.end()
+            return (
+                candidate.group(1),
+                candidate.group(2) or '',
+                text[name_start:name_end],
+                tld.group(),
+                '' if path is None else path.group()
+            ), end
+        name_end = text.rfind('.', name_start, name_end - 1) + 1
+    return None
@@ -1,23 +1,38 @@
 import json
 import logging
 import time
+from collections import Counter
 from datetime import timedelta as TimeDelta
-from threading import RLock
-from urllib.error import URLError
+from http.client import HTTPException, HTTPSConnection
+from threading import BoundedSemaphore, Lock, RLock
 from urllib.parse import urlencode
-from urllib.request import urlopen
 
 from django.utils import timezone
 
 from .models import VkAccount
 
 
+API_HOST = 'api.vk.com'
 HTTP_REQUEST_TIMEOUT = 60
+MAX_CONNECTIONS = 10
+MAX_CONNECTION_IDLE_TIME = 30
 MIN_NETWORK_ERRORS_BEFORE_ALARM = 30
 MIN_NETWORK_ERRORS_DURATION_BEFORE_ALARM = 60
 COMMUNITIES_PER_REQUEST = 500
+WALLS_PER_REQUEST = 25  # the limit of API calls inside one "execute" request
+MAX_POSTS_PER_WALL = 100
 REQUEST_DELAY_PER_TOKEN = 0.5
 REQUEST_DELAY_PER_TOKEN_FOR_WALL = 18
+TOKENS_RELOAD_PERIOD = TimeDelta(minutes=10)
+THROTTLING_ERRORS = (6, 9, 29)  # too many requests per second, flood control, rate limit reached
+AUTH_ERRORS = (5,)
+MAX_DELAY_SCALE = 16  # the delays of a token are doubled on throttling up to this scale
+DELAY_SCALE_DECREASE = 0.1  # and decreased by this after every successful request
+TOKEN_COOLDOWN = TimeDelta(seconds=1)  # doubled after every consecutive throttling
+MAX_TOKEN_COOLDOWN = TimeDelta(minutes=10)
+MAX_THROTTLED_REQUESTS = 10  # consecutive, the token is quarantined after them
+TOKEN_QUARANTINE = TimeDelta(hours=1)
+MAX_TOKEN_COOLDOWN_WAIT = 10  # seconds, a longer cooldown raises TryAgain, so a caller waiting for it can be stopped
 
 
 logger = logging.getLogger(__name__)
@@ -44,109 +59,361 @@ class TryAgain(Exception):
     pass
 
 
+class HttpError(Exception):
+    pass
+
+
 class Token:
     def __init__(self, api_key):
         self.key = api_key
         self.last_used = timezone.now()
         self.last_used_for_wall = timezone.now()
+        self.available_at = timezone.now()  # the end of a cooldown or a quarantine
+        self.delay_scale = 1.0
+        self.throttled = 0  # the number of consecutive throttled requests
+        self.errors = Counter()  # error code -> the number of errors
+
+    def on_success(self):
+        self.throttled = 0
+        self.delay_scale = max(1.0, self.delay_scale - DELAY_SCALE_DECREASE)
+
+    def on_error(self, code, now):
+        self.errors[code] += 1
+        if code in AUTH_ERRORS:
+            self._quarantine(now, 'error {0}'.format(code))
+        elif code in THROTTLING_ERRORS:
+            self.throttled += 1
+            self.delay_scale = min(MAX_DELAY_SCALE, self.delay_scale * 2)
+            if self.throttled >= MAX_THROTTLED_REQUESTS:
+                self._quarantine(now, '{0} throttled requests'.format(self.throttled))
+            else:
+                self.available_at = now + min(MAX_TOKEN_COOLDOWN, TOKEN_COOLDOWN * 2 ** (self.throttled - 1))
+
+    def _quarantine(self, now, reason):
+        logger.error('token=%s is quarantined after %s', self.key, reason)
+        self.available_at = now + TOKEN_QUARANTINE
+
+
+class HttpsConnectionPool:
+    """A bounded pool of keep-alive connections to one host, it is shared by threads.
+    The connections are made by connection_factory, so any HTTPConnection-like object fits."""
+
+    def __init__(self, host=API_HOST, max_connections=MAX_CONNECTIONS, max_idle_time=MAX_CONNECTION_IDLE_TIME,
+                 timeout=HTTP_REQUEST_TIMEOUT, connection_factory=None):
+        if connection_factory is None:
+            def connection_factory():
+                return HTTPSConnection(host, timeout=timeout)
+        self._connection_factory = connection_factory
+        self._max_idle_time = max_idle_time
+        self._semaphore = BoundedSemaphore(max_connections)
+        self._lock = Lock()
+        self._idle = []  # [(connection, the time it was released)]
+        self._stats = dict(created=0, reused=0, evicted=0, failed=0)
+
+    def post(self, path, body):
+        with self._semaphore:
+            conn = self._take_idle_connection()
+            if conn is not None:
+                try:
+                    return self._send(conn, path, body)
+                except (OSError, HTTPException) as err:
+                    # the server could have closed the idle connection
+                    logger.debug('reconnecting after %s', repr(err))
+            conn = self._connection_factory()
+            self._count('created')
+            return self._send(conn, path, body)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle))
+
+    def close(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+    def _take_idle_connection(self):
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, released_at = self._idle.pop()
+                if now - released_at < self._max_idle_time:
+                    self._stats['reused'] += 1
+                    return conn
+                conn.close()
+                self._stats['evicted'] += 1
+        return None
+
+    def _send(self, conn, path, body):
+        try:
+            conn.request('POST', path, body, {'Content-Type': 'application/x-www-form-urlencoded'})
+            resp = conn.getresponse()
+            data = resp.read()
+        except BaseException:
+            conn.close()
+            self._count('failed')
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        if resp.status != 200:
+            raise HttpError('HTTP status {0}'.format(resp.status))
+        return data
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
 
 
-class VkApi:
+class BaseVkApi:
+    """Builds requests and parses responses, the transport is up to subclasses"""
 
     def __init__(self):
         self._lock = RLock()
         self._tokens = set()
+        self._tokens_loaded_at = timezone.now()
         self._load_tokens()
         self._last_successful_request = timezone.now()
         self._network_errors_count = 0  # since the last successful request
 
+    def token_stats(self):
+        with self._lock:
+            return {
+                t.key: dict(available_at=t.available_at, delay_scale=t.delay_scale, errors=dict(t.errors))
+                for t in self._tokens
+            }
+
     def _load_tokens(self):
-        accounts = VkAccount.objects.filter(enabled=True)
-        for acc in accounts:
-            self._tokens.add(Token(acc.api_token))
-        if not self._tokens:
+        """The state of the tokens which are still enabled is kept"""
+        keys = {acc.api_token for acc in VkAccount.objects.filter(enabled=True)}
+        if not keys:
             raise RuntimeError('no tokens in the database')
+        with self._lock:
+            key2token = {t.key: t for t in self._tokens}
+            self._tokens = {key2token.get(key) or Token(key) for key in keys}
 
-    def get_communities(self, ids):
-        if len(ids) > COMMUNITIES_PER_REQUEST:
-            raise ValueError('too many ids = {0} (max=500)'.format(len(ids)))
+    def _refresh_tokens(self):
+        """Reloads the tokens once in TOKENS_RELOAD_PERIOD, returns True if they are reloaded"""
+        if not self._tokens_reload_is_due():
+            return False
+        self._load_tokens()
+        return True
 
+    def _tokens_reload_is_due(self):
+        """Returns True once in TOKENS_RELOAD_PERIOD, the caller is expected to reload the tokens then"""
         with self._lock:
-            token = min(self._tokens, key=lambda t: t.last_used)
-            elapsed = (timezone.now() - token.last_used).total_seconds()
-            delay = max(0, REQUEST_DELAY_PER_TOKEN - elapsed)
-            token.last_used = timezone.now() + TimeDelta(seconds=delay)
-        time.sleep(delay)
+            now = timezone.now()
+            if now - self._tokens_loaded_at < TOKENS_RELOAD_PERIOD:
+                return False
+            self._tokens_loaded_at = now
+            return True
+
+    def _choose_token(self, now, last_used):
+        """The least recently used one of the available tokens or the one which is available first"""
+        available = [t for t in self._tokens if t.available_at <= now]
+        if available:
+            return min(available, key=last_used)
+        return min(self._tokens, key=lambda t: t.available_at)
+
+    def _on_token_success(self, token):
+        with self._lock:
+            token.on_success()
 
-        response = self._request(
-            'groups.getById',
+    def _on_token_error(self, token, code):
+        with self._lock:
+            token.on_error(code, timezone.now())
+
+    @staticmethod
+    def _communities_params(ids):
+        if len(ids) > COMMUNITIES_PER_REQUEST:
+            raise ValueError('too many ids = {0} (max=500)'.format(len(ids)))
+        return dict(
             group_ids=','.join(str(id_) for id_ in ids),
             fields='type,is_closed,verified,age_limits,name,description,members_count,status',
-            access_token=token.key,
             v='5.74')
+
+    def _parse_communities(self, response, token):
         communities = response.get('response')
 
         if communities is None:
             err = VkApiResponseError.from_response(response)
             logger.warning('%s, token=%s', repr(err), token.key)
+            self._on_token_error(token, err.code)
             raise TryAgain()
 
+        self._on_token_success(token)
         return communities
 
-    def get_community_wall(self, id_):
-        with self._lock:
-            token = min(self._tokens, key=lambda t: t.last_used_for_wall)
-            elapsed = (timezone.now() - token.last_used_for_wall).total_seconds()
-            delay = max(0, REQUEST_DELAY_PER_TOKEN_FOR_WALL - REQUEST_DELAY_PER_TOKEN - elapsed)
-            token.last_used_for_wall = timezone.now() + TimeDelta(seconds=delay)
-        time.sleep(delay)
-        with self._lock:
-            token.last_used = timezone.now() + TimeDelta(seconds=REQUEST_DELAY_PER_TOKEN)
-        time.sleep(REQUEST_DELAY_PER_TOKEN)
-
-        response = self._request(
-            'wall.get',
+    @staticmethod
+    def _wall_params(id_, count=MAX_POSTS_PER_WALL):
+        return dict(
             owner_id='-{}'.format(id_),
             offset='0',
-            count='100',
+            count=str(count),
             filter='all',
-            access_token=token.key,
             v='5.74')
+
+    def _parse_wall(self, response, id_, token):
         results = response.get('response')
 
         if results is None:
             err = VkApiResponseError.from_response(response)
             logger.warning('%s, community(id=%s), token=%s', repr(err), id_, token.key)
             if err.code in (15, 18):  # ether there is no access or no content
+                self._on_token_success(token)
                 return None
+            self._on_token_error(token, err.code)
             raise TryAgain()
 
+        self._on_token_success(token)
         posts = results['items']
         if not posts:
             logger.warning('got an empty wall for the community(id=%s)', id_)
         return posts
 
+    @classmethod
+    def _walls_params(cls, ids, counts=None):
+        if len(ids) > WALLS_PER_REQUEST:
+            raise ValueError('too many ids = {0} (max={1})'.format(len(ids), WALLS_PER_REQUEST))
+        return dict(
+            code=cls._walls_script(ids, counts),
+            v='5.74')
+
+    @staticmethod
+    def _walls_script(ids, counts=None):
+        counts = counts or {}
+        calls = (
+            'API.wall.get({})'.format(json.dumps({
+                'owner_id': -id_,
+                'offset': 0,
+                'count': counts.get(id_, MAX_POSTS_PER_WALL),
+                'filter': 'all',
+            }))
+            for id_ in ids
+        )
+        return 'return [{}];'.format(','.join(calls))
+
+    def _parse_walls(self, response, ids, token):
+        results = response.get('response')
+
+        if results is None:
+            err = VkApiResponseError.from_response(response)
+            logger.warning('%s, token=%s', repr(err), token.key)
+            self._on_token_error(token, err.code)
+            raise TryAgain()
+
+        # the errors are listed in the same order as the failed calls
+        errors = iter(response.get('execute_errors', []))
+        walls = {}
+        throttling_code = None
+        for id_, res in zip(ids, results):
+            if not res:
+                err = VkApiResponseError.from_response({'error': next(errors, {})})
+                logger.warning('%s, community(id=%s), token=%s', repr(err), id_, token.key)
+                if err.code in (15, 18):  # ether there is no access or no content
+                    walls[id_] = None
+                elif err.code in THROTTLING_ERRORS:
+                    throttling_code = err.code
+                continue
+            posts = res['items']
+            if not posts:
+                logger.warning('got an empty wall for the community(id=%s)', id_)
+            walls[id_] = posts
+        if throttling_code is None:
+            self._on_token_success(token)
+        else:
+            self._on_token_error(token, throttling_code)
+        return walls
+
+    def _on_successful_request(self):
+        with self._lock:
+            self._last_successful_request = timezone.now()
+            self._network_errors_count = 0
+
+    def _on_network_error(self, err):
+        with self._lock:
+            logger.warning(repr(err))
+            duration = (timezone.now() - self._last_successful_request).total_seconds()
+            self._network_errors_count += 1
+            if self._network_errors_count >= MIN_NETWORK_ERRORS_BEFORE_ALARM and \
+                    duration >= MIN_NETWORK_ERRORS_DURATION_BEFORE_ALARM:
+                logger.error(
+                    '%s network errors since %s',
+                    self._network_errors_count,
+                    self._last_successful_request.strftime('%y-%m-%d %H:%M:%S'))
+                self._last_successful_request = timezone.now()
+                self._network_errors_count = 0
+
+
+class VkApi(BaseVkApi):
+
+    def __init__(self, http_pool=None):
+        super().__init__()
+        self._http = http_pool or HttpsConnectionPool()
+
+    def connection_stats(self):
+        return self._http.stats()
+
+    def get_communities(self, ids):
+        params = self._communities_params(ids)
+        self._refresh_tokens()
+
+        with self._lock:
+            now = timezone.now()
+            token = self._choose_token(now, lambda t: t.last_used)
+            elapsed = (now - token.last_used).total_seconds()
+            cooldown = (token.available_at - now).total_seconds()
+            delay = max(0, REQUEST_DELAY_PER_TOKEN * token.delay_scale - elapsed, cooldown)
+            if cooldown > MAX_TOKEN_COOLDOWN_WAIT:  # the usual delays are slept through
+                raise TryAgain()
+            token.last_used = now + TimeDelta(seconds=delay)
+        time.sleep(delay)
+
+        response = self._request('groups.getById', access_token=token.key, **params)
+        return self._parse_communities(response, token)
+
+    def get_community_wall(self, id_):
+        token = self._take_token_for_wall()
+        response = self._request('wall.get', access_token=token.key, **self._wall_params(id_))
+        return self._parse_wall(response, id_, token)
+
+    def get_community_walls(self, ids, counts=None):
+        """Returns a dict {id: posts}, where posts is None if the wall is unavailable.
+        The ids with other (temporary) errors are absent in the dict.
+        counts is an optional dict {id: the number of the latest posts to get}."""
+        params = self._walls_params(ids, counts)
+        token = self._take_token_for_wall()
+        response = self._request('execute', access_token=token.key, **params)
+        return self._parse_walls(response, ids, token)
+
+    def _take_token_for_wall(self):
+        self._refresh_tokens()
+        with self._lock:
+            now = timezone.now()
+            token = self._choose_token(now, lambda t: t.last_used_for_wall)
+            elapsed = (now - token.last_used_for_wall).total_seconds()
+            cooldown = (token.available_at - now).total_seconds()
+            delay = max(
+                0, (REQUEST_DELAY_PER_TOKEN_FOR_WALL - REQUEST_DELAY_PER_TOKEN) * token.delay_scale - elapsed, cooldown
+            )
+            if cooldown > MAX_TOKEN_COOLDOWN_WAIT:  # the usual delays are slept through
+                raise TryAgain()
+            token.last_used_for_wall = now + TimeDelta(seconds=delay)
+        time.sleep(delay)
+        with self._lock:
+            token.last_used = timezone.now() + TimeDelta(seconds=REQUEST_DELAY_PER_TOKEN)
+        time.sleep(REQUEST_DELAY_PER_TOKEN)
+        return token
+
     def _request(self, method, **params):
         params = urlencode(params)
         params = params.encode('ascii')
         try:
-            resp = urlopen('https://api.vk.com/method/' + method, data=params, timeout=HTTP_REQUEST_TIMEOUT)
-            data = resp.read()
-            with self._lock:
-                self._last_successful_request = timezone.now()
-                self._network_errors_count = 0
-            return json.loads(data)
-        except URLError as err:
-            with self._lock:
-                logger.warning(repr(err))
-                duration = (timezone.now() - self._last_successful_request).total_seconds()
-                self._network_errors_count += 1
-                if self._network_errors_count >= MIN_NETWORK_ERRORS_BEFORE_ALARM and \
-                        duration >= MIN_NETWORK_ERRORS_DURATION_BEFORE_ALARM:
-                    logger.error(
-                        '%s network errors since %s',
-                        self._network_errors_count,
-                        self._last_successful_request.strftime('%y-%m-%d %H:%M:%S'))
-                    self._last_successful_request = timezone.now()
-                    self._network_errors_count = 0
+            data = self._http.post('/method/' + method, params)
+            self._on_successful_request()
+            return json.loads(data.decode('utf-8'))
+        except (OSError, HTTPException, HttpError, ValueError) as err:
+            self._on_network_error(err)
             raise TryAgain()
@@ -0,0 +1,67 @@
+import heapq
+from itertools import count
+
+
+class WallSchedule:
+    """The communities ordered by the time of the next wall update (a timestamp),
+    the communities with more followers go first at the same time.
+    The entries are removed lazily, so push() and remove() take O(log n)."""
+
+    def __init__(self):
+        # [due, -followers, seq, community or None if removed], seq breaks the ties before the communities compare
+        self._heap = []
+        self._entries = {}  # id -> entry
+        self._seq = count()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, id_):
+        return id_ in self._entries
+
+    def get(self, id_):
+        return self._entries[id_][3]
+
+    def communities(self):
+        return (entry[3] for entry in self._entries.values())
+
+    def due_of(self, id_):
+        return self._entries[id_][0]
+
+    def push(self, comm, due):
+        self.remove(comm.vkid)
+        entry = [due, -(comm.followers or 0), next(self._seq), comm]
+        self._entries[comm.vkid] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, id_):
+        entry = self._entries.pop(id_, None)
+        if entry is not None:
+            entry[3] = None
+            if len(self._heap) > 2 * len(self._entries) + 1000:
+                self._heap = [e for e in self._heap if e[3] is not None]
+                heapq.heapify(self._heap)
+
+    def next_due(self):
+        self._drop_removed()
+        return self._heap[0][0] if self._heap else None
+
+    def pop(self, num, until):
+        """Takes up to num communities due by the time"""
+        communities = []
+        while len(communities) < num:
+            self._drop_removed()
+            if not self._heap or self._heap[0][0] > until:
+                break
+            entry = heapq.heappop(self._heap)
+            del self._entries[entry[3].vkid]
+            communities.append(entry[3])
+        return communities
+
+    def clear(self):
+        self._heap = []
+        self._entries = {}
+
+    def _drop_removed(self):
+        while self._heap and self._heap[0][3] is None:
+            heapq.heappop(self._heap)
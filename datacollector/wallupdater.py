@@ -1,77 +1,352 @@
+import asyncio
 import logging
-import re
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime as DateTime
 from datetime import timedelta as TimeDelta
+from itertools import chain
 from threading import Thread, Event
 
 from django.db import transaction
-from django.db.models import FloatField, Count, F
-from django.db.models.functions import Cast
 from django.utils import timezone
 
 import pytz
 
 from communities.models import Community, Post
-from datacollector.vkapi import REQUEST_DELAY_PER_TOKEN_FOR_WALL, TryAgain
+from datacollector.vkapi import REQUEST_DELAY_PER_TOKEN_FOR_WALL, WALLS_PER_REQUEST, MAX_POSTS_PER_WALL, TryAgain
 from .errors import VkApiParsingError
-from .models import Median
-from .utils.tld import LATIN_TLD_LIST, CYRILLIC_TLD_LIST
-
-
-WALL_UPDATE_PERIOD = 23 * 3600
-DEFAULT_UPDATE_DURATION = REQUEST_DELAY_PER_TOKEN_FOR_WALL
-MIN_PERIOD_FOR_STATS = TimeDelta(seconds=300)
+from .utils.links import find_links
+from .wallschedule import WallSchedule
+
+
+WALL_UPDATE_PERIOD = 23 * 3600  # for a community of the usual activity
+MIN_WALL_UPDATE_PERIOD = 4 * 3600
+MAX_WALL_UPDATE_PERIOD = 72 * 3600  # the counters of the posts must be checked during LIVE_POST_PERIOD
+USUAL_NEW_POSTS = 1  # per WALL_UPDATE_PERIOD
+USUAL_VIEWS_GROWTH = 0.01  # per hour, relative to the views at the previous check
+USUAL_LIKES_GROWTH = 0.01  # per hour, relative to the likes at the previous check
+DEFAULT_UPDATE_DURATION = REQUEST_DELAY_PER_TOKEN_FOR_WALL / WALLS_PER_REQUEST
+MIN_PERIOD_FOR_STATS = TimeDelta(seconds=300)  # then the changes of the communities are applied
+COMMUNITIES_RELOAD_PERIOD = TimeDelta(hours=6)
+COMMUNITY_FIELDS = (
+    'deactivated', 'ctype', 'followers', 'wall_checked_at', 'views_per_post', 'likes_per_view', 'posts_per_week',
+    'last_post_vkid', 'last_post_published_at', 'wall_update_period'
+)
 
 MIN_POSTS_NUM_FOR_STATS = 5
 MIN_LIFETIME_OF_POST = TimeDelta(hours=24)
 PERIOD_FOR_POSTS_STATS = TimeDelta(days=7)
+LIVE_POST_PERIOD = PERIOD_FOR_POSTS_STATS + MIN_LIFETIME_OF_POST  # the counters of older posts do not matter
+
+MIN_POSTS_PER_WALL = 20  # enough to notice a burst of new posts and a pinned one
+POSTS_PER_WALL_MARGIN = 2  # the requested count / the expected number of live posts
+
+RECENT_POSTS_CACHE_SIZE = 400000  # posts, a cached post takes about 260 bytes, so the cache takes up to ~100 MB
+
+PARSE_PROCESSES = 0  # 0 means the posts are parsed by the updater thread
+REQUESTS_IN_FLIGHT = 16  # of run_async(), a request waits for the buckets of its token, so it is about the tokens
+PARSE_PIPELINE_DEPTH = 4  # the parsed batches waiting to be written, then fetching waits for the database
+
+POST_VALUES_FIELDS = (
+    'vkid', 'published_at', 'content', 'views', 'likes', 'shares', 'comments', 'marked_as_ads', 'links'
+)
 
 
 logger = logging.getLogger(__name__)
 
 
+def parse_walls(walls):
+    """Runs in a worker process of the parsing stage.
+    Takes the lists of raw posts, returns [([values], [(post id, error)]) for each wall],
+    where values is a tuple of POST_VALUES_FIELDS."""
+    results = []
+    for wall_data in walls:
+        rows = []
+        errors = []
+        for post_data in wall_data:
+            try:
+                rows.append(WallUpdater._parse_post_values(post_data))
+            except VkApiParsingError as err:
+                errors.append((post_data.get('id'), repr(err)))
+        results.append((rows, errors))
+    return results
+
+
 class WallUpdater(Thread):
 
-    def __init__(self, vkapi):
+    def __init__(self, vkapi, parse_processes=PARSE_PROCESSES, requests_in_flight=REQUESTS_IN_FLIGHT):
         super().__init__()
         self._vkapi = vkapi
+        self._requests_in_flight = requests_in_flight
+        self._requests = set()  # the tasks of run_async()
+        self._slots = None  # the semaphore of the requests in flight
+        self._write_lock = None
         self._stop_event = Event()
         self._period_start = None
         self._check_time = None
         self._updated_walls = 0
-        self._communities = []  # the last element is first in queue (has a higher priority)
-
-    def _current_community(self):
-        return self._communities[-1]
-
-    def _change_current_community(self):
-        self._communities.pop()
+        self._idle_time = 0  # seconds since the period start when no wall was due
+        self._schedule = WallSchedule()
+        self._min_followers = 0  # of the communities in the schedule
+        self._reloaded_at = None
+        self._synced_at = None
+        self._period_scale = 1  # the update periods are scaled to fit the throughput
+        # community id -> {post vkid: (published_at, checked_at, views, likes)} for the posts of the stats period
+        self._recent_posts = OrderedDict()
+        self._recent_posts_size = 0  # the number of the cached posts
+        self._parse_processes = parse_processes
+        self._parser = None
+        self._pipeline = deque()  # [(communities, check time, the future of parse_walls())]
 
     def stop(self):
         self._stop_event.set()
 
     def run(self):
         logger.info('started')
+        if self._parse_processes:
+            self._parser = ProcessPoolExecutor(max_workers=self._parse_processes)
         while not self._stop_event.is_set():
             try:
-                self._loop()
+                if self._parser is None:
+                    self._loop()
+                else:
+                    self._loop_pipelined()
+            except TryAgain:
+                pass  # it is raised only after the stop
             except Exception as err:
                 logger.exception(err)
                 self._sleep(10)
+        if self._parser is not None:
+            try:
+                while self._pipeline:  # or their communities would be out of the schedule till the reload
+                    self._write_parsed_walls(*self._pipeline.popleft())
+            except Exception as err:
+                logger.exception(err)
+            self._parser.shutdown()
+            self._parser = None
+            self._pipeline.clear()
+        self._stop_event.clear()
+        logger.info('stopped')
+
+    async def run_async(self):
+        """The same as run(), but the requests to VK API are awaited (AsyncVkApi is expected)
+        and the database work is done in the executor of the event loop.
+        Up to requests_in_flight batches are awaited at once, their walls are written one by one."""
+        logger.info('started')
+        self._slots = asyncio.Semaphore(self._requests_in_flight)
+        self._write_lock = asyncio.Lock()
+        while not self._stop_event.is_set():
+            try:
+                await self._loop_async()
+            except Exception as err:
+                logger.exception(err)
+                await self._sleep_async(10)
+        await self._wait_requests_async()
         self._stop_event.clear()
         logger.info('stopped')
 
     def _loop(self):
-        if not self._communities or self._period_for_statistics_is_over():
-            num = self._calculate_communities_per_period()
-            self._load_accessible_communities(num)
-            self._reset_statistics()
+        if not self._schedule or self._reload_is_needed():
+            self._reload_communities()
+        elif self._period_for_statistics_is_over():
+            self._sync_communities()
+        else:
+            communities = self._schedule.pop(WALLS_PER_REQUEST, time.time())
+            if not communities:
+                self._idle(self._delay_until_due())
+                return
+            updated_ids = ()
+            try:
+                walls = self._get_walls(communities)
+                self._update_walls(communities, walls)
+                updated_ids = walls
+            finally:
+                self._reschedule(communities, updated_ids)
+
+    def _loop_pipelined(self):
+        """Fetching, parsing (by the worker processes) and writing of the different batches overlap.
+        The communities are rescheduled after their walls are written, as by _loop()."""
+        if not (self._schedule or self._pipeline) or self._reload_is_needed() or \
+                self._period_for_statistics_is_over():
+            while self._pipeline:
+                self._write_parsed_walls(*self._pipeline.popleft())
+            if not self._schedule or self._reload_is_needed():
+                self._reload_communities()
+            else:
+                self._sync_communities()
         else:
-            posts = self._get_new_posts()
-            with transaction.atomic():
-                self._update_wall(posts)
-                self._update_wall_stats()
-            self._change_current_community()
+            communities = self._schedule.pop(WALLS_PER_REQUEST, time.time())
+            if not communities:
+                if self._schedule:
+                    self._idle(self._delay_until_due())
+                else:  # all the communities are in the pipeline
+                    self._write_parsed_walls(*self._pipeline.popleft())
+                return
+            walls = {}
+            try:
+                walls = self._get_walls(communities)
+            finally:
+                # the rest will be requested again
+                self._reschedule([c for c in communities if c.vkid not in walls], ())
+            updated = [c for c in communities if c.vkid in walls]
+            future = self._parser.submit(parse_walls, [self._posts_to_parse(c, walls[c.vkid]) for c in updated])
+            self._pipeline.append((updated, self._check_time, future))
+            while len(self._pipeline) > PARSE_PIPELINE_DEPTH or (self._pipeline and self._pipeline[0][2].done()):
+                self._write_parsed_walls(*self._pipeline.popleft())
+
+    def _write_parsed_walls(self, communities, check_time, future):
+        self._check_time = check_time
+        updated_ids = ()
+        try:
+            comm2posts = {}
+            for comm, (rows, errors) in zip(communities, future.result()):
+                for post_id, err in errors:
+                    logger.error('community(id=%s) post(id=%s): %s', comm.vkid, post_id, err)
+                comm2posts[comm.vkid] = [
+                    Post(community=comm, checked_at=check_time, **dict(zip(POST_VALUES_FIELDS, values)))
+                    for values in rows
+                ]
+            self._write_walls(communities, comm2posts)
+            self._updated_walls += len(communities)
+            updated_ids = comm2posts
+        finally:
+            # after the wall stats are applied, the update periods are changed by them
+            self._reschedule(communities, updated_ids)
+
+    async def _loop_async(self):
+        if not (self._schedule or self._requests) or self._reload_is_needed() or \
+                self._period_for_statistics_is_over():
+            await self._wait_requests_async()  # the batches in flight are rescheduled
+            if not self._schedule or self._reload_is_needed():
+                await self._run_sync(self._reload_communities)
+            else:
+                await self._run_sync(self._sync_communities)
+        else:
+            await self._slots.acquire()
+            communities = self._schedule.pop(WALLS_PER_REQUEST, time.time())
+            if not communities:
+                self._slots.release()
+                if self._schedule:
+                    await self._idle_async(self._delay_until_due())
+                elif self._requests:  # all the communities are in flight
+                    await asyncio.wait(list(self._requests), return_when=asyncio.FIRST_COMPLETED)
+                return
+            task = asyncio.ensure_future(self._update_walls_async(communities))
+            self._requests.add(task)
+            task.add_done_callback(self._on_request_done)
+
+    async def _update_walls_async(self, communities):
+        try:
+            check_time, walls = await self._get_walls_async(communities)
+        except BaseException:
+            self._reschedule(communities, ())
+            raise
+        async with self._write_lock:
+            self._check_time = check_time
+            updated_ids = ()
+            try:
+                await self._run_sync(self._update_walls, communities, walls)
+                updated_ids = walls
+            finally:
+                self._reschedule(communities, updated_ids)
+
+    def _on_request_done(self, task):
+        self._slots.release()
+        self._requests.discard(task)
+        err = None if task.cancelled() else task.exception()
+        if err is not None and not isinstance(err, TryAgain):  # TryAgain means it is stopped
+            logger.error(repr(err), exc_info=err)
+
+    async def _wait_requests_async(self):
+        while self._requests:
+            await asyncio.wait(list(self._requests))
+
+    def _reload_communities(self):
+        """Replaces the schedule with the communities which can be updated during the period"""
+        num = self._calculate_communities_per_period()
+        reloaded_at = timezone.now()
+        communities = self._load_accessible_communities(num)
+        self._schedule.clear()
+        for comm in communities:
+            self._schedule.push(comm, self._due_time_of(comm))
+        self._min_followers = min(c.followers for c in communities) if len(communities) == num else 0
+        self._reloaded_at = self._synced_at = reloaded_at
+        self._fit_periods_to_throughput(num)
+        self._reset_statistics()
+
+    def _sync_communities(self):
+        """Applies the changes of the communities checked by CommunitiesUpdater since the last time"""
+        synced_at = timezone.now()
+        changed = Community.objects.filter(checked_at__gte=self._synced_at).only(*COMMUNITY_FIELDS)
+        added = removed = 0
+        for comm in changed:
+            if self._is_eligible(comm):
+                if comm.vkid in self._schedule:
+                    due = self._schedule.due_of(comm.vkid)
+                    scheduled = self._schedule.get(comm.vkid)  # it can be newer than the database
+                    scheduled.followers = comm.followers
+                    self._schedule.push(scheduled, due)
+                else:
+                    self._schedule.push(comm, self._due_time_of(comm))
+                    added += 1
+            elif comm.vkid in self._schedule:
+                self._schedule.remove(comm.vkid)
+                removed += 1
+        self._synced_at = synced_at
+        logger.info('%s communities added, %s removed, %s scheduled', added, removed, len(self._schedule))
+        self._fit_periods_to_throughput(self._calculate_communities_per_period())
+        self._reset_statistics()
+
+    def _fit_periods_to_throughput(self, communities_per_period):
+        """The walls which can be updated per second are shared between the scheduled communities
+        in proportion to their desired update rates"""
+        capacity = communities_per_period / WALL_UPDATE_PERIOD
+        demand = sum(1 / (c.wall_update_period or WALL_UPDATE_PERIOD) for c in self._schedule.communities())
+        if capacity > 0 and demand > 0:
+            self._period_scale = demand / capacity
+        logger.info('the update periods are scaled by %.2f', self._period_scale)
+
+    def _is_eligible(self, comm):
+        return not comm.deactivated and comm.ctype in (Community.TYPE_PUBLIC_PAGE, Community.TYPE_OPEN_GROUP) \
+            and comm.followers is not None and comm.followers >= self._min_followers
+
+    def _reschedule(self, communities, updated_ids):
+        for comm in communities:
+            if comm.vkid in updated_ids:
+                self._schedule.push(comm, self._due_time_of(comm, self._check_time))
+            else:
+                self._schedule.push(comm, self._due_time_of(comm))
+
+    def _due_time_of(self, comm, wall_checked_at=None):
+        wall_checked_at = wall_checked_at or comm.wall_checked_at
+        if wall_checked_at is None:
+            return 0  # new communities have the highest priority
+        period = (comm.wall_update_period or WALL_UPDATE_PERIOD) * self._period_scale
+        return wall_checked_at.timestamp() + min(MAX_WALL_UPDATE_PERIOD, max(MIN_WALL_UPDATE_PERIOD, period))
+
+    def _delay_until_due(self):
+        next_due = self._schedule.next_due()
+        until_sync = (self._period_start + MIN_PERIOD_FOR_STATS - timezone.now()).total_seconds()
+        return max(0, min(next_due - time.time(), until_sync))
+
+    def _reload_is_needed(self):
+        return timezone.now() - self._reloaded_at >= COMMUNITIES_RELOAD_PERIOD
+
+    def _update_walls(self, communities, walls):
+        updated = [c for c in communities if c.vkid in walls]  # the rest will be requested again
+        comm2posts = {comm.vkid: self._get_new_posts(comm, walls[comm.vkid]) for comm in updated}
+        self._write_walls(updated, comm2posts)
+        self._updated_walls += len(updated)
+
+    def _write_walls(self, communities, comm2posts):
+        """The communities and the cache of the recent posts are changed only after the commit,
+        or the posts of a rolled back write would be skipped by the next incremental fetch"""
+        with transaction.atomic():
+            self._save_posts([p for posts in comm2posts.values() for p in posts])
+            comm2stats = [(comm, self._write_wall_stats(comm, comm2posts[comm.vkid])) for comm in communities]
+        for comm, stats in comm2stats:
+            self._apply_wall_stats(comm, *stats)
 
     def _period_for_statistics_is_over(self):
         elapsed = timezone.now() - self._period_start
@@ -80,16 +355,75 @@ class WallUpdater(Thread):
     def _sleep(self, seconds):
         self._stop_event.wait(timeout=seconds)
 
-    def _get_new_posts(self):
-        comm = self._current_community()
+    def _idle(self, seconds):
+        self._sleep(seconds)
+        self._idle_time += seconds
+
+    async def _idle_async(self, seconds):
+        await self._sleep_async(seconds)
+        self._idle_time += seconds
+
+    async def _sleep_async(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self._stop_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(remaining, 1))
+
+    @staticmethod
+    async def _run_sync(fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+
+    def _get_walls(self, communities):
+        ids = [c.vkid for c in communities]
         while True:
             try:
                 self._check_time = timezone.now()
-                wall_data = self._vkapi.get_community_wall(comm.vkid)
-                break
+                return self._vkapi.get_community_walls(ids, self._posts_per_wall(communities))
             except TryAgain:
+                if self._stop_event.is_set():
+                    raise  # the batch is due again after the restart
                 self._sleep(1)
 
+    async def _get_walls_async(self, communities):
+        """Returns the check time and the walls, many requests can be awaited at once"""
+        ids = [c.vkid for c in communities]
+        while True:
+            try:
+                check_time = timezone.now()
+                return check_time, await self._vkapi.get_community_walls(ids, self._posts_per_wall(communities))
+            except TryAgain:
+                if self._stop_event.is_set():
+                    raise  # the batch is due again after the restart
+                await self._sleep_async(1)
+
+    def _posts_per_wall(self, communities):
+        """Returns {id: count}, a slow-posting community does not need all the latest posts"""
+        counts = {}
+        now = timezone.now()
+        for comm in communities:
+            count = MAX_POSTS_PER_WALL
+            if comm.last_post_vkid is not None:
+                if comm.last_post_published_at < now - LIVE_POST_PERIOD:
+                    count = MIN_POSTS_PER_WALL
+                elif comm.posts_per_week is not None:
+                    live_posts = comm.posts_per_week * (LIVE_POST_PERIOD / TimeDelta(weeks=1))
+                    count = min(MAX_POSTS_PER_WALL, max(MIN_POSTS_PER_WALL, int(live_posts * POSTS_PER_WALL_MARGIN)))
+            counts[comm.vkid] = count
+        return counts
+
+    def _get_new_posts(self, comm, wall_data):
+        posts = []
+        for post_data in self._posts_to_parse(comm, wall_data):
+            try:
+                post = self._parse_post(comm, post_data)
+                posts.append(post)
+            except VkApiParsingError as err:
+                logger.error('community(id=%s) post(id=%s): %s', comm.vkid, post_data.get('id'), repr(err))
+        return posts
+
+    def _posts_to_parse(self, comm, wall_data):
         if comm.wall_checked_at is not None:
             planned_check_time = comm.wall_checked_at + TimeDelta(seconds=WALL_UPDATE_PERIOD)
             if self._check_time > planned_check_time:
@@ -99,59 +433,152 @@ class WallUpdater(Thread):
                     (self._check_time - planned_check_time).total_seconds()
                 )
 
-        posts = []
         if wall_data is None:
             logger.warning('cannot get the wall of the community(id=%s)', comm.vkid)
-        else:
-            logger.info('got %s posts for the community(id=%s)', len(wall_data), comm.vkid)
-            for post_data in wall_data:
-                try:
-                    post = self._parse_post(post_data)
-                    posts.append(post)
-                except VkApiParsingError as err:
-                    logger.error('community(id=%s) post(id=%s): %s', comm.vkid, post_data.get('id'), repr(err))
-        return posts
+            return []
+        logger.info('got %s posts for the community(id=%s)', len(wall_data), comm.vkid)
+        if comm.last_post_vkid is not None:  # all the posts are saved at the first check
+            wall_data = [d for d in wall_data if self._post_is_new_or_live(comm, d)]
+        return wall_data
+
+    def _post_is_new_or_live(self, comm, data):
+        if (data.get('id') or 0) > comm.last_post_vkid:
+            return True
+        timestamp = data.get('date')
+        return timestamp is None or timestamp >= (self._check_time - LIVE_POST_PERIOD).timestamp()
 
-    def _update_wall(self, posts):
-        for p in posts:
-            p.save()
-        self._updated_walls += 1
-
-    def _update_wall_stats(self):
-        comm = self._current_community()
-        posts_stats = Post.objects.filter(
-            community_id=comm,
-            published_at__gt=self._check_time - PERIOD_FOR_POSTS_STATS - MIN_LIFETIME_OF_POST,
-            checked_at__gte=F('published_at') + MIN_LIFETIME_OF_POST,
-            views__gt=0
-        ).aggregate(
-            views_per_post=Median('views'),
-            likes_per_view=Median(Cast('likes', FloatField()) / Cast('views', FloatField())),
-            count=Count('*')
-        )
-        if posts_stats['count'] >= MIN_POSTS_NUM_FOR_STATS:
-            comm.views_per_post = posts_stats['views_per_post']
-            comm.likes_per_view = posts_stats['likes_per_view']
+    @staticmethod
+    def _last_post_of(comm, posts):
+        """The newest of the seen and the parsed posts as (vkid, published_at)"""
+        if posts:
+            last_post = max(posts, key=lambda p: p.vkid)
+            if comm.last_post_vkid is None or last_post.vkid > comm.last_post_vkid:
+                return last_post.vkid, last_post.published_at
+        return comm.last_post_vkid, comm.last_post_published_at
+
+    @staticmethod
+    def _save_posts(posts):
+        Post.objects.upsert(posts)
+
+    def _update_wall_stats(self, comm, posts=()):
+        self._apply_wall_stats(comm, *self._write_wall_stats(comm, posts))
+
+    def _write_wall_stats(self, comm, posts):
+        """Writes the stats of the community, returns them as {field: value} and the recent posts to cache,
+        neither the community nor the cache is changed.
+        The posts are the just parsed ones, the rest of the period is taken from the cache."""
+        recent_posts, views_growth, likes_growth = self._recent_posts_of(comm, posts)
+        stats_posts = [
+            (views, likes)
+            for published_at, checked_at, views, likes in recent_posts.values()
+            if checked_at >= published_at + MIN_LIFETIME_OF_POST and views is not None and views > 0
+        ]
+        values = {'views_per_post': None, 'likes_per_view': None}
+        if len(stats_posts) >= MIN_POSTS_NUM_FOR_STATS:
+            values['views_per_post'] = self._median([views for views, likes in stats_posts])
+            values['likes_per_view'] = self._median([likes / views for views, likes in stats_posts])
+        values['last_post_vkid'], values['last_post_published_at'] = self._last_post_of(comm, posts)
+        values['wall_update_period'] = self._desired_update_period(recent_posts.values(), views_growth, likes_growth)
+        values['wall_checked_at'] = self._check_time
+        Community.objects.filter(vkid=comm.vkid).update(**values)
+        return values, recent_posts
+
+    def _apply_wall_stats(self, comm, values, recent_posts):
+        for field, value in values.items():
+            setattr(comm, field, value)
+        self._cache_recent_posts(comm.vkid, recent_posts)
+
+    def _desired_update_period(self, recent_posts, views_growth, likes_growth=None):
+        """A community which posts more or whose posts gain views and likes faster is updated more often,
+        the activity is the mean of the known rates relative to the usual ones"""
+        week_ago = self._check_time - TimeDelta(weeks=1)
+        posts_per_week = sum(1 for published_at, _, _, _ in recent_posts if published_at > week_ago)
+        new_posts = posts_per_week * WALL_UPDATE_PERIOD / TimeDelta(weeks=1).total_seconds()
+        rates = [new_posts / USUAL_NEW_POSTS]
+        if views_growth is not None:
+            rates.append(views_growth / USUAL_VIEWS_GROWTH)
+        if likes_growth is not None:
+            rates.append(likes_growth / USUAL_LIKES_GROWTH)
+        activity = sum(rates) / len(rates)
+        period = WALL_UPDATE_PERIOD * 2 / (1 + activity)  # the usual activity is 1
+        return int(min(MAX_WALL_UPDATE_PERIOD, max(MIN_WALL_UPDATE_PERIOD, period)))
+
+    def _recent_posts_of(self, comm, posts):
+        """Returns the values of the recent posts by vkid and the growth of their views and likes per hour
+        since the previous check (None if the previous values are unknown), the cache is not changed"""
+        period_start = self._check_time - PERIOD_FOR_POSTS_STATS - MIN_LIFETIME_OF_POST
+        recent = self._recent_posts.get(comm.vkid)
+        views_growth = likes_growth = None
+        if recent is not None:
+            views_growth = self._growth(recent, posts, 'views')
+            likes_growth = self._growth(recent, posts, 'likes')
         else:
-            comm.views_per_post = None
-            comm.likes_per_view = None
+            recent = {
+                vkid: values
+                for vkid, *values in Post.objects.filter(
+                    community_id=comm.vkid,
+                    published_at__gt=period_start
+                ).values_list('vkid', 'published_at', 'checked_at', 'views', 'likes')
+            }
+        parsed = {p.vkid: (p.published_at, p.checked_at, p.views, p.likes) for p in posts}
+        recent = {vkid: values for vkid, values in chain(recent.items(), parsed.items()) if values[0] > period_start}
+        return recent, views_growth, likes_growth
+
+    def _cache_recent_posts(self, comm_id, recent):
+        """The least recently updated communities are evicted when there are too many posts"""
+        previous = self._recent_posts.pop(comm_id, None)
+        if previous is not None:
+            self._recent_posts_size -= len(previous)
+        self._recent_posts[comm_id] = recent
+        self._recent_posts_size += len(recent)
+        while self._recent_posts_size > RECENT_POSTS_CACHE_SIZE:
+            _, evicted = self._recent_posts.popitem(last=False)
+            self._recent_posts_size -= len(evicted)
 
-        comm.wall_checked_at = self._check_time
-        comm.save(update_fields=['wall_checked_at', 'views_per_post', 'likes_per_view'])
+    @staticmethod
+    def _growth(previous, posts, counter):
+        """The growth of the counter ('views' or 'likes') per hour relative to its previous values"""
+        index = 2 if counter == 'views' else 3  # in the cached values
+        gained = 0
+        weight = 0  # counter * hours
+        for p in posts:
+            if p.vkid in previous and getattr(p, counter) is not None:
+                values = previous[p.vkid]
+                hours = (p.checked_at - values[1]).total_seconds() / 3600
+                if values[index] and hours > 0:
+                    gained += max(0, getattr(p, counter) - values[index])
+                    weight += values[index] * hours
+        return gained / weight if weight else None
 
-    def _parse_post(self, data):
+    @staticmethod
+    def _median(values):
+        """The same as PERCENTILE_CONT(0.5) in PostgreSQL"""
+        values = sorted(values)
+        half = (len(values) - 1) / 2
+        lo = values[int(half)]
+        hi = values[-int(half) - 1]
+        return float(lo + (hi - lo) * 0.5)
+
+    def _parse_post(self, comm, data):
         return Post(
-            community=self._current_community(),
-            vkid=self._parse_post_id(data),
+            community=comm,
             checked_at=self._check_time,
-            published_at=self._parse_publish_time(data),
-            content=self._parse_content(data),
-            views=self._parse_views(data),
-            likes=self._parse_likes(data),
-            shares=self._parse_shares(data),
-            comments=self._parse_comments(data),
-            marked_as_ads=self._parse_ads_mark(data),
-            links=self._count_links(data)
+            **dict(zip(POST_VALUES_FIELDS, self._parse_post_values(data)))
+        )
+
+    @classmethod
+    def _parse_post_values(cls, data):
+        """Returns a tuple of POST_VALUES_FIELDS"""
+        return (
+            cls._parse_post_id(data),
+            cls._parse_publish_time(data),
+            cls._parse_content(data),
+            cls._parse_views(data),
+            cls._parse_likes(data),
+            cls._parse_shares(data),
+            cls._parse_comments(data),
+            cls._parse_ads_mark(data),
+            cls._count_links(data)
         )
 
     @staticmethod
@@ -264,32 +691,25 @@ class WallUpdater(Thread):
     def _parse_ads_mark(data):
         return data.get('marked_as_ads') == 1
 
-    def _count_links(self, data):
+    @classmethod
+    def _count_links(cls, data):
         try:
             text_list = [data['text']]
             text_list.extend(p['text'] for p in data.get('copy_history', []))
         except KeyError:
             raise VkApiParsingError('no text or invalid a copy_history')
         return sum(
-            len(self._find_links(text))
+            len(cls._find_links(text))
             for text in text_list
         )
 
-    _TLD_LIST = sorted(LATIN_TLD_LIST + CYRILLIC_TLD_LIST, reverse=True)
-    _REGEXP = re.compile(
-        r'''((?i:https://)?)'''
-        r'''(@)?'''  # to exclude emails
-        r'''((?:[-_0-9a-zA-Zа-яёґєіїА-ЯЁҐЄІЇ]+\.)+)'''
-        r'''((?i:{}))'''.format('|'.join(_TLD_LIST)) + r'''(?![-0-9a-zA-Zа-яА-Я])'''
-        r'''([/?#][-_.,/\\+=;:"'~!@#$%&?<>0-9a-zA-Zа-яёґєіїА-ЯЁҐЄІЇ]*)?'''
-    )
     _EXCLUDED_DOMAINS = ('vk.com', 'm.vk.com', '0.vk.com')
 
     @classmethod
     def _find_links(cls, text):
         """Omits any protocol except HTTPS"""
         links = []
-        for protocol, at, name, tld, path in cls._REGEXP.findall(text):
+        for protocol, at, name, tld, path in find_links(text):
             domain = name + tld
             if not at and domain not in cls._EXCLUDED_DOMAINS:
                 links.append(protocol + domain + path)
@@ -299,8 +719,8 @@ class WallUpdater(Thread):
         if self._updated_walls == 0:
             update_duration = DEFAULT_UPDATE_DURATION
         else:
-            elapsed = (timezone.now() - self._period_start).total_seconds()
-            update_duration = elapsed / self._updated_walls
+            elapsed = (timezone.now() - self._period_start).total_seconds() - self._idle_time
+            update_duration = max(elapsed, 0) / self._updated_walls or DEFAULT_UPDATE_DURATION
         num = int(WALL_UPDATE_PERIOD / update_duration)
         logger.info('calculated: %s communities per period, %.2f seconds per each one', num, update_duration)
         return num
@@ -313,23 +733,13 @@ class WallUpdater(Thread):
         ).order_by(
             '-followers'
         ).only(
-            'followers', 'wall_checked_at', 'views_per_post', 'likes_per_view'
+            *COMMUNITY_FIELDS
         )[:num]
-
-        self._communities = sorted(
-            communities,
-            key=self._priority_of_community
-        )
-        logger.info('loaded %s communities', len(self._communities))
-
-    @staticmethod
-    def _priority_of_community(comm):
-        if comm.wall_checked_at is None:
-            time_priority = 0  # new communities have the highest priority
-        else:
-            time_priority = -comm.wall_checked_at.timestamp()
-        return time_priority, comm.followers
+        communities = list(communities)
+        logger.info('loaded %s communities', len(communities))
+        return communities
 
     def _reset_statistics(self):
         self._period_start = timezone.now()
         self._updated_walls = 0
+        self._idle_time = 0